@@ -27,7 +27,7 @@ from time import time
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-from math import ceil
+from math import ceil, gcd
 from numpy import float32, zeros, empty, int32, uint8, uint16, clip, histogram
 from cv2 import imwrite, moments, threshold, THRESH_BINARY, Laplacian, CV_32F, minMaxLoc
 
@@ -59,6 +59,8 @@ class AlignFrames(object):
                                 percent (int).
         """
 
+        # A window set for a previous ROI does not apply when this phase is repeated.
+        frames.reset_window()
         self.frames = frames
         self.rank_frames = rank_frames
         self.shape = frames.shape
@@ -237,9 +239,13 @@ class AlignFrames(object):
         # because in the loop below the optimal frame is not counted.
         number_processed = 1
 
-        # Loop over all frames. Begin with the sharpest (reference) frame
-        for idx in chain(reversed(range(self.rank_frames.frame_ranks_max_index + 1)),
-                         range(self.rank_frames.frame_ranks_max_index, self.frames.number)):
+        # Loop over all frames. Begin with the sharpest (reference) frame and proceed in two chains
+        # to the first and the last frame. Announce this access sequence to the frames object, so
+        # that frames can be read ahead.
+        index_sequence = list(chain(reversed(range(self.rank_frames.frame_ranks_max_index + 1)),
+                         range(self.rank_frames.frame_ranks_max_index, self.frames.number)))
+        self.frames.prefetch(index_sequence, 'gaussian')
+        for idx in index_sequence:
 
             if idx == self.rank_frames.frame_ranks_max_index:
                 # For the sharpest frame the displacement is 0 because it is used as the reference.
@@ -422,6 +428,77 @@ class AlignFrames(object):
                                    [max(b[1] for b in self.frame_shifts),
                                     min(b[1] for b in self.frame_shifts) + self.shape[1]]]
 
+    @staticmethod
+    def object_window(frames, configuration):
+        """
+        For "Planet" mode: Find a window around the object which can be used to crop all frames.
+        In a sample of frames the object is detected with the threshold used in
+        "center_of_gravity". The union of the object bounding boxes is padded by the search widths
+        of frame alignment and alignment points (which cover drifts not seen in the sample), plus
+        a safety margin.
+
+        :param frames: Frames object with all video frames (not cropped yet)
+        :param configuration: Configuration object with parameters
+        :return: Window (y_low, y_high, x_low, x_high), or None if the window would not be
+                 significantly smaller than the full frame.
+        """
+
+        number_samples = max(min(configuration.frames_auto_crop_sample_frames, frames.number), 1)
+        indices = sorted(set(int(i * frames.number / number_samples) for i in
+                             range(number_samples)))
+
+        y_low = x_low = None
+        for index in indices:
+            frame = frames.widen_gaussian(frames.gaussian_from_monochrome(
+                frames.monochrome_from_original(frames.read_frame_calibrated(index))))
+            box = AlignFrames.object_bounding_box(frame)
+            if box is None:
+                continue
+            if y_low is None:
+                y_low, y_high, x_low, x_high = box
+            else:
+                y_low, y_high = min(y_low, box[0]), max(y_high, box[1])
+                x_low, x_high = min(x_low, box[2]), max(x_high, box[3])
+        if y_low is None:
+            return None
+
+        # The lower window bounds are multiples of the sampling stride (for down-sampled
+        # Laplacians) and even (for Bayer patterns).
+        stride = configuration.align_frames_sampling_stride
+        alignment = stride * 2 // gcd(stride, 2)
+        pad = configuration.align_frames_search_width + \
+              configuration.alignment_points_search_width + configuration.frames_roi_window_margin
+        y_low = max(y_low - pad, 0) // alignment * alignment
+        y_high = min(y_high + pad, frames.shape[0])
+        x_low = max(x_low - pad, 0) // alignment * alignment
+        x_high = min(x_high + pad, frames.shape[1])
+
+        if (y_high - y_low) * (x_high - x_low) > \
+                configuration.frames_auto_crop_max_fraction * frames.shape[0] * frames.shape[1]:
+            return None
+        return y_low, y_high, x_low, x_high
+
+    @staticmethod
+    def object_bounding_box(frame):
+        """
+        Compute the bounding box of the object in a monochrome frame. As in method
+        "center_of_gravity", the object consists of all pixels brighter than the mean of the
+        minimal and maximal brightness.
+
+        :param frame: Monochrome frame (2D numpy array)
+        :return: Tuple (y_low, y_high, x_low, x_high), or None if no object is found.
+        """
+
+        minVal, maxVal, minLoc, maxLoc = minMaxLoc(frame)
+        if maxVal <= minVal:
+            return None
+        object_pixels = frame > int((minVal + maxVal) / 2)
+        rows = object_pixels.any(axis=1).nonzero()[0]
+        columns = object_pixels.any(axis=0).nonzero()[0]
+        if not len(rows):
+            return None
+        return int(rows[0]), int(rows[-1]) + 1, int(columns[0]), int(columns[-1]) + 1
+
     @staticmethod
     def center_of_gravity(frame):
         """
@@ -509,6 +586,7 @@ class AlignFrames(object):
         # Create an empty numpy buffer. The first and second dimensions are the y and x
         # coordinates. For color frames add a third dimension. Add all frames to the buffer.
         if color:
+            self.frames.prefetch(average_frame_indices, 'original')
             self.mean_frame = zeros([self.intersection_shape[0][1] - self.intersection_shape[0][0],
                  self.intersection_shape[1][1] - self.intersection_shape[1][0], 3], dtype=float32)
             for frame_index in average_frame_indices:
@@ -519,6 +597,7 @@ class AlignFrames(object):
                     self.intersection_shape[1][0] - shift[1]:
                     self.intersection_shape[1][1] - shift[1], :]
         else:
+            self.frames.prefetch(average_frame_indices, 'monochrome')
             self.mean_frame = zeros([self.intersection_shape[0][1] - self.intersection_shape[0][0],
                                      self.intersection_shape[1][1] - self.intersection_shape[1][0]],
                                      dtype=float32)
@@ -561,10 +640,17 @@ class AlignFrames(object):
         if self.intersection_shape is None:
             raise WrongOrderingError("Method 'set_roi' is called before 'align_frames'")
 
-        # On the first call, keep a copy of the full mean frame and original intersection shape.
+        # If the frames have been restricted to the window of a previous ROI, return to full frames.
+        # The original intersection shape refers to full frames.
+        self.frames.reset_window()
+
+        # On the first call, keep a copy of the full mean frame, original intersection shape and
+        # full-frame global offsets.
         if not self.ROI_set:
             self.mean_frame_original = self.mean_frame.copy()
             self.intersection_shape_original = self.intersection_shape.copy()
+            self.dy_original = self.dy
+            self.dx_original = self.dx
 
         if y_min == 0 and y_max == 0 and x_min == 0 and x_max == 0:
             y_min = 0
@@ -594,19 +680,64 @@ class AlignFrames(object):
 
         self.mean_frame = self.mean_frame_original[y_min:y_max, x_min:x_max]
 
+        # If the ROI is smaller than the intersection, restrict all frames to a window around it.
+        if self.configuration.frames_roi_window and self.mean_frame.shape != \
+                self.mean_frame_original.shape:
+            self.restrict_frames_to_roi()
+
         return self.mean_frame
 
+    def restrict_frames_to_roi(self):
+        """
+        Restrict the frames to a window which in all frames contains the ROI, padded by the AP
+        search width and a safety margin. Frames are then read, buffered and processed for this
+        window only. The intersection shape and the global offsets are translated to window
+        coordinates, so that subsequent phases work unchanged.
+
+        :return: -
+        """
+
+        # The lower window bounds are multiples of the sampling stride (for down-sampled
+        # Laplacians) and even (for Bayer patterns).
+        stride = self.configuration.align_frames_sampling_stride
+        alignment = stride * 2 // gcd(stride, 2)
+        pad = self.configuration.alignment_points_search_width + \
+              self.configuration.frames_roi_window_margin
+        roi_height = self.intersection_shape[0][1] - self.intersection_shape[0][0]
+        roi_width = self.intersection_shape[1][1] - self.intersection_shape[1][0]
+
+        y_low = max(min(self.dy) - pad, 0) // alignment * alignment
+        y_high = min(max(self.dy) + roi_height + pad, self.frames.shape[0])
+        x_low = max(min(self.dx) - pad, 0) // alignment * alignment
+        x_high = min(max(self.dx) + roi_width + pad, self.frames.shape[1])
+
+        # If the window is not smaller than the full frame, there is nothing to gain.
+        if y_high - y_low >= self.frames.shape[0] and x_high - x_low >= self.frames.shape[1]:
+            return
+
+        self.frames.set_window(y_low, y_high, x_low, x_high)
+        self.intersection_shape = [[self.intersection_shape[0][0] - y_low,
+                                    self.intersection_shape[0][1] - y_low],
+                                   [self.intersection_shape[1][0] - x_low,
+                                    self.intersection_shape[1][1] - x_low]]
+        self.dy = [dy - y_low for dy in self.dy]
+        self.dx = [dx - x_low for dx in self.dx]
+
     def reset_roi(self):
         """
-        After a ROI has been set, reset the ROI to the full frame. Restore the mean frame and
-        the intersection shape to their original values. If no ROI has been set, do nothing.
+        After a ROI has been set, reset the ROI to the full frame. Restore the mean frame, the
+        intersection shape and the global offsets to their original (full-frame) values. If no ROI
+        has been set, do nothing.
 
         :return: -
         """
 
         if self.ROI_set:
+            self.frames.reset_window()
             self.mean_frame = self.mean_frame_original
             self.intersection_shape = self.intersection_shape_original
+            self.dy = self.dy_original
+            self.dx = self.dx_original
 
     def write_stabilized_video(self, name, fps, stabilized=True):
         """
@@ -649,6 +780,58 @@ class AlignFrames(object):
 
 
 if __name__ == "__main__":
+    from os import path
+    from shutil import rmtree
+    from struct import pack
+    from tempfile import mkdtemp
+
+    from numpy import array_equal, exp, indices
+    from numpy.random import normal, randint, seed
+
+    # Self-check of the object window: It must contain the object in all frames, obey the
+    # alignment rules for windows, and frames cropped to it must be cut out of the full frames. If
+    # the object fills most of the frame, no window is returned. The test videos show a slightly
+    # moving, blurred planetary disk.
+    seed(1)
+    test_dir = mkdtemp()
+    test_configuration = Configuration()
+    test_configuration.initialize_configuration(read_from_file=False)
+    test_configuration.set_derived_parameters()
+    for shape, cropped in [((200, 240), True), ((48, 64), False)]:
+        y, x = indices(shape)
+        test_frames = empty((12,) + shape, dtype=uint16)
+        for index in range(12):
+            test_frames[index] = clip(2800. * exp(-(
+                (y - shape[0] // 2 - randint(-3, 4)) ** 2 +
+                (x - shape[1] // 2 - randint(-3, 4)) ** 2) / (0.02 * shape[0] * shape[1])) +
+                                      normal(200., 40., shape), 0, 4095)
+        test_file = path.join(test_dir, 'planet_' + str(shape[0]) + '.ser')
+        with open(test_file, 'wb') as test_fid:
+            test_fid.write(pack('<14s 7i 40s 40s 40s 2q', b'LUCAM-RECORDER', 0, 0, 1, shape[1],
+                                shape[0], 16, 12, b'', b'', b'', 0, 0))
+            test_fid.write(test_frames.astype('<u2').tobytes())
+        test_object = Frames(test_configuration, test_file, type='video', buffering_level=4)
+        window = AlignFrames.object_window(test_object, test_configuration)
+        assert (window is not None) == cropped
+        if cropped:
+            stride = test_configuration.align_frames_sampling_stride
+            assert window[0] % stride == 0 and window[2] % stride == 0
+            assert window[0] % 2 == 0 and window[2] % 2 == 0
+            assert (window[1] - window[0]) * (window[3] - window[2]) < shape[0] * shape[1]
+            full_frames = [test_object.frames(index) for index in range(test_object.number)]
+            boxes = [AlignFrames.object_bounding_box(test_object.frames_mono_blurred(index))
+                     for index in range(test_object.number)]
+            assert all(window[0] <= box[0] and box[1] <= window[1] and window[2] <= box[2] and
+                       box[3] <= window[3] for box in boxes)
+            test_object.set_base_window(*window)
+            assert test_object.shape == (window[1] - window[0], window[3] - window[2])
+            for index in range(test_object.number):
+                assert array_equal(test_object.frames(index), full_frames[index][
+                                   window[0]:window[1], window[2]:window[3]])
+        test_object.close_reader()
+    rmtree(test_dir)
+    print("Object window self-check passed")
+
     # Images can either be extracted from a video file or a batch of single photographs. Select
     # the example for the test run.
     type = 'video'
@@ -666,6 +849,12 @@ if __name__ == "__main__":
         names = 'Videos/' + file + '.avi'
     print(names)
 
+    # The example recordings are not part of the repository. Stop after the self-check if they are
+    # not available.
+    if not (names if type == 'image' else path.isfile(names)):
+        print("Example input not found, frame alignment demo skipped")
+        exit()
+
     # Get configuration parameters.
     configuration = Configuration()
     configuration.initialize_configuration()
@@ -635,6 +635,7 @@ class AlignmentPoints(object):
                 self.configuration.alignment_points_rank_method != "Laplace":
             # There are no stored Laplacians, or they cannot be used for the specified method.
             # Cycle through all frames and alignment points:
+            self.frames.prefetch(range(self.frames.number), 'gaussian')
             for frame_index in range(self.frames.number):
                 frame = self.frames.frames_mono_blurred(frame_index)
 
@@ -670,6 +671,7 @@ class AlignmentPoints(object):
             # "frames.frames_mono_blurred_laplacian". Cut out boxes around alignment points from
             # those objects, rather than computing new Laplacians. Cycle through all frames and
             # alignment points. Use the blurred monochrome image for ranking.
+            self.frames.prefetch(range(self.frames.number), 'laplacian')
             for frame_index in range(self.frames.number):
                 frame = self.frames.frames_mono_blurred_laplacian(frame_index)
 
@@ -0,0 +1,284 @@
+# -*- coding: utf-8; -*-
+"""
+Copyright (c) 2018 Rolf Hempel, rolf6419@gmx.de
+
+This file is part of the PlanetarySystemStacker tool (PSS).
+https://github.com/Rolf-Hempel/PlanetarySystemStacker
+
+PSS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PSS.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+from itertools import product
+
+
+class BufferPlanner(object):
+    """
+    Decide which frame variants are to be buffered, based on a cost model. The model combines the
+    access pattern of the PSS workflow (see the docstring of class "Frames"), the time needed to
+    read a frame and to compute its variants (measured with a short probe), and the RAM available.
+
+    For every variant the plan gives the fraction of frames to be buffered. Besides "all frames"
+    and "no frame", a variant can be buffered for the best frames only (e.g. the frames to be
+    stacked). The plan with the lowest predicted runtime which fits into the RAM is selected.
+
+    """
+
+    variants = ['original', 'monochrome', 'gaussian', 'laplacian']
+
+    # Each variant is computed from its parent. Original frames are read from the input.
+    parents = {'monochrome': 'original', 'gaussian': 'monochrome', 'laplacian': 'gaussian'}
+
+    def __init__(self, frames, configuration):
+        """
+        Initialize the planner.
+
+        :param frames: Frames object with all video frames
+        :param configuration: Configuration object with parameters
+        """
+
+        self.frames = frames
+        self.configuration = configuration
+        self.number = frames.number_original
+
+        # Costs (in seconds per frame) of reading a frame and computing each variant from its
+        # parent. They are set by method "probe".
+        self.costs = None
+
+        # Results of the planning.
+        self.plan = None
+        self.predicted_time = None
+        self.required_ram = None
+
+    def probe(self):
+        """
+        Measure the costs of reading frames and computing their variants.
+
+        :return: -
+        """
+
+        self.costs = self.frames.probe_costs(self.configuration.frames_planner_probe_frames)
+
+    def stack_fraction(self):
+        """
+        Estimate the fraction of frames which will be stacked.
+
+        :return: Fraction of frames (0. - 1.)
+        """
+
+        if self.configuration.alignment_points_frame_number > 0:
+            return min(float(self.configuration.alignment_points_frame_number) / self.number, 1.)
+        else:
+            return min(self.configuration.alignment_points_frame_percent / 100., 1.)
+
+    def access_pattern(self):
+        """
+        Describe the frame accesses of the workflow phases. Each access phase touches either all
+        frames, or the best frames only.
+
+        :return: List of tuples (variant, fraction of best frames accessed, after ranking)
+        """
+
+        average_fraction = min(self.configuration.align_frames_average_frame_percent / 100., 1.)
+        stack_fraction = self.stack_fraction()
+
+        if self.configuration.rank_frames_method == "Laplace":
+            rank_variant = 'laplacian'
+        else:
+            rank_variant = 'gaussian'
+        if self.configuration.rank_frames_method == "Laplace" and \
+                self.configuration.alignment_points_rank_method == "Laplace":
+            quality_variant = 'laplacian'
+        else:
+            quality_variant = 'gaussian'
+
+        return [(rank_variant, 1., False),
+                ('gaussian', 1., True),
+                ('monochrome', average_fraction, True),
+                (quality_variant, 1., True),
+                ('original', stack_fraction, True),
+                ('gaussian', stack_fraction, True)]
+
+    def access_cost(self, variant, position, after_ranking, fractions, stored):
+        """
+        Compute the cost of accessing a frame variant, and record if it is stored afterwards.
+
+        :param variant: Frame variant accessed
+        :param position: Position of the frame in the quality ranking (0. best, 1. worst)
+        :param after_ranking: True, if the access happens after ranking. Only then frames can be
+                              selected for partial buffering.
+        :param fractions: Buffering plan
+        :param stored: Set of variants currently stored for this frame. It is updated.
+        :return: Cost in seconds.
+        """
+
+        if variant in stored:
+            return 0.
+
+        cost = self.costs[variant]
+        if variant in BufferPlanner.parents:
+            cost += self.access_cost(BufferPlanner.parents[variant], position, after_ranking,
+                                     fractions, stored)
+
+        fraction = fractions[variant]
+        if fraction >= 1. or (after_ranking and position < fraction):
+            stored.add(variant)
+        return cost
+
+    def predict_time(self, fractions):
+        """
+        Predict the total time spent in reading frames and computing variants for a given plan.
+
+        :param fractions: Buffering plan
+        :return: Predicted time in seconds.
+        """
+
+        pattern = self.access_pattern()
+
+        # Frames between two consecutive breakpoints of the ranking behave identically.
+        breakpoints = sorted(set([0., 1.] + [fraction for (variant, fraction, after) in pattern] +
+                                 [fraction for fraction in fractions.values() if
+                                  0. < fraction < 1.]))
+
+        total_time = 0.
+        for low, high in zip(breakpoints[:-1], breakpoints[1:]):
+            position = (low + high) / 2.
+            stored = set()
+            frame_time = 0.
+            for variant, fraction, after_ranking in pattern:
+                if position < fraction:
+                    frame_time += self.access_cost(variant, position, after_ranking, fractions,
+                                                   stored)
+            total_time += frame_time * (high - low) * self.number
+
+        return total_time
+
+    def candidate_plans(self):
+        """
+        Create all plans to be evaluated. For every variant the buffered fraction is either zero,
+        the fraction of frames averaged for the reference frame, the stack fraction, or one.
+
+        :return: List of plans.
+        """
+
+        average_fraction = min(self.configuration.align_frames_average_frame_percent / 100., 1.)
+        choices = sorted(set([0., average_fraction, self.stack_fraction(), 1.]))
+        return [dict(zip(BufferPlanner.variants, combination)) for combination in
+                product(choices, repeat=len(BufferPlanner.variants))]
+
+    def compute_plan(self, available_ram):
+        """
+        Select the plan with the lowest predicted runtime which fits into the available RAM. Plans
+        which are only marginally faster (by less than "frames_planner_time_tolerance", relative)
+        than the plan with the lowest RAM requirement do not justify the additional RAM, so the
+        latter is chosen in this case.
+
+        :param available_ram: RAM available for the job in Gbytes.
+        :return: True, if a plan was found. False otherwise.
+        """
+
+        if self.costs is None:
+            self.probe()
+
+        feasible = []
+        for fractions in self.candidate_plans():
+            required_ram = self.frames.compute_required_buffer_size_fractions(fractions)
+            if required_ram < available_ram:
+                feasible.append((self.predict_time(fractions), required_ram, fractions))
+
+        if not feasible:
+            self.plan = None
+            return False
+
+        minimum_time = min(plan[0] for plan in feasible)
+        time_limit = minimum_time * (1. + self.configuration.frames_planner_time_tolerance)
+        self.predicted_time, self.required_ram, self.plan = min(
+            (plan for plan in feasible if plan[0] <= time_limit), key=lambda plan: plan[1])
+        return True
+
+    def plan_description(self):
+        """
+        Create a printable description of the plan.
+
+        :return: String with the buffered percentage for each variant.
+        """
+
+        items = []
+        for variant in BufferPlanner.variants:
+            fraction = self.plan[variant]
+            if fraction >= 1.:
+                items.append(variant + ": all")
+            elif fraction <= 0.:
+                items.append(variant + ": none")
+            else:
+                items.append(variant + ": best " + str(round(100. * fraction, 1)) + "%")
+        return ", ".join(items)
+
+    def costs_description(self):
+        """
+        Create a printable description of the measured costs.
+
+        :return: String with the time in milliseconds per frame for each variant.
+        """
+
+        return ", ".join(variant + ": " + str(round(1000. * self.costs[variant], 2)) for
+                         variant in BufferPlanner.variants)
+
+
+if __name__ == "__main__":
+    from math import ceil
+
+    from configuration import Configuration
+
+    class TestFrames(object):
+        """
+        Stand-in for a Frames object with fixed frame sizes, so that plans can be checked without
+        reading a video. Sizes are in Gbytes per frame, plus a constant workspace.
+        """
+
+        number_original = 200
+        sizes = {'original': 0.006, 'monochrome': 0.002, 'gaussian': 0.004, 'laplacian': 0.001}
+
+        def compute_required_buffer_size_fractions(self, fractions):
+            return 0.1 + sum(TestFrames.sizes[variant] * int(ceil(fraction * 200))
+                             for variant, fraction in fractions.items())
+
+    # Self-check: With ample RAM every variant is computed once per frame (within the time
+    # tolerance), with barely any RAM nothing is buffered, and more RAM never makes the selected
+    # plan slower. Selected plans must always fit into the RAM.
+    configuration = Configuration()
+    configuration.initialize_configuration(read_from_file=False)
+    planner = BufferPlanner(TestFrames(), configuration)
+    planner.costs = {'original': 0.004, 'monochrome': 0.001, 'gaussian': 0.003,
+                     'laplacian': 0.002}
+    minimum_time = 200 * sum(planner.costs.values())
+    assert abs(planner.predict_time(dict.fromkeys(BufferPlanner.variants, 1.)) -
+               minimum_time) < 1.e-9
+
+    assert not planner.compute_plan(0.05)
+    assert planner.compute_plan(0.11)
+    assert all(fraction == 0. for fraction in planner.plan.values())
+    unbuffered_time = planner.predicted_time
+    assert unbuffered_time > 2. * minimum_time
+
+    previous_time = unbuffered_time
+    for available_ram in [0.2, 0.5, 1., 2., 4., 100.]:
+        assert planner.compute_plan(available_ram)
+        assert planner.required_ram < available_ram
+        assert planner.predicted_time <= previous_time * \
+               (1. + configuration.frames_planner_time_tolerance) + 1.e-9
+        previous_time = planner.predicted_time
+    assert planner.predicted_time <= minimum_time * \
+           (1. + configuration.frames_planner_time_tolerance) + 1.e-9
+    print("Buffer planner self-check passed: " + planner.plan_description())
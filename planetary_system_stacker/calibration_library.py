@@ -0,0 +1,268 @@
+# -*- coding: utf-8; -*-
+"""
+Copyright (c) 2018 Rolf Hempel, rolf6419@gmx.de
+
+This file is part of the PlanetarySystemStacker tool (PSS).
+https://github.com/Rolf-Hempel/PlanetarySystemStacker
+
+PSS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PSS.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+
+from hashlib import sha1
+from json import dump, load, dumps
+from os import makedirs, remove, replace
+from os.path import join, isfile
+from time import time
+
+from numpy import save, load as np_load
+
+from sidecar_cache import SidecarCache
+
+
+class CalibrationLibrary(object):
+    """
+    Persistent on-disk library of master dark and flat frames. Every master is stored as a ".npy"
+    file together with its metadata in a JSON index: the kind ('dark' or 'flat'), shape, dtype,
+    color mode, Bayer pattern and pixel shift of the input, the identity of the source file(s) it
+    was built from, and the parameters of its construction.
+
+    Masters are found again either by their source (so they are not rebuilt if the same darks or
+    flats are selected again), or by the frame format of a stacking job (so that a batch of jobs
+    can be calibrated without selecting masters by hand). Derived versions of a master (e.g. the
+    dark frame adapted to the dtype and pixel shift of a job, or the inverse flat) are stored as
+    variants next to the master, so they are computed only once.
+
+    """
+
+    index_name = 'library.json'
+    library_version = 1
+
+    def __init__(self, directory):
+        """
+        Open (or create) the library in a given directory.
+
+        :param directory: Directory of the library
+        """
+
+        self.directory = directory
+        makedirs(self.directory, exist_ok=True)
+        self.index_path = join(self.directory, CalibrationLibrary.index_name)
+        self.entries = self.read_index()
+
+    def read_index(self):
+        """
+        Read the index of the library. Entries whose master file is missing are dropped.
+
+        :return: List of entries (dictionaries).
+        """
+
+        try:
+            with open(self.index_path, 'r') as index_file:
+                index = load(index_file)
+            if index.get('version') != CalibrationLibrary.library_version:
+                return []
+            return [entry for entry in index['entries'] if isfile(self.path(entry))]
+        except (OSError, ValueError, KeyError):
+            return []
+
+    def write_index(self):
+        """
+        Write the index of the library. The file is written under a temporary name and renamed,
+        so that an interrupted write does not destroy the index.
+
+        :return: -
+        """
+
+        temporary_path = self.index_path + '.part'
+        with open(temporary_path, 'w') as index_file:
+            dump({'version': CalibrationLibrary.library_version, 'entries': self.entries},
+                 index_file, indent=1)
+        replace(temporary_path, self.index_path)
+
+    @staticmethod
+    def entry_key(kind, sources, parameters):
+        """
+        Compute the key of a master frame from its kind, source and construction parameters.
+
+        :param kind: Either 'dark' or 'flat'.
+        :param sources: Source identity (see "SidecarCache.source_identity").
+        :param parameters: Dictionary with construction parameters (JSON serializable).
+        :return: Hex string with the key.
+        """
+
+        return sha1(dumps([kind, sources, parameters], sort_keys=True).encode('utf-8')
+                    ).hexdigest()[:20]
+
+    def path(self, entry, variant=None):
+        """
+        Compute the file name of a master frame or of one of its variants.
+
+        :param entry: Library entry
+        :param variant: Name of the variant, or None for the master frame itself.
+        :return: Path name of the ".npy" file.
+        """
+
+        if variant is None:
+            return join(self.directory, entry['key'] + '.npy')
+        return join(self.directory, entry['key'] + '.' + variant + '.npy')
+
+    def find(self, kind, names, parameters):
+        """
+        Look up the master frame built from given source file(s) with given parameters.
+
+        :param kind: Either 'dark' or 'flat'.
+        :param names: Name of the video file or master image file, or list of image file names.
+        :param parameters: Dictionary with construction parameters.
+        :return: Library entry, or None if there is no such master frame.
+        """
+
+        key = CalibrationLibrary.entry_key(kind, SidecarCache.source_identity(names), parameters)
+        for entry in self.entries:
+            if entry['key'] == key:
+                return entry
+        return None
+
+    def select(self, kind, color, shape):
+        """
+        Select the master frame of a given kind which matches the frame format of a job. If
+        several masters match, the one stored last is selected.
+
+        :param kind: Either 'dark' or 'flat'.
+        :param color: True, if frames are in color; False otherwise.
+        :param shape: Shape of a single (debayered) frame.
+        :return: Library entry, or None if no master frame matches.
+        """
+
+        matches = [entry for entry in self.entries if entry['kind'] == kind and
+                   entry['color'] == color and tuple(entry['shape']) == tuple(shape)]
+        if not matches:
+            return None
+        return max(matches, key=lambda entry: entry['created'])
+
+    def store(self, kind, names, parameters, master, bayer_pattern=None, shift_pixels=0):
+        """
+        Store a master frame in the library. An existing master with the same key is replaced,
+        together with its variants.
+
+        :param kind: Either 'dark' or 'flat'.
+        :param names: Name of the video file or master image file, or list of image file names.
+        :param parameters: Dictionary with construction parameters.
+        :param master: Master frame
+        :param bayer_pattern: Bayer pattern of the input frames, if known.
+        :param shift_pixels: Number of unused high bits of the input frames.
+        :return: Library entry
+        """
+
+        sources = SidecarCache.source_identity(names)
+        key = CalibrationLibrary.entry_key(kind, sources, parameters)
+        for entry in [entry for entry in self.entries if entry['key'] == key]:
+            self.remove(entry)
+
+        entry = {'key': key, 'kind': kind, 'sources': sources, 'parameters': parameters,
+                 'shape': list(master.shape), 'dtype': str(master.dtype),
+                 'color': len(master.shape) == 3, 'bayer_pattern': bayer_pattern,
+                 'shift_pixels': int(shift_pixels), 'variants': [], 'created': time()}
+        save(self.path(entry), master)
+        self.entries.append(entry)
+        self.write_index()
+        return entry
+
+    def load(self, entry, variant=None):
+        """
+        Read a master frame or one of its variants.
+
+        :param entry: Library entry
+        :param variant: Name of the variant, or None for the master frame itself.
+        :return: Array, or None if the variant has not been stored.
+        """
+
+        if variant is not None and variant not in entry['variants']:
+            return None
+        try:
+            return np_load(self.path(entry, variant))
+        except (OSError, ValueError):
+            return None
+
+    def store_variant(self, entry, variant, data):
+        """
+        Store a derived version of a master frame.
+
+        :param entry: Library entry
+        :param variant: Name of the variant
+        :param data: Array with the variant
+        :return: -
+        """
+
+        save(self.path(entry, variant), data)
+        if variant not in entry['variants']:
+            entry['variants'].append(variant)
+            self.write_index()
+
+    def remove(self, entry):
+        """
+        Remove a master frame and all its variants from the library.
+
+        :param entry: Library entry
+        :return: -
+        """
+
+        for variant in [None] + entry['variants']:
+            if isfile(self.path(entry, variant)):
+                remove(self.path(entry, variant))
+        self.entries.remove(entry)
+        self.write_index()
+
+
+if __name__ == "__main__":
+    from shutil import rmtree
+    from tempfile import mkdtemp
+
+    from numpy import array_equal, float32, uint16
+    from numpy.random import random
+
+    # Self-check: Masters and their variants must be found again after re-opening the library,
+    # by source and parameters as well as by frame format. Storing a master again replaces it.
+    test_dir = mkdtemp()
+    library_dir = join(test_dir, 'library')
+    source_file = join(test_dir, 'darks.ser')
+    with open(source_file, 'wb') as source_fid:
+        source_fid.write(b'0' * 100)
+    master_dark = random((20, 30)).astype(float32)
+    master_flat = random((20, 30, 3)).astype(float32)
+    parameters = {'method': 'median'}
+
+    library = CalibrationLibrary(library_dir)
+    dark_entry = library.store('dark', source_file, parameters, master_dark, shift_pixels=4)
+    library.store('flat', source_file, parameters, master_flat, bayer_pattern='RGB')
+    library.store_variant(dark_entry, 'uint16_shift_4', (master_dark * 16).astype(uint16))
+
+    library = CalibrationLibrary(library_dir)
+    dark_entry = library.find('dark', source_file, parameters)
+    assert dark_entry is not None and dark_entry['shift_pixels'] == 4
+    assert library.find('dark', source_file, {'method': 'mean'}) is None
+    assert array_equal(library.load(dark_entry), master_dark)
+    assert array_equal(library.load(dark_entry, 'uint16_shift_4'),
+                       (master_dark * 16).astype(uint16))
+    assert library.load(dark_entry, 'uint8') is None
+    assert library.select('dark', False, (20, 30))['key'] == dark_entry['key']
+    assert library.select('dark', True, (20, 30, 3)) is None
+    assert array_equal(library.load(library.select('flat', True, (20, 30, 3))), master_flat)
+
+    dark_entry = library.store('dark', source_file, parameters, 2. * master_dark)
+    assert len(library.entries) == 2 and dark_entry['variants'] == []
+    assert array_equal(CalibrationLibrary(library_dir).load(dark_entry), 2. * master_dark)
+    rmtree(test_dir)
+    print("Calibration library self-check passed")
@@ -23,6 +23,7 @@ along with PSS.  If not, see <http://www.gnu.org/licenses/>.
 import sys
 from configparser import ConfigParser
 from copy import deepcopy
+from os import cpu_count
 from os.path import expanduser, join, isfile, dirname
 from os.path import splitext
 
@@ -218,6 +219,43 @@ class Configuration(object):
         self.frames_color_difference_threshold = 0
         self.frames_bayer_max_noise_diff_green = 2.
         self.frames_bayer_min_distance_from_blue = 99.5
+        self.frames_ser_memory_mapped = False
+        self.frames_ser_block_frames = 16
+        self.frames_prefetching = False
+        self.frames_prefetch_queue_size = 8
+        self.frames_image_decoding_threads = min(cpu_count() or 1, 8)
+        self.frames_image_decoding_window = 16
+        self.frames_video_decoding_handles = 1
+        self.frames_video_segment_length = 32
+        self.frames_video_seek_threshold = 16
+        self.frames_video_transcode = False
+        self.frames_sidecar_cache = False
+        self.frames_cache_budget_mbytes = 0
+        self.frames_buffer_planner = False
+        self.frames_planner_probe_frames = 5
+        self.frames_planner_time_tolerance = 0.02
+        self.frames_raw_cfa_buffering = False
+        self.frames_spill_directory = ''
+        self.frames_arena_buffers = False
+        self.frames_roi_window = False
+        self.frames_roi_window_margin = 16
+        self.frames_auto_crop = False
+        self.frames_auto_crop_sample_frames = 10
+        self.frames_auto_crop_max_fraction = 0.8
+        self.frames_buffer_compression = ''
+        self.frames_buffer_compression_level = 1
+        self.frames_gaussian_8bit = False
+        self.frames_master_method = 'mean'
+        self.frames_master_sigma = 3.
+        self.frames_master_clip_iterations = 5
+        self.frames_master_chunk_frames = 16
+        self.frames_master_tile_mbytes = 64
+        self.frames_master_threads = min(cpu_count() or 1, 4)
+        self.frames_calibration_library = ''
+        self.frames_calibration_raw = False
+        self.frames_hot_pixel_correction = False
+        self.frames_hot_pixel_sigma = 8.
+        self.frames_hot_pixel_min_delta = 1024
 
         self.rank_frames_pixel_stride = 2
         self.rank_frames_method = "Laplace"
@@ -0,0 +1,514 @@
+# -*- coding: utf-8; -*-
+"""
+Copyright (c) 2018 Rolf Hempel, rolf6419@gmx.de
+
+This file is part of the PlanetarySystemStacker tool (PSS).
+https://github.com/Rolf-Hempel/PlanetarySystemStacker
+
+PSS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PSS.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import lzma
+import zlib
+from abc import ABC, abstractmethod
+from tempfile import TemporaryFile
+
+from numpy import memmap, zeros, empty, frombuffer, subtract, ascontiguousarray, dtype as np_dtype
+
+from exceptions import ArgumentError
+
+
+class FrameBuffer(ABC):
+    """
+    Abstract base class for buffers which replace a Python list of per-frame arrays. Buffers are
+    indexed with the (original) frame index, and entries which have not been set are returned as
+    None.
+
+    """
+
+    def __init__(self, number, frame_shape, dtype):
+        """
+        Initialize the buffer attributes.
+
+        :param number: Number of frames
+        :param frame_shape: Shape of a single frame
+        :param dtype: Numpy dtype of the frames
+        """
+
+        self.number = number
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = np_dtype(dtype)
+
+    def __len__(self):
+        return self.number
+
+    @abstractmethod
+    def __getitem__(self, index):
+        """
+        Look up the frame with a given index.
+
+        :param index: Frame index
+        :return: Frame, or None if the frame has not been stored.
+        """
+
+    @abstractmethod
+    def __setitem__(self, index, frame):
+        """
+        Store a frame at a given index. Storing None removes the entry.
+
+        :param index: Frame index
+        :param frame: Frame to be stored, or None
+        :return: -
+        """
+
+    def stored(self, index):
+        """
+        Check if a frame is stored at a given index, without looking up (e.g. decompressing) the
+        frame itself.
+
+        :param index: Frame index
+        :return: True, if the frame is stored. False otherwise.
+        """
+
+        return self[index] is not None
+
+    def check_shape(self, frame):
+        """
+        Check if a frame fits into the buffer.
+
+        :param frame: Frame to be stored
+        :return: -
+        """
+
+        if frame.shape != self.frame_shape:
+            raise ArgumentError("Frame with shape " + str(frame.shape) +
+                                " does not fit into frame buffer with frame shape " +
+                                str(self.frame_shape))
+
+    @abstractmethod
+    def release(self):
+        """
+        Free the memory of all frames.
+
+        :return: -
+        """
+
+
+def frame_stored(buffer, index):
+    """
+    Check if a frame is stored at a given index of a frame buffer or a Python list of frames.
+
+    :param buffer: FrameBuffer object, or list with frames and None entries
+    :param index: Frame index
+    :return: True, if the frame is stored. False otherwise.
+    """
+
+    if isinstance(buffer, FrameBuffer):
+        return buffer.stored(index)
+    return buffer[index] is not None
+
+
+class FrameArena(FrameBuffer):
+    """
+    Frame buffer with one contiguous, pre-allocated array of shape (N, H, W) (or (N, H, W, 3) for
+    color frames) for all frames of a variant, plus a validity bitmap. It replaces a Python list
+    of independently allocated per-frame arrays (e.g. "Frames.frames_monochrome_blurred"). Like the
+    list, it is indexed with the (original) frame index, and entries which have not been set are
+    returned as None.
+
+    The array is allocated with "numpy.zeros", so the operating system commits memory pages only
+    when frames are written to them. When a workflow phase does not need the variant any more, the
+    whole arena is returned to the OS in one piece with "release".
+
+    """
+
+    def __init__(self, number, frame_shape, dtype):
+        """
+        Allocate the arena.
+
+        :param number: Number of frames
+        :param frame_shape: Shape of a single frame
+        :param dtype: Numpy dtype of the frames
+        """
+
+        super(FrameArena, self).__init__(number, frame_shape, dtype)
+        self.data = self.allocate()
+        self.valid = zeros(number, dtype=bool)
+
+    def allocate(self):
+        """
+        Allocate the array for all frames.
+
+        :return: Array of shape (number,) + frame_shape
+        """
+
+        return zeros((self.number,) + self.frame_shape, dtype=self.dtype)
+
+    def __getitem__(self, index):
+        """
+        Look up the frame with a given index.
+
+        :param index: Frame index
+        :return: View of the frame in the arena, or None if the frame has not been stored.
+        """
+
+        if self.valid[index]:
+            return self.data[index]
+        return None
+
+    def stored(self, index):
+        """
+        Check if a frame is stored at a given index.
+
+        :param index: Frame index
+        :return: True, if the frame is stored. False otherwise.
+        """
+
+        return bool(self.valid[index])
+
+    def __setitem__(self, index, frame):
+        """
+        Store a frame at a given index. Storing None invalidates the entry.
+
+        :param index: Frame index
+        :param frame: Frame to be stored, or None
+        :return: -
+        """
+
+        if frame is None:
+            self.valid[index] = False
+            return
+        self.check_released()
+        self.check_shape(frame)
+        self.data[index] = frame
+        self.valid[index] = True
+
+    def valid_indices(self):
+        """
+        List the indices of all frames stored in the arena.
+
+        :return: Array with frame indices
+        """
+
+        return self.valid.nonzero()[0]
+
+    def frames(self, indices):
+        """
+        Look up several frames at once, e.g. for vectorized reductions over frames.
+
+        :param indices: Sequence of frame indices, or a slice
+        :return: Array of shape (len(indices),) + frame_shape. For a slice it is a view into the
+                 arena, otherwise a copy.
+        """
+
+        self.check_released()
+        if not self.valid[indices].all():
+            raise ArgumentError("Frames requested which are not stored in the frame buffer")
+        return self.data[indices]
+
+    def check_released(self):
+        """
+        Check that the arena has not been released. A released arena cannot store frames any more,
+        a new buffer must be created instead.
+
+        :return: -
+        """
+
+        if self.data is None:
+            raise ArgumentError("Frame buffer has been released")
+
+    def release(self):
+        """
+        Free the memory of all frames.
+
+        :return: -
+        """
+
+        self.valid[:] = False
+        self.data = None
+
+
+class SpillBuffer(FrameArena):
+    """
+    Frame arena backed by a pre-allocated memory-mapped scratch file. It is used if the buffered
+    frames do not fit into RAM. Frames are returned as views into the memory map, so access stays
+    array slicing; the operating system pages data in and out as needed.
+
+    The scratch file is deleted automatically when the buffer is released or garbage collected.
+
+    """
+
+    def __init__(self, directory, number, frame_shape, dtype):
+        """
+        Create the scratch file and map it into memory.
+
+        :param directory: Directory where the scratch file is created (should be on a fast local
+                          disk).
+        :param number: Number of frames
+        :param frame_shape: Shape of a single frame
+        :param dtype: Numpy dtype of the frames
+        """
+
+        # On POSIX systems the temporary file is unlinked at once, so it vanishes even if the
+        # program is terminated abnormally.
+        self.file = TemporaryFile(dir=directory, prefix='pss_spill_')
+        super(SpillBuffer, self).__init__(number, frame_shape, dtype)
+
+    def allocate(self):
+        """
+        Map the scratch file into memory.
+
+        :return: Memory map of shape (number,) + frame_shape
+        """
+
+        return memmap(self.file, dtype=self.dtype, mode='w+', shape=(self.number,) +
+                      self.frame_shape)
+
+    def release(self):
+        """
+        Release the memory map and delete the scratch file.
+
+        :return: -
+        """
+
+        super(SpillBuffer, self).release()
+        self.file.close()
+
+
+class CompressedFrameBuffer(FrameBuffer):
+    """
+    Frame buffer which keeps frames losslessly compressed in RAM. Planetary frames are mostly
+    black sky, so they compress very well. Frames are decompressed on every access.
+
+    Codecs:
+        'zlib': zlib compression of the raw pixel data.
+        'delta-zlib': Each row is replaced with its difference to the previous row (modulo the
+                      integer range) before zlib compression. This improves compression of smooth
+                      image content.
+        'lzma': lzma compression (better ratio, but much slower).
+
+    """
+
+    codecs = ['zlib', 'delta-zlib', 'lzma']
+
+    def __init__(self, number, frame_shape, dtype, codec='delta-zlib', level=1):
+        """
+        Create an empty buffer.
+
+        :param number: Number of frames
+        :param frame_shape: Shape of a single frame
+        :param dtype: Numpy dtype of the frames (unsigned integer type)
+        :param codec: One out of 'zlib', 'delta-zlib', 'lzma'.
+        :param level: Compression level (zlib: 0 - 9, lzma preset: 0 - 9).
+        """
+
+        if codec not in CompressedFrameBuffer.codecs:
+            raise ArgumentError("Frame buffer compression codec " + str(codec) +
+                                " not supported")
+        super(CompressedFrameBuffer, self).__init__(number, frame_shape, dtype)
+        self.codec = codec
+        self.level = level
+        self.data = [None] * number
+
+        # Scratch buffer for the row differences, re-used for all frames.
+        self.scratch = None
+
+        # Sizes of all frames currently stored, uncompressed and compressed.
+        self.bytes_uncompressed = 0
+        self.bytes_compressed = 0
+
+    def __getitem__(self, index):
+        """
+        Look up the frame with a given index.
+
+        :param index: Frame index
+        :return: Decompressed frame, or None if the frame has not been stored.
+        """
+
+        compressed = self.data[index]
+        if compressed is None:
+            return None
+        if self.codec == 'lzma':
+            raw = lzma.decompress(compressed)
+        else:
+            raw = zlib.decompress(compressed)
+        frame = frombuffer(raw, dtype=self.dtype).reshape(self.frame_shape)
+
+        # Undo the row differences. The cumulative sum wraps around like the differences did.
+        if self.codec == 'delta-zlib':
+            frame = frame.cumsum(axis=0, dtype=self.dtype)
+        return frame
+
+    def stored(self, index):
+        """
+        Check if a frame is stored at a given index, without decompressing it.
+
+        :param index: Frame index
+        :return: True, if the frame is stored. False otherwise.
+        """
+
+        return self.data[index] is not None
+
+    def __setitem__(self, index, frame):
+        """
+        Compress and store a frame at a given index. Storing None removes the entry.
+
+        :param index: Frame index
+        :param frame: Frame to be stored, or None
+        :return: -
+        """
+
+        self.remove(index)
+        if frame is None:
+            return
+        self.check_shape(frame)
+
+        if self.codec == 'delta-zlib':
+            if self.scratch is None:
+                self.scratch = empty(self.frame_shape, dtype=self.dtype)
+            self.scratch[0] = frame[0]
+            subtract(frame[1:], frame[:-1], out=self.scratch[1:], dtype=self.dtype,
+                     casting='unsafe')
+            source = self.scratch
+        else:
+            source = ascontiguousarray(frame, dtype=self.dtype)
+
+        if self.codec == 'lzma':
+            compressed = lzma.compress(source, preset=self.level)
+        else:
+            compressed = zlib.compress(source, self.level)
+
+        self.data[index] = compressed
+        self.bytes_uncompressed += source.nbytes
+        self.bytes_compressed += len(compressed)
+
+    def remove(self, index):
+        """
+        Remove the frame with a given index, if it is stored.
+
+        :param index: Frame index
+        :return: -
+        """
+
+        compressed = self.data[index]
+        if compressed is not None:
+            self.bytes_uncompressed -= self.frame_bytes()
+            self.bytes_compressed -= len(compressed)
+            self.data[index] = None
+
+    def frame_bytes(self):
+        """
+        Compute the size of an uncompressed frame.
+
+        :return: Size in bytes
+        """
+
+        size = self.dtype.itemsize
+        for extent in self.frame_shape:
+            size *= extent
+        return size
+
+    def compression_ratio(self):
+        """
+        Compute the compression ratio achieved for the frames stored.
+
+        :return: Ratio of uncompressed to compressed size, or None if no frame is stored.
+        """
+
+        if not self.bytes_compressed:
+            return None
+        return float(self.bytes_uncompressed) / self.bytes_compressed
+
+    def statistics(self):
+        """
+        Create a one-line summary of the buffer contents.
+
+        :return: String with the number of frames, their compressed size and the ratio.
+        """
+
+        frames_stored = sum(1 for compressed in self.data if compressed is not None)
+        ratio = self.compression_ratio()
+        return str(frames_stored) + " frames, " + \
+               str(round(self.bytes_compressed / 1e6, 1)) + " MB (" + self.codec + \
+               ", compression ratio " + (str(round(ratio, 2)) if ratio else "-") + ")"
+
+    def release(self):
+        """
+        Free the memory of all frames.
+
+        :return: -
+        """
+
+        self.data = [None] * self.number
+        self.scratch = None
+        self.bytes_uncompressed = 0
+        self.bytes_compressed = 0
+
+
+if __name__ == "__main__":
+    from os import listdir
+    from shutil import rmtree
+    from tempfile import mkdtemp
+
+    from numpy import arange, array_equal, newaxis, uint8, uint16
+    from numpy.random import randint
+
+    # Self-check: Frames stored in frame arenas and spill buffers must be returned unchanged, and
+    # entries not stored must be returned as None. A released buffer must reject new frames, and
+    # releasing a spill buffer must delete its scratch file.
+    test_dir = mkdtemp()
+    test_frames = randint(0, 65536, (5, 40, 60, 3)).astype(uint16)
+    for buffer in [FrameArena(5, (40, 60, 3), uint16),
+                   SpillBuffer(test_dir, 5, (40, 60, 3), uint16)]:
+        for index in [0, 2, 3]:
+            buffer[index] = test_frames[index]
+        assert buffer[1] is None and buffer[4] is None
+        assert frame_stored(buffer, 2) and not frame_stored(buffer, 4)
+        assert list(buffer.valid_indices()) == [0, 2, 3]
+        assert array_equal(buffer[2], test_frames[2])
+        assert array_equal(buffer.frames([0, 3]), test_frames[[0, 3]])
+        buffer[2] = None
+        assert buffer[2] is None
+        buffer.release()
+        assert buffer[0] is None
+        try:
+            buffer[0] = test_frames[0]
+            raise AssertionError("A released buffer accepted a frame")
+        except ArgumentError:
+            pass
+    assert buffer.file.closed and not listdir(test_dir)
+    rmtree(test_dir)
+    print("Frame arena / spill buffer self-check passed")
+
+    # Self-check: All codecs of the compressed buffer must be lossless, including row differences
+    # which wrap around the integer range (random data) and a mostly black frame which compresses
+    # well.
+    smooth_frame = zeros((40, 60, 3), dtype=uint16)
+    smooth_frame[10:30, 20:40] = arange(20, dtype=uint16)[:, newaxis, newaxis] * 1000
+    for codec in CompressedFrameBuffer.codecs:
+        for dtype, test_frame in [(uint16, test_frames[0]), (uint16, smooth_frame),
+                                  (uint8, (test_frames[1] >> 8).astype(uint8))]:
+            buffer = CompressedFrameBuffer(3, (40, 60, 3), dtype, codec=codec)
+            buffer[1] = test_frame
+            assert buffer[0] is None
+            assert buffer.stored(1) and not buffer.stored(0)
+            assert buffer[1].dtype == dtype and array_equal(buffer[1], test_frame)
+            buffer[1] = test_frame[::-1]
+            assert array_equal(buffer[1], test_frame[::-1])
+            if test_frame is smooth_frame:
+                assert buffer.compression_ratio() > 1.
+            buffer[1] = None
+            assert buffer.bytes_compressed == 0 and buffer.bytes_uncompressed == 0
+    print("Compressed frame buffer self-check passed")
@@ -20,11 +20,17 @@ along with PSS.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
+from bisect import bisect_right
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
+from hashlib import sha1
 from math import ceil
 from os import path, remove, listdir, stat
 from os.path import splitext
 from pathlib import Path
+from queue import Queue, Full, Empty
+from threading import Thread, Event, Lock
 from time import time
 
 from PyQt5 import QtCore
@@ -34,19 +40,29 @@ from cv2 import imread, VideoCapture, CAP_PROP_FRAME_COUNT, cvtColor, COLOR_RGB2
     GaussianBlur, Laplacian, CV_32F, COLOR_RGB2BGR, imwrite, convertScaleAbs, CAP_PROP_POS_FRAMES, \
     IMREAD_UNCHANGED, flip, COLOR_GRAY2RGB, COLOR_BayerRG2BGR, COLOR_BayerGR2BGR, \
     COLOR_BayerRG2BGR_VNG, COLOR_BayerGR2BGR_VNG, COLOR_BayerGB2BGR_VNG, COLOR_BayerBG2BGR_VNG, \
-    COLOR_BayerRG2BGR_EA, COLOR_BayerGR2BGR_EA, COLOR_BayerGB2BGR_EA, COLOR_BayerBG2BGR_EA
-from cv2 import mean as cv_mean
+    COLOR_BayerRG2BGR_EA, COLOR_BayerGR2BGR_EA, COLOR_BayerGB2BGR_EA, COLOR_BayerBG2BGR_EA, \
+    COLOR_BayerRG2GRAY, COLOR_BayerGR2GRAY, COLOR_BayerGB2GRAY, COLOR_BayerBG2GRAY
+from cv2 import mean as cv_mean, subtract as cv_subtract, multiply as cv_multiply, CV_8U, CV_16U, \
+    medianBlur
+from numpy import dtype as np_dtype
 from numpy import max as np_max
 from numpy import min as np_min
 from numpy import sum as np_sum
+from numpy import median as np_median
 from numpy import uint8, uint16, int32, float32, clip, zeros, float64, where, average, moveaxis, \
-    unravel_index, ndarray
+    unravel_index, ndarray, empty, array, absolute, ascontiguousarray, may_share_memory
 
 import ser_parser
 from configuration import Configuration
 from exceptions import TypeError, ShapeError, ArgumentError, WrongOrderingError, Error, \
     InternalError
+from frame_buffers import FrameBuffer, FrameArena, SpillBuffer, CompressedFrameBuffer, \
+    frame_stored
 from frames_old import FramesOld
+from master_frames import MasterFrameBuilder
+from calibration_library import CalibrationLibrary
+from sidecar_cache import SidecarCache
+from video_transcoder import TranscodedVideo
 
 
 def debayer_frame(frame_in, debayer_pattern='No change', debayer_method='Bilinear', BGR_input=False):
@@ -386,6 +402,12 @@ class VideoReader(object):
         self.bayer_pattern = None
         self.BGR_input = None
         self.warn_message = None
+        self.debayer = True
+        self.file_path = None
+        self.cap = None
+        self.transcoded = None
+        self.window = None
+        self.calibration = None
 
     def sanity_check(self, file_path):
         """
@@ -425,15 +447,30 @@ class VideoReader(object):
 
         # Do sanity check
         self.sanity_check(file_path)
+        self.file_path = file_path
+
+        # Frames are debayered and not cropped unless requested after opening.
+        self.debayer = True
+        self.window = None
 
         # Check, if file has SER extension
         self.SERFile = path.splitext(file_path)[1].lower() == '.ser'
 
+        # If transcoding is active, check if a transcoded copy of the video exists from a
+        # previous run.
+        self.transcoded = None
+        if not self.SERFile and self.configuration.frames_video_transcode:
+            transcoded = TranscodedVideo(file_path)
+            if transcoded.open():
+                self.transcoded = transcoded
+
         # Check if input file is SER file
         if self.SERFile:
             try:
-                # Create the VideoCapture object.
-                self.cap = ser_parser.SERParser(file_path, SER_16bit_shift_correction)
+                # Create the VideoCapture object. If requested, map the frame data into memory, so
+                # that frames can be accessed at random without seek and copy operations.
+                self.cap = ser_parser.SERParser(file_path, SER_16bit_shift_correction,
+                                memory_mapped=self.configuration.frames_ser_memory_mapped)
                 self.shift_pixels = self.cap.shift_pixels
                 self.warn_message = self.cap.warn_message
 
@@ -453,6 +490,24 @@ class VideoReader(object):
                     self.bayer_pattern = bayer_option_selected
             except:
                 raise IOError("Error in reading first video frame")
+
+        # A transcoded copy of the video is available. Read the frames from there, the video file
+        # is not opened.
+        elif self.transcoded is not None:
+            self.cap = None
+            self.last_frame_read = self.transcoded.data[0]
+            self.frame_count = self.transcoded.frame_count
+            self.color_in = (len(self.last_frame_read.shape) == 3)
+            self.BGR_input = True
+            self.dtype = self.last_frame_read.dtype
+            if bayer_option_selected == 'Auto detect color':
+                if self.transcoded.bayer_pattern is not None:
+                    self.bayer_pattern = self.transcoded.bayer_pattern
+                else:
+                    self.bayer_pattern = self.detect_bayer_pattern(self.last_frame_read)
+            else:
+                self.bayer_pattern = bayer_option_selected
+
         else:
             try:
                 # Create the VideoCapture object.
@@ -473,38 +528,7 @@ class VideoReader(object):
 
                 # Set the bayer pattern.
                 if bayer_option_selected == 'Auto detect color':
-                    # Look for a Bayer pattern in the 2D or 3D data.
-                    bayer_pattern_computed = detect_bayer(self.last_frame_read,
-                            self.configuration.frames_bayer_max_noise_diff_green,
-                            self.configuration.frames_bayer_min_distance_from_blue,
-                            self.configuration.frames_color_difference_threshold)
-                    # If the image was classified as 'Color', test the ordering of color channels.
-                    if bayer_pattern_computed == 'Color':
-                        # Analyze first frame to detect ordering of color channels. Note that the
-                        # frame was read by OpenCV in BGR mode. Channels will be swapt later.
-                        rgb_order = detect_rgb_bgr(self.last_frame_read)
-                        if rgb_order == 'BGR':
-                            self.bayer_pattern = 'RGB'
-                            # print("Color channel ordering 'RGB' detected")
-                        elif rgb_order == 'RGB':
-                            self.bayer_pattern = 'BGR'
-                            # print("Color channel ordering  'BGR' detected")
-                        else:
-                            self.bayer_pattern = 'RGB'
-                            # print("No color channel ordering  detected, apply 'RGB'")
-                    elif bayer_pattern_computed == 'Grayscale':
-                        self.bayer_pattern = 'Grayscale'
-                        # print("Image has been found to be grayscale")
-                    elif bayer_pattern_computed == 'None':
-                        if self.color_in:
-                            self.bayer_pattern = 'RGB'
-                            # print("No Bayer pattern detected, apply 'RGB' because 3D")
-                        else:
-                            self.bayer_pattern = 'Grayscale'
-                            # print("No Bayer pattern detected, apply 'Grayscale' because 2D")
-                    else:
-                        self.bayer_pattern = bayer_pattern_computed
-                        # print("Bayer pattern " + bayer_pattern_computed + " detected")
+                    self.bayer_pattern = self.detect_bayer_pattern(self.last_frame_read)
 
                 # The user has selected a debayering mode explicitly.
                 else:
@@ -514,11 +538,28 @@ class VideoReader(object):
                 raise IOError("Error in reading first video frame. Try to convert the video with "
                               "PIPP into some standard format")
 
+            # On first use, transcode the video into an uncompressed container which can be
+            # memory-mapped. Subsequent passes and runs read the frames from there. If this fails
+            # (e.g. because the disk is full), continue with reading the video.
+            if self.configuration.frames_video_transcode:
+                transcoded = TranscodedVideo(file_path)
+                if bayer_option_selected == 'Auto detect color':
+                    bayer_pattern_detected = self.bayer_pattern
+                else:
+                    bayer_pattern_detected = None
+                if transcoded.create(self.cap, self.last_frame_read, self.frame_count,
+                                     bayer_pattern_detected):
+                    self.cap.release()
+                    self.cap = None
+                    self.transcoded = transcoded
+                    self.frame_count = transcoded.frame_count
+
         # Assign "last_read"
         self.last_read = 0
 
-        # Convert the first frame read into the desired output format and set the metadata.
-        self.last_frame_read = debayer_frame(self.last_frame_read,
+        # Convert the first frame read into the desired output format and set the metadata. If
+        # raw CFA calibration is active, it is applied before debayering.
+        self.last_frame_read = debayer_frame(self.calibrate(self.cfa_plane(self.last_frame_read)),
                                              debayer_pattern=self.bayer_pattern,
                                              debayer_method=self.configuration.frames_debayering_method,
                                              BGR_input=self.BGR_input)
@@ -528,6 +569,48 @@ class VideoReader(object):
         # Return the metadata.
         return self.frame_count, self.color, self.dtype, self.shape, self.shift_pixels
 
+    def detect_bayer_pattern(self, frame):
+        """
+        Detect the Bayer pattern or color channel ordering of a frame read by OpenCV.
+
+        :param frame: First frame of the video, as read by OpenCV.
+        :return: Bayer pattern, one out of: "Grayscale", "RGB", "BGR", "Force Bayer RGGB",
+                 "Force Bayer GRBG", "Force Bayer GBRG", "Force Bayer BGGR".
+        """
+
+        # Look for a Bayer pattern in the 2D or 3D data.
+        bayer_pattern_computed = detect_bayer(frame,
+                self.configuration.frames_bayer_max_noise_diff_green,
+                self.configuration.frames_bayer_min_distance_from_blue,
+                self.configuration.frames_color_difference_threshold)
+        # If the image was classified as 'Color', test the ordering of color channels.
+        if bayer_pattern_computed == 'Color':
+            # Analyze first frame to detect ordering of color channels. Note that the
+            # frame was read by OpenCV in BGR mode. Channels will be swapt later.
+            rgb_order = detect_rgb_bgr(frame)
+            if rgb_order == 'BGR':
+                # print("Color channel ordering 'RGB' detected")
+                return 'RGB'
+            elif rgb_order == 'RGB':
+                # print("Color channel ordering  'BGR' detected")
+                return 'BGR'
+            else:
+                # print("No color channel ordering  detected, apply 'RGB'")
+                return 'RGB'
+        elif bayer_pattern_computed == 'Grayscale':
+            # print("Image has been found to be grayscale")
+            return 'Grayscale'
+        elif bayer_pattern_computed == 'None':
+            if len(frame.shape) == 3:
+                # print("No Bayer pattern detected, apply 'RGB' because 3D")
+                return 'RGB'
+            else:
+                # print("No Bayer pattern detected, apply 'Grayscale' because 2D")
+                return 'Grayscale'
+        else:
+            # print("Bayer pattern " + bayer_pattern_computed + " detected")
+            return bayer_pattern_computed
+
     def read_frame(self, index=None):
         """
         Read a single frame from the video.
@@ -547,18 +630,24 @@ class VideoReader(object):
             return self.last_frame_read
         else:
             # If it is the next frame after the one read last time, for AVI videos the frame pointer
-            # does not have to be set. The read_frame method of the "ser_parser" module always does
-            # a seek operation.
-            if not self.SERFile and index != self.last_read + 1:
-                self.cap.set(CAP_PROP_POS_FRAMES, index)
+            # does not have to be set. The read_frame method of the "ser_parser" module does a seek
+            # operation if necessary (or none at all if the SER file is memory-mapped).
+            if not self.SERFile and self.transcoded is None:
+                self.position_capture(self.cap, self.last_read + 1, index)
             self.last_read = index
 
         # A new frame has to be read. First check if the index is not out of bounds.
         if 0 <= self.last_read < self.frame_count:
             try:
                 # Read the next frame.
-                if self.SERFile:
+                if self.SERFile and self.window is not None:
+                    # Only read the rows inside the window.
+                    self.last_frame_read = self.cap.read_frame_rows(self.last_read, self.window[0],
+                                                                    self.window[1])
+                elif self.SERFile:
                     self.last_frame_read = self.cap.read_frame_raw(self.last_read)
+                elif self.transcoded is not None:
+                    self.last_frame_read = self.transcoded.data[self.last_read]
                 else:
                     ret, self.last_frame_read = self.cap.read()
                     if not ret:
@@ -570,14 +659,324 @@ class VideoReader(object):
         else:
             raise ArgumentError("Error in reading video frame, index {0} is out of bounds".format(index))
 
-        # Convert the frame read into the desired output format.
-        self.last_frame_read = debayer_frame(self.last_frame_read,
-                                             debayer_pattern=self.bayer_pattern,
-                                             debayer_method=self.configuration.frames_debayering_method,
-                                             BGR_input=self.BGR_input)
+        # If a window is set, crop the frame before debayering. Raw CFA calibration is applied to
+        # the cropped frame.
+        self.last_frame_read = self.calibrate(self.cfa_plane(self.crop(self.last_frame_read)))
+
+        # Convert the frame read into the desired output format, unless raw CFA frames are
+        # requested.
+        if self.debayer:
+            self.last_frame_read = debayer_frame(self.last_frame_read,
+                                                 debayer_pattern=self.bayer_pattern,
+                                                 debayer_method=self.configuration.frames_debayering_method,
+                                                 BGR_input=self.BGR_input)
 
         return self.last_frame_read
 
+    def raw_cfa_available(self):
+        """
+        Check if the video contains Bayer-encoded (CFA) frames which are debayered into color
+        frames. SER files flag such videos as color, and OpenCV may return them as three-channel
+        frames. In both cases the raw frames are single-plane frames (see "cfa_plane").
+
+        :return: True, if raw CFA frames can be read. False otherwise.
+        """
+
+        return self.bayer_pattern in ['Force Bayer RGGB', 'Force Bayer GRBG', 'Force Bayer GBRG',
+                                      'Force Bayer BGGR']
+
+    def cfa_plane(self, frame):
+        """
+        For Bayer-encoded videos, reduce a three-channel frame as read by OpenCV to the single CFA
+        plane. This is the same conversion "debayer_frame" applies before debayering, so the
+        result of debayering is not changed. Other frames are returned unchanged.
+
+        :param frame: Frame as read from the file
+        :return: Single-plane CFA frame, or the unchanged frame
+        """
+
+        if len(frame.shape) == 3 and self.raw_cfa_available():
+            return cvtColor(frame, COLOR_RGB2GRAY)
+        return frame
+
+    def set_raw_output(self, raw):
+        """
+        Switch between debayered output (default) and raw CFA output of read operations.
+
+        :param raw: If True, frames are returned as read from the video, without debayering.
+        :return: -
+        """
+
+        if raw == (not self.debayer):
+            return
+
+        self.debayer = not raw
+
+        # The frame read last was converted in the previous mode.
+        self.reset_position()
+
+    def set_window(self, window):
+        """
+        Restrict the output of read operations to a window of the frames. The window is cut out
+        before debayering. For SER files only the rows inside the window are read.
+
+        :param window: Tuple (y_low, y_high, x_low, x_high), or None for full frames. For Bayer
+                       input the lower bounds must be even.
+        :return: -
+        """
+
+        if window == self.window:
+            return
+        self.window = window
+
+        # The frame read last was cropped differently.
+        self.reset_position()
+
+    def crop(self, frame):
+        """
+        Cut the window out of a frame as read from the file. Rows may have been restricted by the
+        read operation already.
+
+        :param frame: Frame as read from the file (before debayering)
+        :return: Frame restricted to the window
+        """
+
+        if self.window is None:
+            return frame
+        y_low, y_high, x_low, x_high = self.window
+        if frame.shape[0] != y_high - y_low:
+            frame = frame[y_low:y_high]
+        return frame[:, x_low:x_high]
+
+    def set_calibration(self, calibration):
+        """
+        Calibrate frames on the raw CFA data, i.e. before debayering. The master frames of the
+        calibration object must be single-plane frames with the shape of the raw frames.
+
+        :param calibration: Calibration object, or None to switch off raw CFA calibration.
+        :return: -
+        """
+
+        if calibration is self.calibration:
+            return
+        self.calibration = calibration
+
+        # The frame read last was calibrated differently.
+        self.reset_position()
+
+    def calibrate(self, frame):
+        """
+        Apply the raw CFA calibration (if active) to a frame as read from the file and cropped to
+        the window. This method does not change the state of the reader, so it can be executed in
+        parallel threads.
+
+        :param frame: Frame as read from the file (before debayering)
+        :return: Calibrated frame
+        """
+
+        if self.calibration is None:
+            return frame
+        return self.calibration.correct(frame, window=self.window)
+
+    def reset_position(self):
+        """
+        Forget the frame read last, and position the reader before the first frame.
+
+        :return: -
+        """
+
+        self.last_read = -1
+        self.last_frame_read = None
+        if not self.SERFile and self.transcoded is None:
+            self.cap.set(CAP_PROP_POS_FRAMES, 0)
+
+    def position_capture(self, capture, position, index):
+        """
+        Position an OpenCV capture object such that the next read operation returns a given frame.
+        Setting the frame pointer makes OpenCV decode from the preceding keyframe. Therefore, if
+        the frame is only a few frames ahead, the frames in between are skipped with "grab"
+        operations instead.
+
+        :param capture: OpenCV VideoCapture object
+        :param position: Index of the frame the next read operation would return
+        :param index: Index of the frame to be read next
+        :return: -
+        """
+
+        if index == position:
+            return
+        if position < index <= position + self.configuration.frames_video_seek_threshold:
+            for skip in range(index - position):
+                capture.grab()
+        else:
+            capture.set(CAP_PROP_POS_FRAMES, index)
+
+    def read_frames(self, index_sequence):
+        """
+        Read a sequence of frames. SER files which are not memory-mapped are read in blocks of
+        consecutive frames, unless a window is set (then only the rows inside the window are read
+        frame by frame). For non-SER videos (unless a transcoded copy is read), the sequence is
+        cut into segments of consecutive positions which are decoded in parallel, each worker
+        thread using its own capture handle on the video file.
+
+        :param index_sequence: Sequence of frame indices.
+        :return: Generator which yields the frames in the order of "index_sequence".
+        """
+
+        index_sequence = list(index_sequence)
+        handles = self.configuration.frames_video_decoding_handles
+        segment_length = self.configuration.frames_video_segment_length
+
+        if self.SERFile and self.cap.frames_mapped is None and self.window is None:
+            yield from self.read_frames_blocked(index_sequence)
+        elif self.SERFile or self.transcoded is not None or handles < 2 or \
+                len(index_sequence) <= segment_length:
+            for index in index_sequence:
+                yield self.read_frame(index)
+        else:
+            yield from self.read_frames_segmented(index_sequence, handles, segment_length)
+
+    def read_frames_blocked(self, index_sequence):
+        """
+        Read a sequence of frames from a SER file which is not memory-mapped. Runs of consecutive
+        frame indices are read in blocks of up to "frames_ser_block_frames" frames with a single
+        read operation each.
+
+        :param index_sequence: List of frame indices.
+        :return: Generator which yields the frames in the order of "index_sequence".
+        """
+
+        block_frames = self.configuration.frames_ser_block_frames
+
+        # All blocks are read into the same buffer. Frames which are still views into the buffer
+        # after calibration and debayering are copied out. Otherwise each frame kept by the caller
+        # (in a frame buffer or cache) would keep the whole buffer alive, and the next block would
+        # overwrite it.
+        block = empty((block_frames,) + self.cap.frame_shape(), dtype=self.cap.PixelDepthPerPlane)
+        position = 0
+        while position < len(index_sequence):
+            start = index_sequence[position]
+            count = 1
+            while count < block_frames and position + count < len(index_sequence) and \
+                    index_sequence[position + count] == start + count:
+                count += 1
+
+            for offset, frame in enumerate(self.cap.read_frames(start, count, out=block)):
+                frame = self.calibrate(self.cfa_plane(frame))
+                if self.debayer:
+                    frame = debayer_frame(frame, debayer_pattern=self.bayer_pattern,
+                                          debayer_method=self.configuration.frames_debayering_method,
+                                          BGR_input=self.BGR_input)
+                if may_share_memory(frame, block):
+                    frame = frame.copy()
+                self.last_read = start + offset
+                self.last_frame_read = frame
+                yield frame
+            position += count
+
+    def read_frames_segmented(self, index_sequence, handles, segment_length):
+        """
+        Decode a sequence of frames with several capture handles in parallel. Segments are
+        assigned to the handles in a round-robin fashion. Each worker puts its frames into its own
+        bounded queue, so the number of frames decoded ahead is limited.
+
+        :param index_sequence: List of frame indices.
+        :param handles: Number of capture handles (and worker threads).
+        :param segment_length: Number of consecutive positions in "index_sequence" per segment.
+        :return: Generator which yields the frames in the order of "index_sequence".
+        """
+
+        segments = [index_sequence[start:start + segment_length] for start in
+                    range(0, len(index_sequence), segment_length)]
+        handles = min(handles, len(segments))
+
+        # The workers calibrate frames concurrently. Build the calibration data for the window
+        # before they start, so that they only read shared data.
+        if self.calibration is not None:
+            self.calibration.prepare_correction(self.window)
+        stop_event = Event()
+        queues = [Queue(maxsize=2 * segment_length) for handle in range(handles)]
+        workers = [Thread(target=self.decode_segments,
+                          args=(segments[handle::handles], queues[handle], stop_event),
+                          daemon=True) for handle in range(handles)]
+        for worker in workers:
+            worker.start()
+
+        try:
+            for segment_index, segment in enumerate(segments):
+                frame_queue = queues[segment_index % handles]
+                for index in segment:
+                    frame = frame_queue.get()
+                    if isinstance(frame, Exception):
+                        raise frame
+                    yield frame
+        finally:
+            # The sequence is complete, or the consumer has stopped early. Stop the workers and
+            # release their queues.
+            stop_event.set()
+            for frame_queue in queues:
+                try:
+                    while True:
+                        frame_queue.get_nowait()
+                except Empty:
+                    pass
+            for worker in workers:
+                worker.join()
+
+    def decode_segments(self, segments, frame_queue, stop_event):
+        """
+        Worker thread for "read_frames_segmented": Open a capture handle and decode the frames of
+        the segments assigned to this worker. Frames (or an exception) are put into the queue.
+
+        :param segments: List of segments (lists of frame indices).
+        :param frame_queue: Queue for the decoded frames.
+        :param stop_event: If set, the worker terminates.
+        :return: -
+        """
+
+        capture = VideoCapture(self.file_path)
+        position = 0
+        try:
+            for segment in segments:
+                for index in segment:
+                    self.position_capture(capture, position, index)
+                    ret, frame = capture.read()
+                    if not ret:
+                        raise IOError("Error in reading video frame, index: {0}. Try to convert "
+                                      "the video with PIPP into some standard format".format(index))
+                    position = index + 1
+                    frame = self.calibrate(self.cfa_plane(self.crop(frame)))
+                    if self.debayer:
+                        frame = debayer_frame(frame, debayer_pattern=self.bayer_pattern,
+                                              debayer_method=self.configuration.frames_debayering_method,
+                                              BGR_input=self.BGR_input)
+                    if not VideoReader.put_frame(frame_queue, frame, stop_event):
+                        return
+        except Exception as e:
+            VideoReader.put_frame(frame_queue, e, stop_event)
+        finally:
+            capture.release()
+
+    @staticmethod
+    def put_frame(frame_queue, item, stop_event):
+        """
+        Put an item into a bounded queue. Wait while the queue is full, unless the stop event is
+        set.
+
+        :param frame_queue: Queue
+        :param item: Item to be put into the queue
+        :param stop_event: Event which signals that the consumer has stopped.
+        :return: True, if the item was put into the queue. False, if the worker is to terminate.
+        """
+
+        while not stop_event.is_set():
+            try:
+                frame_queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
     def close(self):
         """
         Close the VideoReader object.
@@ -585,7 +984,252 @@ class VideoReader(object):
         :return:
         """
 
-        self.cap.release()
+        if self.cap is not None:
+            self.cap.release()
+        if self.transcoded is not None:
+            self.transcoded.close()
+
+
+class VirtualVideoReader(object):
+    """
+    The VirtualVideoReader joins several video files into one logical frame sequence. Capture
+    software often splits a recording session into several files (segments) when a file size
+    limit is reached. All segments must have the same frame format. Each segment is read by its
+    own VideoReader, so SER files are memory-mapped or read in blocks as usual. The interface is
+    the same as for the VideoReader.
+    """
+
+    def __init__(self, configuration):
+        """
+        Create the VirtualVideoReader object and initialize instance variables.
+
+        :param configuration: Configuration object with parameters
+        """
+
+        self.configuration = configuration
+        self.readers = []
+        self.offsets = []
+        self.last_read = None
+        self.frame_count = None
+        self.shape = None
+        self.color = None
+        self.dtype = None
+        self.shift_pixels = 0
+        self.bayer_pattern = None
+        self.BGR_input = None
+        self.warn_message = None
+        self.calibration = None
+
+    def open(self, file_path_list, bayer_option_selected='Auto detect color',
+             SER_16bit_shift_correction=True):
+        """
+        Open all video segments and return parameters with the metadata of the joined sequence.
+        Throws an IOError if a segment cannot be read, or if its frame format differs from the
+        first segment.
+
+        :param file_path_list: List with the full names of the video files, in temporal order.
+        :param bayer_option_selected: Bayer pattern, one out of: "Auto detect color", "Grayscale",
+                              "RGB", "BGR", "Force Bayer RGGB", "Force Bayer GRBG",
+                               "Force Bayer GBRG", "Force Bayer BGGR".
+        :param SER_16bit_shift_correction: If True and the frame type is 16bit, the video frames
+                                           are analyzed to find the number of unused high bits in
+                                           pixel data. In read operations data are shifted up by
+                                           this number of bits.
+        :return: (frame_count, color, dtype, shape, shift_pixels), see "VideoReader.open". The
+                 frame count is the total over all segments.
+        """
+
+        self.close()
+        self.readers = []
+        self.offsets = []
+        self.frame_count = 0
+        self.warn_message = None
+
+        for file_path in file_path_list:
+            reader = VideoReader(self.configuration)
+            reader.calibration = self.calibration
+            # The Bayer pattern detected (or selected) for the first segment applies to all.
+            if self.readers:
+                bayer_option_selected = self.bayer_pattern
+            frame_count, color, dtype, shape, shift_pixels = reader.open(
+                file_path, bayer_option_selected=bayer_option_selected,
+                SER_16bit_shift_correction=SER_16bit_shift_correction)
+
+            if not self.readers:
+                self.color, self.dtype, self.shape = color, dtype, shape
+                self.bayer_pattern = reader.bayer_pattern
+                self.BGR_input = reader.BGR_input
+            elif color != self.color or dtype != self.dtype or shape != self.shape or \
+                    reader.BGR_input != self.BGR_input:
+                reader.close()
+                self.close()
+                raise IOError("Video segment " + path.basename(file_path) +
+                              " does not match the format of the first segment")
+
+            if self.warn_message is None:
+                self.warn_message = reader.warn_message
+            self.readers.append(reader)
+            self.offsets.append(self.frame_count)
+            self.frame_count += frame_count
+
+        # The number of unused high bits may have been found to be different for the segments.
+        # Use the smallest number for all of them, so that the pixel values are consistent.
+        self.shift_pixels = min(reader.shift_pixels for reader in self.readers)
+        for reader in self.readers:
+            if reader.SERFile and reader.shift_pixels != self.shift_pixels:
+                reader.shift_pixels = reader.cap.shift_pixels = self.shift_pixels
+                reader.reset_position()
+
+        self.last_read = -1
+
+        # Return the metadata.
+        return self.frame_count, self.color, self.dtype, self.shape, self.shift_pixels
+
+    def matching_segments(self, file_path_list, bayer_option_selected='Auto detect color'):
+        """
+        Find the video files which can be joined into one sequence by "open". The first file which
+        can be read sets the frame format. Files which cannot be read or have a different format
+        are rejected. Only the first frame of each file is read.
+
+        :param file_path_list: List with the full names of the video files, in temporal order.
+        :param bayer_option_selected: Bayer pattern, see "open".
+        :return: Tuple (segments, rejected) with the lists of files which match the format of
+                 the first file (including the first file) and which do not match.
+        """
+
+        segments = []
+        rejected = []
+        segment_format = None
+
+        for file_path in file_path_list:
+            reader = VideoReader(self.configuration)
+            try:
+                frame_count, color, dtype, shape, shift_pixels = reader.open(
+                    file_path, bayer_option_selected=bayer_option_selected,
+                    SER_16bit_shift_correction=False)
+            except (IOError, Error):
+                rejected.append(file_path)
+                continue
+            finally:
+                reader.close()
+
+            # The Bayer pattern detected (or selected) for the first segment applies to all.
+            if segment_format is None:
+                segment_format = (color, dtype, shape, reader.BGR_input)
+                bayer_option_selected = reader.bayer_pattern
+            elif (color, dtype, shape, reader.BGR_input) != segment_format:
+                rejected.append(file_path)
+                continue
+            segments.append(file_path)
+
+        return segments, rejected
+
+    def locate(self, index):
+        """
+        Translate a frame index of the joined sequence into the segment and the frame index
+        within the segment.
+
+        :param index: Frame index
+        :return: Tuple (segment number, frame index within the segment)
+        """
+
+        if not 0 <= index < self.frame_count:
+            raise ArgumentError("Error in reading video frame, index {0} is out of bounds".format(
+                index))
+        segment = bisect_right(self.offsets, index) - 1
+        return segment, index - self.offsets[segment]
+
+    def read_frame(self, index=None):
+        """
+        Read a single frame from the joined sequence.
+
+        :param index: Frame index (optional). If no index is specified, the next frame is read.
+        :return: Numpy array containing the frame, see "VideoReader.read_frame".
+        """
+
+        if index is None:
+            index = self.last_read + 1
+        segment, index_segment = self.locate(index)
+        frame = self.readers[segment].read_frame(index_segment)
+        self.last_read = index
+        return frame
+
+    def read_frames(self, index_sequence):
+        """
+        Read a sequence of frames. The sequence is cut into runs of frames in the same segment,
+        and each run is read with the "read_frames" method of the segment's reader.
+
+        :param index_sequence: Sequence of frame indices.
+        :return: Generator which yields the frames in the order of "index_sequence".
+        """
+
+        run_segment = None
+        run = []
+        for index in index_sequence:
+            segment, index_segment = self.locate(index)
+            if segment != run_segment and run:
+                yield from self.readers[run_segment].read_frames(run)
+                run = []
+            run_segment = segment
+            run.append(index_segment)
+            self.last_read = index
+        if run:
+            yield from self.readers[run_segment].read_frames(run)
+
+    def raw_cfa_available(self):
+        """
+        Check if the video contains Bayer-encoded single-plane (CFA) frames which are debayered
+        into color frames.
+
+        :return: True, if raw CFA frames can be read. False otherwise.
+        """
+
+        return self.readers[0].raw_cfa_available()
+
+    def set_raw_output(self, raw):
+        """
+        Switch between debayered output (default) and raw CFA output of read operations.
+
+        :param raw: If True, frames are returned as read from the video, without debayering.
+        :return: -
+        """
+
+        for reader in self.readers:
+            reader.set_raw_output(raw)
+
+    def set_window(self, window):
+        """
+        Restrict the output of read operations to a window of the frames.
+
+        :param window: Tuple (y_low, y_high, x_low, x_high), or None for full frames. For Bayer
+                       input the lower bounds must be even.
+        :return: -
+        """
+
+        for reader in self.readers:
+            reader.set_window(window)
+
+    def set_calibration(self, calibration):
+        """
+        Calibrate frames on the raw CFA data, i.e. before debayering.
+
+        :param calibration: Calibration object, or None to switch off raw CFA calibration.
+        :return: -
+        """
+
+        self.calibration = calibration
+        for reader in self.readers:
+            reader.set_calibration(calibration)
+
+    def close(self):
+        """
+        Close the readers of all segments.
+
+        :return:
+        """
+
+        for reader in self.readers:
+            reader.close()
 
 
 class ImageReader(object):
@@ -700,20 +1344,90 @@ class ImageReader(object):
             else:
                 self.last_read = index
 
-        # A new frame has to be read. First check if the index is not out of bounds.
-        if 0 <= self.last_read < self.frame_count:
+        # A new frame has to be read. Check if its metadata match those of the first image.
+        self.last_frame_read = self.decode_image(self.last_read)
+        self.check_metadata(self.last_frame_read, self.last_read)
+
+        return self.last_frame_read
+
+    def read_frames(self, index_sequence):
+        """
+        Read a sequence of frames. The images are decoded in parallel by a pool of threads which
+        works on a window of files ahead of the frame handed out last. The frames are returned in
+        the order of the index sequence.
+
+        :param index_sequence: Sequence of frame indices.
+        :return: Generator which yields the frames in the order of "index_sequence".
+        """
+
+        if not self.opened:
+            raise WrongOrderingError(
+                "Error: Attempt to read image file frame before opening ImageReader")
+
+        index_sequence = list(index_sequence)
+        window = max(self.configuration.frames_image_decoding_window, 1)
+
+        with ThreadPoolExecutor(
+                max_workers=self.configuration.frames_image_decoding_threads) as executor:
+            futures = deque()
+            next_submitted = 0
+            for index in index_sequence:
+                # Keep the window of images being decoded filled.
+                while next_submitted < len(index_sequence) and len(futures) < window:
+                    futures.append(
+                        executor.submit(self.decode_image, index_sequence[next_submitted]))
+                    next_submitted += 1
+
+                frame = futures.popleft().result()
+                self.check_metadata(frame, index)
+
+                self.just_opened = False
+                self.last_read = index
+                self.last_frame_read = frame
+                yield frame
+
+    def raw_cfa_available(self):
+        """
+        Images are not debayered by the ImageReader, so raw CFA frames are never available.
+
+        :return: False
+        """
+
+        return False
+
+    def decode_image(self, index):
+        """
+        Read and decode the image with a given index. This method does not change the state of the
+        reader, so it can be executed in parallel threads.
+
+        :param index: Frame index
+        :return: Numpy array containing the frame.
+        """
+
+        # First check if the index is not out of bounds.
+        if 0 <= index < self.frame_count:
             try:
-                self.last_frame_read = Frames.read_image(self.file_path_list[self.last_read])
+                frame = Frames.read_image(self.file_path_list[index])
                 if self.convert_to_grayscale:
-                    self.last_frame_read = cvtColor(self.last_frame_read, COLOR_RGB2GRAY)
+                    frame = cvtColor(frame, COLOR_RGB2GRAY)
             except Exception as ex:
                 raise IOError("Reading image with index: " + str(index) + ", " + str(ex))
         else:
             raise ArgumentError("Reading image with index: " + str(index) +
                                 ", index is out of bounds")
 
-        # Check if the metadata match.
-        shape = self.last_frame_read.shape
+        return frame
+
+    def check_metadata(self, frame, index):
+        """
+        Check if the metadata of a frame match those of the first image read.
+
+        :param frame: Frame read from file
+        :param index: Frame index
+        :return: -
+        """
+
+        shape = frame.shape
         color = (len(shape) == 3)
 
         # Check if all images have matching metadata.
@@ -722,11 +1436,9 @@ class ImageReader(object):
                 "Mixing grayscale and color images not supported, index: " + str(index))
         elif shape != self.shape:
             raise ShapeError("Images have different size, index: " + str(index))
-        elif self.last_frame_read.dtype != self.dtype:
+        elif frame.dtype != self.dtype:
             raise TypeError("Images have different type, index: " + str(index))
 
-        return self.last_frame_read
-
     def close(self):
         """
         Close the ImageReader object.
@@ -737,6 +1449,223 @@ class ImageReader(object):
         self.opened = False
 
 
+class FramePrefetcher(object):
+    """
+    Read frames ahead of their use in a background thread. The sequence of frame indices which will
+    be accessed next is known in advance (e.g. sequential in "rank_frames.frame_score", two chains
+    out from the reference frame in "align_frames.align_frames"). The frames are read in this order
+    and put into a bounded queue, so that I/O and decoding overlap with the computations on the
+    workflow thread.
+
+    While the prefetcher is active, the reader object must not be used by any other thread.
+    """
+
+    def __init__(self, read_frames, index_sequence, queue_size):
+        """
+        Initialize the prefetcher and start the read-ahead thread.
+
+        :param read_frames: Function which for a sequence of (original) frame indices returns a
+                            generator yielding the frames in this order.
+        :param index_sequence: Sequence of (original) frame indices in the order of access.
+        :param queue_size: Maximum number of frames held in the queue.
+        """
+
+        self.read_frames = read_frames
+        self.index_sequence = list(index_sequence)
+        self.queue = Queue(maxsize=max(queue_size, 1))
+        self.stop_request = Event()
+
+        # For each frame index store the positions in the access sequence. An index can occur more
+        # than once (e.g. the reference frame in frame alignment).
+        self.positions = {}
+        for position, index in enumerate(self.index_sequence):
+            self.positions.setdefault(index, []).append(position)
+
+        # Position in the sequence of the next frame to be handed out to the consumer.
+        self.next_position = 0
+
+        self.thread = Thread(target=self.read_ahead, daemon=True)
+        self.thread.start()
+
+    def read_ahead(self):
+        """
+        Thread function: Read all frames of the access sequence and put them into the queue. If an
+        error occurs, the exception object is queued instead of the frame. It is raised when the
+        consumer asks for the frame.
+
+        :return: -
+        """
+
+        frame_generator = self.read_frames(self.index_sequence)
+        for position in range(len(self.index_sequence)):
+            if self.stop_request.is_set():
+                frame_generator.close()
+                return
+            try:
+                item = next(frame_generator)
+            except Exception as e:
+                item = e
+
+            # Wait until there is space in the queue. Check periodically if the prefetcher is to
+            # be stopped.
+            while True:
+                if self.stop_request.is_set():
+                    frame_generator.close()
+                    return
+                try:
+                    self.queue.put((position, item), timeout=0.1)
+                    break
+                except Full:
+                    pass
+
+            # After an error the generator cannot be continued.
+            if isinstance(item, Exception):
+                return
+
+    def get(self, index):
+        """
+        Get the frame with a given index. Frames which were read ahead but are skipped by the
+        consumer (e.g. because a derived variant was buffered already) are discarded.
+
+        :param index: Original frame index.
+        :return: The frame, or None if the index does not occur in the remaining access sequence.
+        """
+
+        # Find the next occurrence of this index in the part of the sequence not yet consumed.
+        target_position = None
+        for position in self.positions.get(index, []):
+            if position >= self.next_position:
+                target_position = position
+                break
+        if target_position is None:
+            return None
+
+        # Take frames from the queue until the requested one is found.
+        while True:
+            try:
+                position, item = self.queue.get(timeout=0.1)
+            except Empty:
+                # The reader thread has terminated without delivering the frame.
+                if not self.thread.is_alive() and self.queue.empty():
+                    return None
+                continue
+            if position == target_position:
+                break
+
+        self.next_position = target_position + 1
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def stop(self):
+        """
+        Stop the read-ahead thread and discard all frames read in advance.
+
+        :return: -
+        """
+
+        self.stop_request.set()
+        self.thread.join()
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+
+class FrameCache(object):
+    """
+    Least-recently-used cache for a frame variant which is not buffered. Frames are kept until the
+    total size of all cached frames exceeds a byte budget. Then the frames which have not been
+    accessed for the longest time are evicted. The frame stored last is always kept, even if it
+    alone exceeds the budget. The numbers of cache hits and misses are counted for the protocol.
+
+    """
+
+    def __init__(self, name, budget_bytes):
+        """
+        Initialize an empty cache.
+
+        :param name: Name of the frame variant (used in statistics output).
+        :param budget_bytes: Maximum total size of cached frames in bytes.
+        """
+
+        self.name = name
+        self.budget_bytes = budget_bytes
+        self.frames = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, index):
+        """
+        Look up a frame in the cache.
+
+        :param index: Original frame index
+        :return: The cached frame, or None if it is not in the cache.
+        """
+
+        if index in self.frames:
+            self.frames.move_to_end(index)
+            self.hits += 1
+            return self.frames[index]
+
+        self.misses += 1
+        return None
+
+    def put(self, index, frame):
+        """
+        Store a frame in the cache, and evict the least recently used frames if the byte budget
+        is exceeded.
+
+        :param index: Original frame index
+        :param frame: Frame to be stored
+        :return: -
+        """
+
+        if index in self.frames:
+            self.size_bytes -= self.frames.pop(index).nbytes
+        self.frames[index] = frame
+        self.size_bytes += frame.nbytes
+
+        while self.size_bytes > self.budget_bytes and len(self.frames) > 1:
+            self.size_bytes -= self.frames.popitem(last=False)[1].nbytes
+
+    def remove(self, index):
+        """
+        Remove a frame from the cache, if it is cached.
+
+        :param index: Original frame index
+        :return: -
+        """
+
+        if index in self.frames:
+            self.size_bytes -= self.frames.pop(index).nbytes
+
+    def clear(self):
+        """
+        Remove all frames from the cache. The statistics are kept.
+
+        :return: -
+        """
+
+        self.frames.clear()
+        self.size_bytes = 0
+
+    def statistics(self):
+        """
+        Create a one-line summary of the cache statistics.
+
+        :return: String with the numbers of hits and misses, and the hit rate.
+        """
+
+        accesses = self.hits + self.misses
+        if accesses:
+            hit_rate = 100. * self.hits / accesses
+        else:
+            hit_rate = 0.
+        return "{0:12s}: {1:8d} hits, {2:8d} misses, hit rate {3:5.1f}%, " \
+               "{4:5d} frames cached".format(self.name, self.hits, self.misses, hit_rate,
+                                             len(self.frames))
+
+
 class Calibration(QtCore.QObject):
     """
     This class performs the dark / flat calibration of frames. Master frames are created from
@@ -757,6 +1686,21 @@ class Calibration(QtCore.QObject):
         super(Calibration, self).__init__()
         self.configuration = configuration
         self.warn_message = None
+        self.master_bayer_pattern = None
+        self.master_raw = False
+
+        # Data derived lazily during frame correction are built under this lock, because frames
+        # may be corrected in several threads at once (parallel video decoding, prefetching).
+        self.correction_lock = Lock()
+
+        # If a calibration library is configured, master frames are stored there and re-used.
+        self.library = None
+        if self.configuration.frames_calibration_library:
+            try:
+                self.library = CalibrationLibrary(self.configuration.frames_calibration_library)
+            except OSError:
+                self.library = None
+
         self.reset_masters()
 
     def reset_masters(self):
@@ -782,6 +1726,12 @@ class Calibration(QtCore.QObject):
 
         self.master_dark_frame = None
         self.master_dark_frame_adapted = None
+        self.master_dark_frame_variants = {}
+        self.dark_entry = None
+        self.dark_raw = False
+        self.hot_pixels = None
+        self.hot_pixel_mode = False
+        self.hot_pixel_neighbours = {}
         self.high_value = None
         self.dark_color = None
         self.dark_dtype = None
@@ -796,64 +1746,227 @@ class Calibration(QtCore.QObject):
 
         self.master_flat_frame = None
         self.inverse_master_flat_frame = None
+        self.flat_entry = None
         self.flat_color = None
         self.flat_dtype = None
         self.flat_shape = None
 
     def create_master(self, master_name, output_dtype=uint16):
         """
-        Create a master frame by averaging a number of video frames or still images.
+        Create a master frame by combining a number of video frames or still images (see
+        "MasterFrameBuilder" for the methods available).
+
+        :param master_name: Path name of video file or image directory.
+        :param output_dtype: Data type of resulting master frame, one of:
+                             - uint8 (high value = 255)
+                             - uint16 (high value = 65535)
+                             default: uint16
+        :return: Master frame
+        """
+
+        # Case video file:
+        if Path(master_name).is_file():
+            extension = Path(master_name).suffix
+            if extension.lower() in ('.avi', '.mov', '.mp4', '.ser'):
+                reader = VideoReader(self.configuration)
+                # Switch off dynamic range correction for 16bit SER files.
+                frame_count, input_color, input_dtype, input_shape, shift_pixels = reader.open(master_name,
+                     bayer_option_selected=self.configuration.frames_debayering_default,
+                     SER_16bit_shift_correction=False)
+                self.warn_message = reader.warn_message
+                # For Bayer-encoded videos, a raw CFA master can be created from the frames before
+                # debayering. It is applied to the raw frames of stacking jobs.
+                self.master_raw = self.configuration.frames_calibration_raw and \
+                                  reader.raw_cfa_available()
+                if self.master_raw:
+                    reader.set_raw_output(True)
+                    input_shape = input_shape[:2]
+                self.configuration.hidden_parameters_current_dir = str(Path(master_name).parent)
+            else:
+                raise InternalError(
+                    "Unsupported file type '" + extension + "' specified for master frame "
+                                                            "construction")
+        # Case image directory:
+        elif Path(master_name).is_dir():
+            # Use the same (sorted) file list as the calibration library, so that the build order
+            # is deterministic and matches the library fingerprint.
+            names = Calibration.master_sources(master_name)
+            reader = ImageReader(self.configuration)
+            self.master_raw = False
+            frame_count, input_color, input_dtype, input_shape, shift_pixels = reader.open(names,
+                                        bayer_option_selected=self.configuration.frames_debayering_default)
+            self.configuration.hidden_parameters_current_dir = str(master_name)
+        else:
+            raise InternalError("Cannot decide if input file is video or image directory")
+
+        # Combine all frames with the method selected in the configuration (mean, median or
+        # sigma-clipped mean). For image directories and videos, frames are decoded in parallel.
+        try:
+            master_frame_64 = MasterFrameBuilder(self.configuration).build(
+                reader.read_frames(range(frame_count)), frame_count, input_shape, input_dtype)
+        finally:
+            reader.close()
+        self.master_bayer_pattern = reader.bayer_pattern
+
+        # Return the master frame in the format specified.
+        if output_dtype == input_dtype:
+            return master_frame_64.astype(output_dtype)
+        elif output_dtype == uint8 and input_dtype == uint16:
+            return (master_frame_64 * (1. / 256)).astype(output_dtype)
+        elif output_dtype == uint16 and input_dtype == uint8:
+            return (master_frame_64 * 256.).astype(output_dtype)
+        else:
+            raise ArgumentError("Cannot convert dtype from " + str(input_dtype) + " to " +
+                                str(output_dtype))
+
+    def master_parameters(self, load_from_file):
+        """
+        Collect the parameters which affect the construction of a master frame. They are part of
+        the key under which the master is stored in the calibration library.
+
+        :param load_from_file: True, if the master is loaded from a file. False, if it is created
+                               from a video file or image directory.
+        :return: Dictionary with parameters
+        """
+
+        if load_from_file:
+            return {'method': 'file'}
+        return {'method': self.configuration.frames_master_method,
+                'sigma': self.configuration.frames_master_sigma,
+                'debayering': self.configuration.frames_debayering_default,
+                'debayer_method': self.configuration.frames_debayering_method,
+                'raw': self.configuration.frames_calibration_raw}
+
+    @staticmethod
+    def master_sources(master_name):
+        """
+        Look up the input files of a master frame.
+
+        :param master_name: Path name of video file, image directory, or master frame file.
+        :return: The path name, or for an image directory the list of image file names.
+        """
+
+        if Path(master_name).is_dir():
+            return [path.join(master_name, name) for name in sorted(listdir(master_name))]
+        return master_name
+
+    def find_in_library(self, kind, master_name, parameters):
+        """
+        Look up a master frame in the calibration library which was created from the same input
+        with the same parameters.
+
+        :param kind: Either 'dark' or 'flat'.
+        :param master_name: Path name of video file or image directory.
+        :param parameters: Dictionary with construction parameters.
+        :return: Library entry, or None if the library is not active or has no such master.
+        """
+
+        if self.library is None:
+            return None
+        return self.library.find(kind, Calibration.master_sources(master_name), parameters)
+
+    def store_in_library(self, kind, master_name, parameters, master):
+        """
+        Store a master frame in the calibration library, if it is active. If the library cannot
+        be written, the master is used anyway.
+
+        :param kind: Either 'dark' or 'flat'.
+        :param master_name: Path name of video file, image directory, or master frame file.
+        :param parameters: Dictionary with construction parameters.
+        :param master: Master frame
+        :return: Library entry, or None if the master was not stored.
+        """
+
+        if self.library is None:
+            return None
+        try:
+            return self.library.store(kind, Calibration.master_sources(master_name), parameters,
+                                      master, bayer_pattern=self.master_bayer_pattern)
+        except OSError:
+            return None
+
+    def select_masters(self, color, shape, raw_shape=None):
+        """
+        If the active master frames do not match the frames of a job, select the matching master
+        dark and master flat from the calibration library (the ones stored last). For Bayer-encoded
+        videos, raw CFA masters are preferred.
+
+        :param color: True, if frames are in color; False otherwise.
+        :param shape: Tuple with the shape of a single frame.
+        :param raw_shape: Shape of the raw CFA frames, or None if the job has no raw CFA frames.
+        :return: True, if master frames were selected from the library. False otherwise.
+        """
+
+        if self.library is None or self.flats_darks_match(color, shape) or (
+                raw_shape is not None and self.flats_darks_match(False, raw_shape)):
+            return False
+        dark_entry = flat_entry = None
+        if raw_shape is not None:
+            dark_entry = self.library.select('dark', False, raw_shape)
+            flat_entry = self.library.select('flat', False, raw_shape)
+        if dark_entry is None and flat_entry is None:
+            dark_entry = self.library.select('dark', color, shape)
+            flat_entry = self.library.select('flat', color, shape)
+        if dark_entry is None and flat_entry is None:
+            return False
+
+        self.reset_masters()
+        if dark_entry is not None:
+            self.master_dark_frame = self.library.load(dark_entry)
+            self.dark_entry = dark_entry
+            self.dark_raw = Calibration.raw_master(dark_entry['bayer_pattern'],
+                                                   dark_entry['shape'])
+            self.shape = self.dark_shape = self.master_dark_frame.shape
+            self.color = self.dark_color = (len(self.dark_shape) == 3)
+            self.dark_dtype = self.master_dark_frame.dtype
+        if flat_entry is not None:
+            self.master_flat_frame = self.library.load(flat_entry)
+            self.flat_entry = flat_entry
+            self.shape = self.flat_shape = self.master_flat_frame.shape
+            self.color = self.flat_color = (len(self.flat_shape) == 3)
+            self.flat_dtype = self.master_flat_frame.dtype
+            self.inverse_master_flat_frame = self.library.load(flat_entry, 'inverse')
+            if self.inverse_master_flat_frame is None:
+                self.inverse_master_flat_frame = Calibration.inverse_flat(
+                    self.master_flat_frame,
+                    Calibration.raw_master(flat_entry['bayer_pattern'], flat_entry['shape']))
+                self.library.store_variant(flat_entry, 'inverse', self.inverse_master_flat_frame)
+        return True
+
+    @staticmethod
+    def raw_master(bayer_pattern, shape):
+        """
+        Check if a master frame has been created from raw CFA frames of a Bayer-encoded video.
+
+        :param bayer_pattern: Bayer pattern of the frames the master has been created from
+        :param shape: Shape of the master frame
+        :return: True, if the master is a raw CFA frame. False otherwise.
+        """
 
-        :param master_name: Path name of video file or image directory.
-        :param output_dtype: Data type of resulting master frame, one of:
-                             - uint8 (high value = 255)
-                             - uint16 (high value = 65535)
-                             default: uint16
-        :return: Master frame
+        return len(shape) == 2 and bayer_pattern in ['Force Bayer RGGB', 'Force Bayer GRBG',
+                                                     'Force Bayer GBRG', 'Force Bayer BGGR']
+
+    @staticmethod
+    def inverse_flat(master_flat_frame, raw):
         """
+        Compute the inverse of a master flat, normalized so that its entries are close to one.
 
-        # Case video file:
-        if Path(master_name).is_file():
-            extension = Path(master_name).suffix
-            if extension.lower() in ('.avi', '.mov', '.mp4', '.ser'):
-                reader = VideoReader(self.configuration)
-                # Switch off dynamic range correction for 16bit SER files.
-                frame_count, input_color, input_dtype, input_shape, shift_pixels = reader.open(master_name,
-                     bayer_option_selected=self.configuration.frames_debayering_default,
-                     SER_16bit_shift_correction=False)
-                self.warn_message = reader.warn_message
-                self.configuration.hidden_parameters_current_dir = str(Path(master_name).parent)
-            else:
-                raise InternalError(
-                    "Unsupported file type '" + extension + "' specified for master frame "
-                                                            "construction")
-        # Case image directory:
-        elif Path(master_name).is_dir():
-            names = [path.join(master_name, name) for name in listdir(master_name)]
-            reader = ImageReader(self.configuration)
-            frame_count, input_color, input_dtype, input_shape, shift_pixels = reader.open(names,
-                                        bayer_option_selected=self.configuration.frames_debayering_default)
-            self.configuration.hidden_parameters_current_dir = str(master_name)
-        else:
-            raise InternalError("Cannot decide if input file is video or image directory")
+        :param master_flat_frame: Master flat
+        :param raw: True, if the master flat is a raw CFA frame. In this case the four pixel
+                    positions of the 2x2 Bayer cell are normalized separately, so the flat does
+                    not change the color balance.
+        :return: Inverse master flat (float32)
+        """
 
-        # Sum all frames in a 64bit buffer.
-        master_frame_64 = zeros(input_shape, float64)
-        for index in range(frame_count):
-            master_frame_64 += reader.read_frame(index)
+        if not raw:
+            return (average(master_flat_frame).astype(uint16) / master_flat_frame).astype(float32)
 
-        # Return the average frame in the format specified.
-        if output_dtype == input_dtype:
-            return (master_frame_64 / frame_count).astype(output_dtype)
-        elif output_dtype == uint8 and input_dtype == uint16:
-            factor = 1. / (frame_count * 256)
-            return (master_frame_64 * factor).astype(output_dtype)
-        elif output_dtype == uint16 and input_dtype == uint8:
-            factor = 256. / frame_count
-            return (master_frame_64 * factor).astype(output_dtype)
-        else:
-            raise ArgumentError("Cannot convert dtype from " + str(input_dtype) + " to " +
-                                str(output_dtype))
+        inverse = empty(master_flat_frame.shape, dtype=float32)
+        for dy in range(2):
+            for dx in range(2):
+                cell = master_flat_frame[dy::2, dx::2]
+                inverse[dy::2, dx::2] = average(cell).astype(uint16) / cell
+        return inverse
 
     def create_master_dark(self, dark_name, load_from_file=False):
         """
@@ -868,7 +1981,9 @@ class Calibration(QtCore.QObject):
         # Reset a master dark frame if previously allocated.
         self.reset_master_dark()
 
-        # Create the master frame or read it from a file.
+        # Create the master frame or read it from a file. If it has been created from the same
+        # input before, take it from the calibration library.
+        parameters = self.master_parameters(load_from_file)
         if load_from_file:
             try:
                 self.master_dark_frame = Frames.read_image(dark_name)
@@ -878,8 +1993,19 @@ class Calibration(QtCore.QObject):
 
             if self.master_dark_frame.dtype == uint8:
                 self.master_dark_frame = (self.master_dark_frame * 256).astype(uint16)
+            self.dark_entry = self.store_in_library('dark', dark_name, parameters,
+                                                    self.master_dark_frame)
         else:
-            self.master_dark_frame = self.create_master(dark_name, output_dtype=uint16)
+            self.dark_entry = self.find_in_library('dark', dark_name, parameters)
+            if self.dark_entry is not None:
+                self.master_dark_frame = self.library.load(self.dark_entry)
+                self.dark_raw = Calibration.raw_master(self.dark_entry['bayer_pattern'],
+                                                       self.dark_entry['shape'])
+            else:
+                self.master_dark_frame = self.create_master(dark_name, output_dtype=uint16)
+                self.dark_raw = self.master_raw
+                self.dark_entry = self.store_in_library('dark', dark_name, parameters,
+                                                    self.master_dark_frame)
 
         self.shape = self.dark_shape = self.master_dark_frame.shape
         self.color = self.dark_color = (len(self.dark_shape) == 3)
@@ -918,7 +2044,11 @@ class Calibration(QtCore.QObject):
         # Reset a master flat frame if previously allocated.
         self.reset_master_flat()
 
-        # Create the master frame or read it from a file.
+        # Create the master frame or read it from a file. If it has been created from the same
+        # input (and with the same master dark) before, take it from the calibration library.
+        parameters = self.master_parameters(load_from_file)
+        if self.dark_entry is not None:
+            parameters['dark'] = self.dark_entry['key']
         if load_from_file:
             try:
                 self.master_flat_frame = Frames.read_image(flat_name)
@@ -929,7 +2059,11 @@ class Calibration(QtCore.QObject):
             if self.master_flat_frame.dtype == uint8:
                 self.master_flat_frame = (self.master_flat_frame * 256).astype(uint16)
         else:
-            self.master_flat_frame = self.create_master(flat_name, output_dtype=uint16)
+            self.flat_entry = self.find_in_library('flat', flat_name, parameters)
+            if self.flat_entry is not None:
+                self.master_flat_frame = self.library.load(self.flat_entry)
+            else:
+                self.master_flat_frame = self.create_master(flat_name, output_dtype=uint16)
 
         self.shape = self.flat_shape = self.master_flat_frame.shape
         self.color = self.flat_color = (len(self.flat_shape) == 3)
@@ -947,8 +2081,9 @@ class Calibration(QtCore.QObject):
 
         average_flat_frame = average(self.master_flat_frame).astype(uint16)
 
-        # If a new flat frame is to be constructed, apply a dark frame (if available).
-        if not load_from_file:
+        # If a new flat frame is to be constructed, apply a dark frame (if available). Flats from
+        # the library have been corrected already.
+        if not load_from_file and self.flat_entry is None:
             if self.master_dark_frame is not None:
                 # If there is a matching dark frame, use it to correct the flat frame. Avoid zeros
                 # in places where darks and flats are the same (hot pixels??).
@@ -958,8 +2093,24 @@ class Calibration(QtCore.QObject):
 
         # Compute the inverse master flat (float32) so that its entries are close to one.
         if average_flat_frame > 0:
-            self.inverse_master_flat_frame = (average_flat_frame / self.master_flat_frame).astype(
-                float32)
+            if self.flat_entry is not None:
+                self.inverse_master_flat_frame = self.library.load(self.flat_entry, 'inverse')
+            if self.inverse_master_flat_frame is None:
+                if load_from_file:
+                    raw = False
+                elif self.flat_entry is not None:
+                    raw = Calibration.raw_master(self.flat_entry['bayer_pattern'],
+                                                 self.flat_entry['shape'])
+                else:
+                    raw = self.master_raw
+                self.inverse_master_flat_frame = Calibration.inverse_flat(self.master_flat_frame,
+                                                                          raw)
+                if self.flat_entry is None:
+                    self.flat_entry = self.store_in_library('flat', flat_name, parameters,
+                                                            self.master_flat_frame)
+                if self.flat_entry is not None:
+                    self.library.store_variant(self.flat_entry, 'inverse',
+                                               self.inverse_master_flat_frame)
         else:
             self.reset_master_flat()
             raise InternalError("Invalid input for flat frame computation")
@@ -1008,45 +2159,263 @@ class Calibration(QtCore.QObject):
 
         self.dtype = frame_dtype
 
-        if self.master_dark_frame is None:
-            self.high_value = None
-            self.master_dark_frame_adapted = None
-        elif frame_dtype == uint8:
+        if frame_dtype == uint8:
             self.high_value = 255
-            self.master_dark_frame_adapted = (self.master_dark_frame / 256.).astype(uint8)
         elif frame_dtype == uint16:
             self.high_value = 65535
-            if shift_pixels:
-                self.master_dark_frame_adapted = self.master_dark_frame << shift_pixels
+
+        # Adapted versions of the dark frame are kept for re-use in later jobs. If the dark frame
+        # is stored in the calibration library, they are stored there as well.
+        variant = str(np_dtype(frame_dtype)) + '_shift_' + str(shift_pixels)
+        if self.master_dark_frame is None:
+            self.high_value = None
+            self.master_dark_frame_adapted = None
+        elif variant in self.master_dark_frame_variants:
+            self.master_dark_frame_adapted = self.master_dark_frame_variants[variant]
+        elif frame_dtype == uint16 and not shift_pixels:
+            self.master_dark_frame_adapted = self.master_dark_frame
+        else:
+            self.master_dark_frame_adapted = None
+            if self.dark_entry is not None:
+                self.master_dark_frame_adapted = self.library.load(self.dark_entry, variant)
+            if self.master_dark_frame_adapted is None:
+                if frame_dtype == uint8:
+                    self.master_dark_frame_adapted = (self.master_dark_frame / 256.).astype(uint8)
+                else:
+                    self.master_dark_frame_adapted = self.master_dark_frame << shift_pixels
+                if self.dark_entry is not None:
+                    try:
+                        self.library.store_variant(self.dark_entry, variant,
+                                                   self.master_dark_frame_adapted)
+                    except OSError:
+                        pass
+            self.master_dark_frame_variants[variant] = self.master_dark_frame_adapted
+
+        # In hot pixel mode the master dark is not subtracted. Instead, the (few) hot and dead
+        # pixels found in the master dark are replaced in every frame.
+        self.hot_pixel_mode = self.configuration.frames_hot_pixel_correction and \
+                              self.master_dark_frame is not None
+        if self.hot_pixel_mode and self.hot_pixels is None:
+            variant = 'hot_pixels_' + str(self.configuration.frames_hot_pixel_sigma) + '_' + \
+                      str(self.configuration.frames_hot_pixel_min_delta)
+            if self.dark_entry is not None:
+                self.hot_pixels = self.library.load(self.dark_entry, variant)
+            if self.hot_pixels is None:
+                self.hot_pixels = Calibration.hot_pixel_map(
+                    self.master_dark_frame, self.dark_raw,
+                    self.configuration.frames_hot_pixel_sigma,
+                    self.configuration.frames_hot_pixel_min_delta)
+                if self.dark_entry is not None:
+                    try:
+                        self.library.store_variant(self.dark_entry, variant, self.hot_pixels)
+                    except OSError:
+                        pass
+
+    @staticmethod
+    def hot_pixel_map(master_dark_frame, raw, threshold_sigma, minimum_delta):
+        """
+        Find hot and dead pixels in a master dark. A pixel is marked if it deviates from the median
+        of its 3x3 neighbourhood by more than "threshold_sigma" times the robust noise level of
+        the master dark (and by at least "minimum_delta"). For raw CFA masters, the neighbourhood
+        consists of the nearest pixels with the same Bayer color.
+
+        :param master_dark_frame: Master dark (uint16)
+        :param raw: True, if the master dark is a raw CFA frame.
+        :param threshold_sigma: Threshold in units of the noise level (median absolute deviation
+                                from the local median, scaled to a standard deviation)
+        :param minimum_delta: Minimal deviation (16bit units) for a pixel to be marked
+        :return: Array of shape (2, N) with the row and column indices of the N pixels marked.
+        """
+
+        if raw:
+            local_median = empty(master_dark_frame.shape, dtype=master_dark_frame.dtype)
+            for dy in range(2):
+                for dx in range(2):
+                    local_median[dy::2, dx::2] = medianBlur(
+                        ascontiguousarray(master_dark_frame[dy::2, dx::2]), 3)
+        else:
+            local_median = medianBlur(master_dark_frame, 3)
+
+        # For color frames, a pixel is marked if it deviates in any color channel.
+        deviation = absolute(master_dark_frame.astype(int32) - local_median)
+        if len(deviation.shape) == 3:
+            deviation = deviation.max(axis=2)
+
+        limit = max(threshold_sigma * 1.4826 * np_median(deviation), minimum_delta)
+        return array((deviation > limit).nonzero(), dtype=int32)
+
+    def prepare_correction(self, window=None):
+        """
+        Build the data which "correct" would otherwise derive lazily for a window. Afterwards,
+        "correct" only reads shared data for this window. Readers call this method before they
+        start worker threads which correct frames.
+
+        :param window: Window (y_low, y_high, x_low, x_high) in full frame coordinates, or None for
+                       full frames.
+        :return: -
+        """
+
+        if self.hot_pixel_mode:
+            self.hot_pixel_indices(window)
+
+    def hot_pixel_indices(self, window):
+        """
+        Compute the indices of the hot pixels and of their neighbours within a frame. The results
+        are kept for re-use, so that this work is done only once per window.
+
+        :param window: Window (y_low, y_high, x_low, x_high) in full frame coordinates covered by
+                       the frame, or None for full frames.
+        :return: Tuple (rows, columns, neighbour_rows, neighbour_columns). The hot pixel index
+                 arrays have shape (N,), the neighbour arrays have shape (N, 8).
+        """
+
+        indices = self.hot_pixel_neighbours.get(window)
+        if indices is not None:
+            return indices
+
+        with self.correction_lock:
+            # Another thread may have built the indices in the meantime.
+            indices = self.hot_pixel_neighbours.get(window)
+            if indices is None:
+                indices = self.compute_hot_pixel_indices(window)
+                self.hot_pixel_neighbours[window] = indices
+        return indices
+
+    def compute_hot_pixel_indices(self, window):
+        """
+        Compute the indices of the hot pixels and of their neighbours within a frame (see
+        "hot_pixel_indices").
+
+        :param window: Window (y_low, y_high, x_low, x_high) in full frame coordinates covered by
+                       the frame, or None for full frames.
+        :return: Tuple (rows, columns, neighbour_rows, neighbour_columns)
+        """
+
+        if window is None:
+            height, width = self.master_dark_frame.shape[:2]
+        else:
+            height = window[1] - window[0]
+            width = window[3] - window[2]
+        rows, columns = self.hot_pixels
+        if window is not None:
+            rows = rows - window[0]
+            columns = columns - window[2]
+        inside = (rows >= 0) & (rows < height) & (columns >= 0) & (columns < width)
+        rows = rows[inside]
+        columns = columns[inside]
+
+        # The eight neighbours of each pixel. For raw CFA frames they are two pixels apart, so they
+        # have the same Bayer color. At the frame border, neighbours are mirrored.
+        step = 2 if self.dark_raw else 1
+        offsets_y = array([-step, -step, -step, 0, 0, step, step, step], dtype=int32)
+        offsets_x = array([-step, 0, step, -step, step, -step, 0, step], dtype=int32)
+        neighbour_rows = rows[:, None] + offsets_y
+        neighbour_rows = where((neighbour_rows < 0) | (neighbour_rows >= height),
+                               rows[:, None] - offsets_y, neighbour_rows)
+        neighbour_columns = columns[:, None] + offsets_x
+        neighbour_columns = where((neighbour_columns < 0) | (neighbour_columns >= width),
+                                  columns[:, None] - offsets_x, neighbour_columns)
+
+        return rows, columns, clip(neighbour_rows, 0, height - 1), \
+               clip(neighbour_columns, 0, width - 1)
+
+    def replace_hot_pixels(self, frame, window=None):
+        """
+        Replace the hot and dead pixels of a frame in place with the median of their neighbours.
+        The work is proportional to the number of hot pixels, not to the frame size.
+
+        :param frame: Frame to be corrected (modified in place)
+        :param window: Window (y_low, y_high, x_low, x_high) in full frame coordinates covered by
+                       the frame, or None for full frames.
+        :return: -
+        """
+
+        rows, columns, neighbour_rows, neighbour_columns = self.hot_pixel_indices(window)
+        if len(rows):
+            frame[rows, columns] = np_median(frame[neighbour_rows, neighbour_columns], axis=1)
+
+    def fingerprint(self):
+        """
+        Compute a hash value which identifies the currently active (adapted) master frames. It is
+        used to decide if data derived from corrected frames can be re-used.
+
+        :return: Hex string with the hash value.
+        """
+
+        hash_object = sha1()
+        if self.hot_pixel_mode:
+            masters = [self.hot_pixels, self.inverse_master_flat_frame]
+        else:
+            masters = [self.master_dark_frame_adapted, self.inverse_master_flat_frame]
+        for master in masters:
+            if master is None:
+                hash_object.update(b'None')
             else:
-                self.master_dark_frame_adapted = self.master_dark_frame
+                hash_object.update(str(master.dtype).encode('utf-8'))
+                hash_object.update(master.tobytes())
+        return hash_object.hexdigest()
 
-    def correct(self, frame):
+    def correct(self, frame, out=None, window=None):
         """
-        Correct a stacking frame using a master dark and / or a master flat.
+        Correct a stacking frame using a master dark and / or a master flat. The dark subtraction
+        and the flat multiplication are done with saturating OpenCV operations which write into
+        the output array directly, so no temporary full-frame arrays are created. Pixels darker
+        than the master dark are set to zero, values above the range of the frame type are
+        clipped.
 
         :param frame: Frame to be stacked.
+        :param out: Optional output array with the shape and type of the frame. It may be the
+                    frame itself. If None, a new array is allocated.
+        :param window: Optional window (y_low, y_high, x_low, x_high) in full frame coordinates.
+                       If it is given, the frame contains only this window of the full frame, and
+                       the corresponding window of the master frames is applied.
         :return: Frame corrected for dark/flat, same type as input frame.
         """
 
+        # In hot pixel mode, the dark is not subtracted. Hot pixels are replaced after the flat
+        # correction, so that they get the values of their corrected neighbours.
+        if self.hot_pixel_mode:
+            inverse_flat = self.inverse_master_flat_frame
+            if window is not None and inverse_flat is not None:
+                y_low, y_high, x_low, x_high = window
+                inverse_flat = inverse_flat[y_low:y_high, x_low:x_high]
+            if inverse_flat is not None:
+                depth = CV_8U if frame.dtype == uint8 else CV_16U
+                out = cv_multiply(frame, inverse_flat, dst=out, dtype=depth)
+            elif out is None:
+                out = frame.copy()
+            elif out is not frame:
+                out[...] = frame
+            self.replace_hot_pixels(out, window)
+            return out
+
         # Case neither darks nor flats are available:
         if self.master_dark_frame_adapted is None and self.inverse_master_flat_frame is None:
             return frame
 
+        dark = self.master_dark_frame_adapted
+        inverse_flat = self.inverse_master_flat_frame
+        if window is not None:
+            y_low, y_high, x_low, x_high = window
+            if dark is not None:
+                dark = dark[y_low:y_high, x_low:x_high]
+            if inverse_flat is not None:
+                inverse_flat = inverse_flat[y_low:y_high, x_low:x_high]
+        depth = CV_8U if frame.dtype == uint8 else CV_16U
+
         # Case only flats are available:
-        elif self.master_dark_frame_adapted is None:
-            return (frame * self.inverse_master_flat_frame).astype(self.dtype)
+        if dark is None:
+            return cv_multiply(frame, inverse_flat, dst=out, dtype=depth)
 
         # Case only darks are available:
-        elif self.inverse_master_flat_frame is None:
-            return where(frame > self.master_dark_frame_adapted,
-                         frame - self.master_dark_frame_adapted, 0)
+        elif inverse_flat is None:
+            return cv_subtract(frame, dark, dst=out)
 
-        # Case both darks and flats are available:
+        # Case both darks and flats are available: The difference is computed in the output
+        # array, and then multiplied in place.
         else:
-            return clip(
-                (frame - self.master_dark_frame_adapted) * self.inverse_master_flat_frame,
-                0., self.high_value).astype(self.dtype)
+            out = cv_subtract(frame, dark, dst=out)
+            return cv_multiply(out, inverse_flat, dst=out, dtype=depth)
 
 
 class Frames(object):
@@ -1057,7 +2426,8 @@ class Frames(object):
             - Frame stacking ("stack_frames.stack_frames")
         2. Monochrome version of 1., type: uint8 / uint16
             - Computing the average frame (only average frame subset, "align_frames.average_frame")
-        3. Gaussian blur added to 2., type: type: uint16
+        3. Gaussian blur added to 2., type: type: uint16 (stored as uint8 for 8bit input if
+           "frames_gaussian_8bit" is set, and widened to uint16 on access)
             - Aligning all frames ("align_frames.align_frames")
             - Frame stacking ("stack_frames.stack_frames")
         4. Down-sampled Laplacian of 3., type: uint8
@@ -1089,8 +2459,9 @@ class Frames(object):
         as single images in a directory.
 
         :param configuration: Configuration object with parameters
-        :param names: In case "video": name of the video file. In case "image": list of names for
-                      all images.
+        :param names: In case "video": name of the video file, or list of names of video files
+                      which are segments of one recording session. In case "image": list of names
+                      for all images.
         :param type: Either "video" or "image".
         :param bayer_option_selected: Bayer pattern, one out of: "Auto detect color", "Grayscale",
                               "RGB", "BGR", "Force Bayer RGGB", "Force Bayer GRBG",
@@ -1116,17 +2487,40 @@ class Frames(object):
         self.buffer_monochrome = None
         self.buffer_gaussian = None
         self.buffer_laplacian = None
-        self.set_buffering(buffering_level)
 
-        # In non-buffered mode, the index of the image just read/computed is stored for re-use.
-        self.original_available = None
-        self.original_available_index = -1
-        self.monochrome_available = None
-        self.monochrome_available_index = -1
-        self.gaussian_available = None
-        self.gaussian_available_index = -1
-        self.laplacian_available = None
-        self.laplacian_available_index = None
+        # The buffering selected for the job, as fractions of frames per variant. Later workflow
+        # phases may reduce it (see "retain_frames"). It is restored if the workflow is repeated.
+        self.buffering_selected = None
+        self.partial_buffering_ranked = {}
+
+        # In non-buffered mode, the images read/computed most recently are kept for re-use in an
+        # LRU cache per image variant. With the default budget of 0 bytes only the last image is
+        # kept.
+        cache_budget_bytes = self.configuration.frames_cache_budget_mbytes * 1e6
+        self.original_cache = FrameCache('original', cache_budget_bytes)
+        self.monochrome_cache = FrameCache('monochrome', cache_budget_bytes)
+        self.gaussian_cache = FrameCache('gaussian', cache_budget_bytes)
+        self.laplacian_cache = FrameCache('laplacian', cache_budget_bytes)
+
+        # If frames are read ahead in a background thread, this is the prefetcher object.
+        self.prefetcher = None
+
+        # If buffers do not fit into RAM, they can be kept in memory-mapped scratch files in this
+        # directory.
+        self.spill_directory = None
+
+        # For planetary videos, frames can be cropped to a base window (y_low, y_high, x_low,
+        # x_high) around the object right after opening. After a ROI is set, frames can be
+        # restricted further to a window which contains the ROI in all frames. Its coordinates
+        # refer to the (base-cropped) frames. If the windows are cut out by the reader, the flag
+        # "reader_window_active" is set.
+        self.base_window = None
+        self.window = None
+        self.shape_full = None
+        self.reader_window_active = False
+
+        # If frame buffers are compressed, the compression ratio is estimated with the first frame.
+        self.compression_ratio = None
 
         # Set a flag that no monochrome image has been computed before.
         self.first_monochrome = True
@@ -1143,6 +2537,8 @@ class Frames(object):
         # Initialize and open the reader object.
         if self.type == 'image':
             self.reader = ImageReader(self.configuration)
+        elif self.type == 'video' and isinstance(self.names, list):
+            self.reader = VirtualVideoReader(self.configuration)
         elif self.type == 'video':
             self.reader = VideoReader(self.configuration)
         else:
@@ -1150,6 +2546,7 @@ class Frames(object):
 
         self.number, self.color, self.dt0, self.shape, self.shift_pixels = self.reader.open(self.names,
             bayer_option_selected=self.bayer_option_selected)
+        self.reader_open = True
         self.warn_message = self.reader.warn_message
 
         # Look up the Bayer pattern the reader has identified.
@@ -1163,49 +2560,715 @@ class Frames(object):
         else:
             raise TypeError("Frame type " + str(self.dt0) + " not supported")
 
-        # Check if the darks / flats of the calibration object match the current reader.
+        # For 8bit input the Gaussian-blurred frames can be stored with 8bit as well. This halves
+        # the memory for this variant. They are widened to 16bit when they are accessed.
+        self.gaussian_8bit = self.configuration.frames_gaussian_8bit and self.depth == 8
+
+        # Check if the darks / flats of the calibration object match the current reader. If they
+        # do not match, matching master frames may be selected from the calibration library.
+        # For Bayer-encoded video input, single-plane masters with the shape of the raw frames are
+        # raw CFA masters. They are applied by the reader before debayering.
         if self.calibration:
+            if self.reader.raw_cfa_available():
+                raw_shape = self.shape[:2]
+            else:
+                raw_shape = None
+            self.calibration.select_masters(self.color, self.shape, raw_shape=raw_shape)
             self.calibration_matches = self.calibration.flats_darks_match(self.color, self.shape)
+            self.calibration_raw = not self.calibration_matches and raw_shape is not None and \
+                                   self.calibration.flats_darks_match(False, raw_shape)
             # If there are matching darks or flats, adapt their type to the current frame type.
-            if self.calibration_matches:
+            if self.calibration_matches or self.calibration_raw:
                 self.calibration.adapt_dark_frame(self.dt0, self.shift_pixels)
+            if self.calibration_raw:
+                self.reader.set_calibration(self.calibration)
         else:
             self.calibration_matches = False
+            self.calibration_raw = False
+
+        # For Bayer-encoded video input, buffer the raw single-plane CFA frames instead of the
+        # debayered color frames, if requested. Frames are debayered on demand. This mode is not
+        # available with masters for debayered frames, but with raw CFA masters.
+        self.raw_cfa = self.configuration.frames_raw_cfa_buffering and \
+                       self.reader.raw_cfa_available() and not self.calibration_matches
+        if self.raw_cfa:
+            self.reader.set_raw_output(True)
+            # OpenCV's Bayer codes produce BGR ordered output which PSS interprets as RGB. The
+            # gray conversion code with the complementary pattern applies the luma weights to the
+            # channels in the same way as "cvtColor(frame, COLOR_RGB2GRAY)" on the debayered frame.
+            self.cfa_gray_code = {'Force Bayer RGGB': COLOR_BayerBG2GRAY,
+                                  'Force Bayer GRBG': COLOR_BayerGB2GRAY,
+                                  'Force Bayer GBRG': COLOR_BayerGR2GRAY,
+                                  'Force Bayer BGGR': COLOR_BayerRG2GRAY}[self.bayer_pattern]
+
+        # Initialize an index translation list which is used later to exclude a subset of indices
+        # in the stacking workflow. Initially, all indices are included.
+        self.number_original = self.number
+        self.index_translation = [item for item in range(self.number_original)]
+        self.index_included = [True] * self.number_original
+
+        # Initialize lists of monochrome frames (with and without Gaussian blur) and their
+        # Laplacians.
+        colors = ['red', 'green', 'blue', 'panchromatic']
+        if self.configuration.frames_mono_channel in colors:
+            self.color_index = colors.index(self.configuration.frames_mono_channel)
+        else:
+            raise ArgumentError("Invalid color selected for channel extraction")
+        # The buffers are allocated when the buffering is set.
+        self.set_buffering(buffering_level)
+        if self.configuration.frames_normalization:
+            self.frames_average_brightness = [None] *self.number_original
+        else:
+            self.frames_average_brightness = None
+        self.first_monochrome_index = None
+        self.used_alignment_points = None
+
+        # If requested, open the persistent on-disk cache of derived per-frame data.
+        self.sidecar_cache = None
+        if self.configuration.frames_sidecar_cache:
+            self.open_sidecar_cache()
+
+    def open_sidecar_cache(self):
+        """
+        Open the persistent sidecar cache next to the input file(s), and register the products
+        stored there: Gaussian-blurred frames, downsampled Laplacians, average brightness values
+        and frame ranks. Each product is keyed on the parameters which affect its values. Average
+        brightness values stored by a previous run are copied into the brightness list.
+
+        If the cache cannot be opened (e.g. because the input is on read-only media), the cache is
+        not used.
+
+        :return: -
+        """
+
+        try:
+            self.sidecar_cache = SidecarCache(self.names, self.number_original, type=self.type)
+        except (OSError, ValueError):
+            self.sidecar_cache = None
+            return
+
+        # Parameters which affect all products: Debayering, channel extraction and calibration.
+        if self.calibration_matches or self.calibration_raw:
+            calibration_fingerprint = self.calibration.fingerprint()
+        else:
+            calibration_fingerprint = None
+        parameters = {'bayer_pattern': str(self.bayer_pattern),
+                      'debayer_method': self.configuration.frames_debayering_method,
+                      'mono_channel': self.configuration.frames_mono_channel,
+                      'shift_pixels': int(self.shift_pixels) if self.shift_pixels else 0,
+                      'calibration': calibration_fingerprint,
+                      'raw_cfa': self.raw_cfa,
+                      'window': list(self.base_window) if self.base_window is not None else None}
+
+        brightness_parameters = dict(parameters, normalization_threshold=
+                                     self.configuration.frames_normalization_threshold)
+        self.sidecar_cache.register('brightness', brightness_parameters, (), float64)
+
+        parameters['gauss_width'] = self.configuration.frames_gauss_width
+        parameters['gaussian_8bit'] = self.gaussian_8bit
+        self.sidecar_cache.register('gaussian', parameters, self.shape[:2],
+                                    self.variant_shape_dtype('gaussian')[1])
+
+        stride = self.configuration.align_frames_sampling_stride
+        parameters['sampling_stride'] = stride
+        self.sidecar_cache.register('laplacian', parameters,
+                                    (int(ceil(self.shape[0] / stride)),
+                                     int(ceil(self.shape[1] / stride))), uint8)
+
+        rank_parameters = dict(brightness_parameters, **parameters)
+        rank_parameters['rank_method'] = self.configuration.rank_frames_method
+        rank_parameters['rank_pixel_stride'] = self.configuration.rank_frames_pixel_stride
+        rank_parameters['normalization'] = self.configuration.frames_normalization
+        self.sidecar_cache.register('frame_ranks', rank_parameters, (), float64)
+
+        if self.frames_average_brightness is not None:
+            for index in range(self.number_original):
+                brightness = self.sidecar_cache.get('brightness', index)
+                if brightness is not None:
+                    self.frames_average_brightness[index] = float(brightness)
+
+    def close_sidecar_cache(self):
+        """
+        Write pending changes of the sidecar cache to disk and close it.
+
+        :return: -
+        """
+
+        if self.sidecar_cache is not None:
+            self.sidecar_cache.close()
+            self.sidecar_cache = None
+
+    def sidecar_lookup(self, product, index_original):
+        """
+        Look up a product entry in the sidecar cache.
+
+        :param product: Name of the product, e.g. 'gaussian'.
+        :param index_original: Original frame index (without index translation)
+        :return: Stored entry, or None if the cache is not active or the entry is not stored.
+        """
+
+        if self.sidecar_cache is None:
+            return None
+        value = self.sidecar_cache.get(product, index_original)
+
+        # Frame variants are stored for frames without a ROI window. If a window is set, cut it
+        # out.
+        if value is not None and self.window is not None and product in ['gaussian', 'laplacian']:
+            value = self.crop_variant(product, value, self.window)
+        return value
+
+    def sidecar_store(self, product, index_original, value):
+        """
+        Store a product entry in the sidecar cache, if the cache is active.
+
+        :param product: Name of the product, e.g. 'gaussian'.
+        :param index_original: Original frame index (without index translation)
+        :param value: Entry to be stored.
+        :return: -
+        """
+
+        # Frame variants restricted to a ROI window do not fit into the cache.
+        if self.window is not None and product in ['gaussian', 'laplacian']:
+            return
+        if self.sidecar_cache is not None:
+            self.sidecar_cache.put(product, index_original, value)
+
+    def sidecar_lookup_all(self, product):
+        """
+        Look up the entries of a product for all frames in the sidecar cache.
+
+        :param product: Name of the product, e.g. 'frame_ranks'.
+        :return: Array with all entries, or None if the cache is not active or the product is
+                 not complete.
+        """
+
+        if self.sidecar_cache is None:
+            return None
+        return self.sidecar_cache.get_all(product)
+
+    def sidecar_store_all(self, product, values):
+        """
+        Store the entries of a product for all frames in the sidecar cache, if it is active.
+
+        :param product: Name of the product, e.g. 'frame_ranks'.
+        :param values: Sequence with one entry per frame.
+        :return: -
+        """
+
+        if self.sidecar_cache is not None:
+            self.sidecar_cache.put_all(product, values)
+
+    def set_buffering(self, buffering_level):
+        """
+        Set the buffering flags for original image data and its variants depending on the buffering
+        level selected.
+
+        :param buffering_level: Level of buffering for image data and variants.
+        :return: -
+        """
+
+        self.buffer_original, self.buffer_monochrome, self.buffer_gaussian, self.buffer_laplacian =\
+            Frames.decide_buffering(buffering_level)
+        self.buffering_selected = {variant: float(getattr(self, 'buffer_' + variant)) for variant
+                                   in ['original', 'monochrome', 'gaussian', 'laplacian']}
+        self.partial_buffering = {}
+        self.partial_buffering_indices = {}
+        self.partial_buffering_ranked = {}
+        self.allocate_buffers()
+
+    def set_buffering_plan(self, fractions):
+        """
+        Set the buffering for original image data and its variants as specified by a buffering
+        plan. A variant is either buffered for all frames (fraction 1.), not at all (fraction 0.),
+        or for the best frames only. Since the quality ranking is not known before ranking, the
+        partially buffered frames are selected by "set_partial_buffering" after ranking.
+
+        :param fractions: Dictionary which for 'original', 'monochrome', 'gaussian' and
+                          'laplacian' gives the fraction of frames to be buffered (0. - 1.).
+        :return: -
+        """
+
+        self.buffer_original = fractions['original'] >= 1.
+        self.buffer_monochrome = fractions['monochrome'] >= 1.
+        self.buffer_gaussian = fractions['gaussian'] >= 1.
+        self.buffer_laplacian = fractions['laplacian'] >= 1.
+        self.buffering_selected = dict(fractions)
+        self.partial_buffering = {variant: fraction for variant, fraction in fractions.items() if
+                                  0. < fraction < 1.}
+        self.partial_buffering_indices = {}
+        self.partial_buffering_ranked = {}
+        self.allocate_buffers()
+
+    def use_spill_buffers(self, directory):
+        """
+        Keep the buffers for original frames, Gaussians and Laplacians in pre-allocated
+        memory-mapped scratch files instead of RAM. All three variants are buffered for all frames
+        (as with buffering level 3). Monochrome frames are not buffered. This method must be
+        called before any frame is accessed.
+
+        :param directory: Directory for the scratch files (should be on a fast local disk).
+        :return: List with the names of the variants kept in scratch files.
+        """
+
+        self.spill_directory = directory
+        self.set_buffering(3)
+        return [variant for variant in ['original', 'monochrome', 'gaussian', 'laplacian'] if
+                getattr(self, 'buffer_' + variant)]
+
+    def allocate_buffers(self):
+        """
+        Create the (empty) buffers for the monochrome, Gaussian and Laplacian frame variants
+        according to the buffering flags. The buffer for original frames is created when the
+        first frame is accessed. This method is called when the buffering is set, before any frame
+        is accessed.
+
+        :return: -
+        """
+
+        self.frames_monochrome = self.create_buffer('monochrome')
+        self.frames_monochrome_blurred = self.create_buffer('gaussian')
+        self.frames_monochrome_blurred_laplacian = self.create_buffer('laplacian')
+
+    def release_variant(self, variant):
+        """
+        A workflow phase does not need a frame variant any more. Free its buffer in one piece and
+        stop buffering it. Should the variant be accessed again, it is re-computed on demand.
+
+        :param variant: One out of 'original', 'monochrome', 'gaussian', 'laplacian'.
+        :return: -
+        """
+
+        attribute = {'original': 'frames_original', 'monochrome': 'frames_monochrome',
+                     'gaussian': 'frames_monochrome_blurred',
+                     'laplacian': 'frames_monochrome_blurred_laplacian'}[variant]
+        buffer = getattr(self, attribute)
+        if isinstance(buffer, FrameBuffer):
+            buffer.release()
+        setattr(self, 'buffer_' + variant, False)
+        self.partial_buffering.pop(variant, None)
+        self.partial_buffering_indices.pop(variant, None)
+        if buffer is not None:
+            setattr(self, attribute, [None] * self.number_original)
+        getattr(self, variant + '_cache').clear()
+
+    def retain_frames(self, variants):
+        """
+        A workflow phase declares which frame variants it still needs, and for which frames.
+        Everything else is freed at once: Variants which are not listed are released completely.
+        For the variants listed with a frame subset, all other frames are removed from the buffer
+        and the LRU cache, and they are not buffered again if they should be re-computed later.
+
+        :param variants: Dictionary which for each variant still needed ('original', 'monochrome',
+                         'gaussian', 'laplacian') gives the frame indices needed (translated
+                         indices if index translation is active), or None if all frames are
+                         needed.
+        :return: -
+        """
+
+        for variant in ['original', 'monochrome', 'gaussian', 'laplacian']:
+            if variant not in variants:
+                self.release_variant(variant)
+            elif variants[variant] is not None:
+                if self.index_translation_active:
+                    indices_original = set(self.index_translation[index] for index in
+                                           variants[variant])
+                else:
+                    indices_original = set(variants[variant])
+                self.retain_variant_frames(variant, indices_original)
+
+    def retain_variant_frames(self, variant, indices_original):
+        """
+        Keep a frame variant only for a subset of frames. Frames not in the subset are removed from
+        the buffer and the LRU cache. A frame arena in RAM cannot return parts of its memory, so
+        the frames kept are copied into a list, and the arena is released as a whole.
+
+        :param variant: One out of 'original', 'monochrome', 'gaussian', 'laplacian'.
+        :param indices_original: Set of original frame indices (without index translation) to be
+                                 kept.
+        :return: -
+        """
+
+        attribute = {'original': 'frames_original', 'monochrome': 'frames_monochrome',
+                     'gaussian': 'frames_monochrome_blurred',
+                     'laplacian': 'frames_monochrome_blurred_laplacian'}[variant]
+        buffer = getattr(self, attribute)
+        cache = getattr(self, variant + '_cache')
+
+        for index_original in list(cache.frames):
+            if index_original not in indices_original:
+                cache.remove(index_original)
+
+        if isinstance(buffer, FrameArena) and not isinstance(buffer, SpillBuffer):
+            frames_kept = [None] * self.number_original
+            for index_original in indices_original:
+                frame = buffer[index_original]
+                if frame is not None:
+                    frames_kept[index_original] = frame.copy()
+            buffer.release()
+            setattr(self, attribute, frames_kept)
+        elif buffer is not None:
+            for index_original in range(self.number_original):
+                if index_original not in indices_original:
+                    buffer[index_original] = None
+
+        # From now on, buffer only the frames kept. If the original frames have not been read yet,
+        # this avoids reading the other frames at all.
+        if getattr(self, 'buffer_' + variant):
+            setattr(self, 'buffer_' + variant, False)
+            self.partial_buffering_indices[variant] = set(indices_original)
+        elif variant in self.partial_buffering_indices:
+            self.partial_buffering_indices[variant] &= indices_original
+
+    def restore_buffering(self):
+        """
+        Undo the reductions of "retain_frames": Buffer all frame variants again as selected with
+        "set_buffering" or "set_buffering_plan". This is called when the workflow is repeated
+        from an earlier phase (e.g. with "Go back to" in the GUI), which may need variants
+        released by a later phase. Frames still buffered are kept, all others are read or
+        computed again when they are accessed.
+
+        :return: -
+        """
+
+        if self.buffering_selected is None:
+            return
+
+        self.stop_prefetching()
+        for variant, attribute in [('original', 'frames_original'),
+                                   ('monochrome', 'frames_monochrome'),
+                                   ('gaussian', 'frames_monochrome_blurred'),
+                                   ('laplacian', 'frames_monochrome_blurred_laplacian')]:
+            if self.buffering_selected[variant] < 1. or getattr(self, 'buffer_' + variant):
+                continue
+            setattr(self, 'buffer_' + variant, True)
+
+            # The original frames are read when the first one is accessed. Until then there is no
+            # buffer. Spill and compressed buffers are kept by "retain_frames". Frames kept in a
+            # list are moved into a new buffer for all frames.
+            buffer = getattr(self, attribute)
+            if buffer is None or isinstance(buffer, FrameBuffer):
+                continue
+            buffer_restored = self.create_buffer(variant)
+            for index_original, frame in enumerate(buffer):
+                if frame is not None:
+                    buffer_restored[index_original] = frame
+            setattr(self, attribute, buffer_restored)
+
+        self.partial_buffering = {variant: fraction for variant, fraction in
+                                  self.buffering_selected.items() if 0. < fraction < 1.}
+        self.partial_buffering_indices = {variant: set(indices) for variant, indices in
+                                          self.partial_buffering_ranked.items()}
+
+    def release_buffers(self):
+        """
+        Free all frame arenas and delete the scratch files of spill buffers.
+
+        :return: -
+        """
+
+        for buffer in [self.frames_original, self.frames_monochrome, self.frames_monochrome_blurred,
+                       self.frames_monochrome_blurred_laplacian]:
+            if isinstance(buffer, FrameBuffer):
+                buffer.release()
+
+    def variant_shape_dtype(self, variant):
+        """
+        Look up the shape and type of a single frame for the original frames and all variants.
+
+        :param variant: One out of 'original', 'monochrome', 'gaussian', 'laplacian'.
+        :return: Tuple (shape, dtype)
+        """
+
+        if variant == 'original':
+            if self.raw_cfa:
+                return self.shape[:2], self.dt0
+            return self.shape, self.dt0
+        elif variant == 'monochrome':
+            return self.shape[:2], self.dt0
+        elif variant == 'gaussian':
+            if self.gaussian_8bit:
+                return self.shape[:2], uint8
+            return self.shape[:2], uint16
+        elif variant == 'laplacian':
+            stride = self.configuration.align_frames_sampling_stride
+            return (int(ceil(self.shape[0] / stride)), int(ceil(self.shape[1] / stride))), uint8
+        else:
+            raise ArgumentError("Invalid frame variant " + str(variant) + " specified")
+
+    def create_buffer(self, variant):
+        """
+        Create an empty buffer for a frame variant, indexed with the original frame index. If
+        spilling to disk is active and the variant is buffered, it is a spill buffer. If buffer
+        compression is selected, original and monochrome frames are kept in a compressed buffer.
+        Otherwise, if the variant is buffered for all frames, it is a contiguous frame arena. In
+        all other cases it is a Python list.
+
+        :param variant: One out of 'original', 'monochrome', 'gaussian', 'laplacian'.
+        :return: Buffer object
+        """
+
+        shape, dtype = self.variant_shape_dtype(variant)
+        if self.spill_directory is not None and getattr(self, 'buffer_' + variant):
+            return SpillBuffer(self.spill_directory, self.number_original, shape, dtype)
+        elif self.configuration.frames_buffer_compression and \
+                variant in ['original', 'monochrome']:
+            return CompressedFrameBuffer(self.number_original, shape, dtype,
+                                         codec=self.configuration.frames_buffer_compression,
+                                         level=self.configuration.frames_buffer_compression_level)
+        elif self.configuration.frames_arena_buffers and getattr(self, 'buffer_' + variant):
+            return FrameArena(self.number_original, shape, dtype)
+        return [None] * self.number_original
+
+    def set_window(self, y_low, y_high, x_low, x_high):
+        """
+        Restrict all frames to a window. From now on, the original frames and all variants are
+        returned for this window only, and the frame shape is the window shape. Frames which are
+        buffered already are cropped, so that the memory of the full frames is released. Frames
+        read later are cropped as they are read. Video readers (SER files, OpenCV videos and
+        segmented captures) cut out the window themselves, and calibration is then restricted to
+        the window as well (for SER files, only the rows inside the window are read). Frames read
+        from image files are read in full size and cropped afterwards.
+
+        Window coordinates refer to the frames as returned by this object, i.e. after cropping
+        to the base window (if set). For the Laplacians (which are down-sampled with the alignment
+        sampling stride) to be consistent, the lower window bounds must be multiples of the
+        stride. For raw CFA frames they must also be even, so that the Bayer pattern is unchanged.
+
+        :param y_low: Lower y pixel bound
+        :param y_high: Upper y pixel bound
+        :param x_low: Lower x pixel bound
+        :param x_high: Upper x pixel bound
+        :return: -
+        """
+
+        if self.window is not None:
+            self.reset_window()
+
+        # Frames read ahead have full size.
+        self.stop_prefetching()
+
+        self.shape_full = self.shape
+        self.window = (y_low, y_high, x_low, x_high)
+        self.shape = (y_high - y_low, x_high - x_low) + tuple(self.shape_full[2:])
+
+        # Crop all buffered frames. The buffers are allocated with the new shape.
+        for variant, attribute in [('original', 'frames_original'),
+                                   ('monochrome', 'frames_monochrome'),
+                                   ('gaussian', 'frames_monochrome_blurred'),
+                                   ('laplacian', 'frames_monochrome_blurred_laplacian')]:
+            buffer = getattr(self, attribute)
+            if buffer is None:
+                continue
+            if isinstance(buffer, FrameBuffer):
+                buffer_cropped = self.create_buffer(variant)
+            else:
+                buffer_cropped = [None] * self.number_original
+            for index_original in range(self.number_original):
+                frame = buffer[index_original]
+                if frame is not None:
+                    buffer_cropped[index_original] = self.crop_variant(variant, frame,
+                                                                       self.window).copy()
+            if isinstance(buffer, FrameBuffer):
+                buffer.release()
+            setattr(self, attribute, buffer_cropped)
+
+        # Cached frames have full size.
+        for cache in [self.original_cache, self.monochrome_cache, self.gaussian_cache,
+                      self.laplacian_cache]:
+            cache.clear()
+
+        self.update_reader_window()
+
+    def reset_window(self):
+        """
+        Remove the restriction of frames to a window. Buffered (cropped) frames are discarded, so
+        that frames are read and computed anew.
+
+        :return: -
+        """
+
+        if self.window is None:
+            return
+
+        self.stop_prefetching()
+        self.window = None
+        self.shape = self.shape_full
+        self.update_reader_window()
+
+        self.release_buffers()
+        self.frames_original = None
+        self.allocate_buffers()
+        for cache in [self.original_cache, self.monochrome_cache, self.gaussian_cache,
+                      self.laplacian_cache]:
+            cache.clear()
+
+    def set_base_window(self, y_low, y_high, x_low, x_high):
+        """
+        Crop all frames to a base window (e.g. around a planet) for the entire workflow. This
+        method is called after the Frames object is created, before frames are processed. Since
+        the frame shape changes, the buffering has to be decided afterwards. The bounds must obey
+        the same alignment rules as for "set_window".
+
+        :param y_low: Lower y pixel bound
+        :param y_high: Upper y pixel bound
+        :param x_low: Lower x pixel bound
+        :param x_high: Upper x pixel bound
+        :return: -
+        """
+
+        self.reset_window()
+        self.stop_prefetching()
+        self.release_buffers()
+
+        self.base_window = (y_low, y_high, x_low, x_high)
+        self.shape = (y_high - y_low, x_high - x_low) + tuple(self.shape[2:])
+        self.compression_ratio = None
+        self.frames_original = None
+        self.allocate_buffers()
+        for cache in [self.original_cache, self.monochrome_cache, self.gaussian_cache,
+                      self.laplacian_cache]:
+            cache.clear()
+        self.update_reader_window()
+
+        # Brightness values depend on the frame area.
+        if self.frames_average_brightness is not None:
+            self.frames_average_brightness = [None] * self.number_original
+        self.first_monochrome = True
+
+        # Products in the sidecar cache are keyed on the base window.
+        if self.sidecar_cache is not None:
+            self.close_sidecar_cache()
+            self.open_sidecar_cache()
+
+    def effective_window(self):
+        """
+        Combine the base window and the ROI window.
+
+        :return: Window (y_low, y_high, x_low, x_high) in coordinates of the full frames as read
+                 from the input, or None if no window is set.
+        """
+
+        if self.base_window is None:
+            return self.window
+        if self.window is None:
+            return self.base_window
+        return (self.base_window[0] + self.window[0], self.base_window[0] + self.window[1],
+                self.base_window[2] + self.window[2], self.base_window[2] + self.window[3])
+
+    def update_reader_window(self):
+        """
+        Let the reader cut out the effective window. Calibration is then restricted to the window
+        as well.
+
+        :return: -
+        """
+
+        window = self.effective_window()
+        self.reader_window_active = window is not None and \
+                                    isinstance(self.reader, (VideoReader, VirtualVideoReader))
+        if self.reader_open:
+            if self.reader_window_active:
+                self.reader.set_window(window)
+            elif isinstance(self.reader, (VideoReader, VirtualVideoReader)):
+                self.reader.set_window(None)
+
+    def crop_variant(self, variant, frame, window):
+        """
+        Cut a window out of a frame variant.
+
+        :param variant: One out of 'original', 'monochrome', 'gaussian', 'laplacian'.
+        :param frame: Frame variant
+        :param window: Window (y_low, y_high, x_low, x_high) in coordinates of the frame
+        :return: View of the window
+        """
+
+        y_low, y_high, x_low, x_high = window
+        if variant == 'laplacian':
+            stride = self.configuration.align_frames_sampling_stride
+            return frame[y_low // stride:y_low // stride + int(ceil((y_high - y_low) / stride)),
+                         x_low // stride:x_low // stride + int(ceil((x_high - x_low) / stride))]
+        return frame[y_low:y_high, x_low:x_high]
+
+    def crop_original(self, frame):
+        """
+        Cut the effective window out of a frame delivered by the reader, unless the reader has
+        done it.
 
-        # Initialize an index translation list which is used later to exclude a subset of indices
-        # in the stacking workflow. Initially, all indices are included.
-        self.number_original = self.number
-        self.index_translation = [item for item in range(self.number_original)]
-        self.index_included = [True] * self.number_original
+        :param frame: Frame delivered by the reader (after calibration)
+        :return: Frame restricted to the window
+        """
 
-        # Initialize lists of monochrome frames (with and without Gaussian blur) and their
-        # Laplacians.
-        colors = ['red', 'green', 'blue', 'panchromatic']
-        if self.configuration.frames_mono_channel in colors:
-            self.color_index = colors.index(self.configuration.frames_mono_channel)
-        else:
-            raise ArgumentError("Invalid color selected for channel extraction")
-        self.frames_monochrome = [None] * self.number_original
-        self.frames_monochrome_blurred = [None] *self.number_original
-        self.frames_monochrome_blurred_laplacian = [None] *self.number_original
-        if self.configuration.frames_normalization:
-            self.frames_average_brightness = [None] *self.number_original
-        else:
-            self.frames_average_brightness = None
-        self.first_monochrome_index = None
-        self.used_alignment_points = None
+        window = self.effective_window()
+        if window is None or self.reader_window_active:
+            return frame
+        return self.crop_variant('original', frame, window).copy()
 
-    def set_buffering(self, buffering_level):
+    def set_partial_buffering(self, quality_sorted_indices_original):
         """
-        Set the buffering flags for original image data and its variants depending on the buffering
-        level selected.
+        After ranking, select the frames to be buffered for variants which are buffered partially.
+        These are the best frames according to the ranking.
 
-        :param buffering_level: Level of buffering for image data and variants.
+        :param quality_sorted_indices_original: List of original frame indices, sorted in
+                                                descending order of frame quality.
         :return: -
         """
 
-        self.buffer_original, self.buffer_monochrome, self.buffer_gaussian, self.buffer_laplacian =\
-            Frames.decide_buffering(buffering_level)
+        for variant, fraction in self.partial_buffering.items():
+            number_buffered = int(ceil(fraction * self.number_original))
+            self.partial_buffering_indices[variant] = set(
+                quality_sorted_indices_original[:number_buffered])
+        self.partial_buffering_ranked = {variant: set(indices) for variant, indices in
+                                         self.partial_buffering_indices.items()}
+
+    def buffered(self, variant, index_original):
+        """
+        Decide if a frame variant is to be buffered for a given frame.
+
+        :param variant: One out of 'original', 'monochrome', 'gaussian', 'laplacian'.
+        :param index_original: Original frame index (without index translation)
+        :return: True, if the variant is buffered for this frame. False otherwise.
+        """
+
+        if getattr(self, 'buffer_' + variant):
+            return True
+        indices = self.partial_buffering_indices.get(variant)
+        return indices is not None and index_original in indices
+
+    def probe_costs(self, number_samples):
+        """
+        Measure the average time needed to read a frame and to compute each of its variants from
+        the variant it is derived from. The sample frames are spread evenly over the input. No
+        data are stored in this object.
+
+        :param number_samples: Number of frames to be probed.
+        :return: Dictionary with the time in seconds per frame for 'original', 'monochrome',
+                 'gaussian' and 'laplacian'.
+        """
+
+        number_samples = max(min(number_samples, self.number_original), 1)
+        indices = sorted(set(int(i * self.number_original / number_samples) for i in
+                             range(number_samples)))
+        costs = {'original': 0., 'monochrome': 0., 'gaussian': 0., 'laplacian': 0.}
+
+        for index in indices:
+            time_start = time()
+            frame = self.read_frame_calibrated(index)
+            time_original = time()
+            frame_mono = self.monochrome_from_original(frame)
+            if self.configuration.frames_normalization:
+                cv_mean(frame_mono)
+            time_monochrome = time()
+            frame_blurred = self.gaussian_from_monochrome(frame_mono)
+            time_gaussian = time()
+            self.laplacian_from_gaussian(frame_blurred)
+            time_laplacian = time()
+
+            costs['original'] += time_original - time_start
+            costs['monochrome'] += time_monochrome - time_original
+            costs['gaussian'] += time_gaussian - time_monochrome
+            costs['laplacian'] += time_laplacian - time_gaussian
+
+        return {variant: cost / len(indices) for variant, cost in costs.items()}
 
     @staticmethod
     def decide_buffering(buffering_level):
@@ -1244,6 +3307,78 @@ class Frames(object):
         return buffer_original, buffer_monochrome, buffer_gaussian, buffer_laplacian
 
     def compute_required_buffer_size(self, buffering_level):
+        """
+        Compute the RAM required at a given buffering level.
+
+        :param buffering_level: Buffering level parameter.
+        :return: Number of required buffer space in Gbytes.
+        """
+
+        buffer_original, buffer_monochrome, buffer_gaussian, buffer_laplacian = \
+            Frames.decide_buffering(buffering_level)
+        return self.compute_required_buffer_size_fractions(
+            {'original': float(buffer_original), 'monochrome': float(buffer_monochrome),
+             'gaussian': float(buffer_gaussian), 'laplacian': float(buffer_laplacian)})
+
+    def image_variant_sizes(self):
+        """
+        Compute the size of a single frame in bytes for the original frames and all variants.
+
+        :return: Dictionary with the size in bytes for 'original', 'monochrome', 'gaussian' and
+                 'laplacian'.
+        """
+
+        # Compute the number of image pixels.
+        number_pixel = self.shape[0] * self.shape[1]
+
+        # Compute the size of a monochrome image in bytes.
+        image_size_monochrome_bytes = number_pixel * self.depth / 8
+
+        # Compute the size of an original image in bytes. Raw CFA frames have a single plane.
+        if self.color and not self.raw_cfa:
+            image_size_bytes = 3 * image_size_monochrome_bytes
+        else:
+            image_size_bytes = image_size_monochrome_bytes
+
+        # Compute the size of the monochrome images with Gaussian blur added in bytes.
+        if self.gaussian_8bit:
+            image_size_gaussian_bytes = number_pixel
+        else:
+            image_size_gaussian_bytes = number_pixel * 2
+
+        # Compute the size of a "Laplacian of Gaussian" in bytes. Remember that it is down-sampled.
+        image_size_laplacian_bytes = number_pixel / \
+                                     self.configuration.align_frames_sampling_stride ** 2
+
+        # If original and monochrome frames are compressed, estimate their size from the
+        # compression ratio of the first frame. Add a margin of 25% for frames which compress less
+        # well.
+        if self.configuration.frames_buffer_compression:
+            compressed_fraction = min(1.25 / self.estimate_compression_ratio(), 1.)
+            image_size_bytes *= compressed_fraction
+            image_size_monochrome_bytes *= compressed_fraction
+
+        return {'original': image_size_bytes, 'monochrome': image_size_monochrome_bytes,
+                'gaussian': image_size_gaussian_bytes, 'laplacian': image_size_laplacian_bytes}
+
+    def estimate_compression_ratio(self):
+        """
+        Estimate the compression ratio of buffered frames by compressing the first frame. The
+        result is computed only once.
+
+        :return: Ratio of uncompressed to compressed size
+        """
+
+        if self.compression_ratio is None:
+            shape, dtype = self.variant_shape_dtype('original')
+            buffer = CompressedFrameBuffer(1, shape, dtype,
+                                           codec=self.configuration.frames_buffer_compression,
+                                           level=self.configuration.frames_buffer_compression_level)
+            buffer[0] = self.read_frame_calibrated(0)
+            self.compression_ratio = buffer.compression_ratio()
+        return self.compression_ratio
+
+    def compute_required_buffer_size_fractions(self, fractions):
         """
         Compute the RAM required to store original images and their derivatives, and other objects
         which scale with the image size.
@@ -1265,44 +3400,20 @@ class Frames(object):
             stack_frames.stacked_image: image pixels * colors (uint16)                     2     6
                                                                                           ---------
                                                                   Total (bytes / pixel):  53   111
-        :param buffering_level: Buffering level parameter.
-        :return: Number of required buffer space in bytes.
+        :param fractions: Dictionary which for 'original', 'monochrome', 'gaussian' and
+                          'laplacian' gives the fraction of frames to be buffered (0. - 1.).
+        :return: Number of required buffer space in Gbytes.
         """
 
         # Compute the number of image pixels.
         number_pixel = self.shape[0] * self.shape[1]
 
-        # Compute the size of a monochrome image in bytes.
-        image_size_monochrome_bytes = number_pixel * self.depth / 8
-
-        # Compute the size of an original image in bytes.
-        if self.color:
-            image_size_bytes = 3 * image_size_monochrome_bytes
-        else:
-            image_size_bytes = image_size_monochrome_bytes
-
-        # Compute the size of the monochrome images with Gaussian blur added in bytes.
-        image_size_gaussian_bytes = number_pixel * 2
-
-        # Compute the size of a "Laplacian of Gaussian" in bytes. Remember that it is down-sampled.
-        image_size_laplacian_bytes = number_pixel / \
-                                     self.configuration.align_frames_sampling_stride ** 2
-
-        # Compute the buffer space per image, based on the buffering level.
-        buffer_original, buffer_monochrome, buffer_gaussian, buffer_laplacian = \
-            Frames.decide_buffering(buffering_level)
-        buffer_per_image = 0
-        if buffer_original:
-            buffer_per_image += image_size_bytes
-        if buffer_monochrome:
-            buffer_per_image += image_size_monochrome_bytes
-        if buffer_gaussian:
-            buffer_per_image += image_size_gaussian_bytes
-        if buffer_laplacian:
-            buffer_per_image += image_size_laplacian_bytes
-
-        # Multiply with the total number of frames.
-        buffer_for_all_images = buffer_per_image * self.number_original
+        # Compute the buffer space for all buffered frames, based on the fractions of frames
+        # buffered for each variant.
+        sizes = self.image_variant_sizes()
+        buffer_for_all_images = 0
+        for variant, fraction in fractions.items():
+            buffer_for_all_images += sizes[variant] * int(ceil(fraction * self.number_original))
 
         # Compute the size of additional workspace objects allocated during the workflow. For the
         # details see the comment block at the beginning of this method.
@@ -1311,6 +3422,20 @@ class Frames(object):
         else:
             buffer_additional_workspace = number_pixel * 53
 
+        # If an LRU cache budget is set, frame variants which are not buffered completely are kept
+        # in LRU caches with this byte budget. Without a budget only the last frame is cached, as
+        # in single-slot caching, which is covered by the workspace estimate above.
+        cache_budget_bytes = self.configuration.frames_cache_budget_mbytes * 1e6
+        for variant, fraction in fractions.items():
+            if cache_budget_bytes and fraction < 1.:
+                buffer_additional_workspace += min(cache_budget_bytes,
+                                                   sizes[variant] * self.number_original)
+
+        # Frames read ahead in a background thread are held in a queue.
+        if self.configuration.frames_prefetching:
+            buffer_additional_workspace += (self.configuration.frames_prefetch_queue_size + 1) * \
+                                           sizes['original']
+
         # Return the total buffer space required.
         return (buffer_for_all_images + buffer_additional_workspace) / 1e9
 
@@ -1334,25 +3459,60 @@ class Frames(object):
                 raise ArgumentError("Frame index " + str(index) + " is out of bounds")
             index_original = index
 
+        # In raw CFA mode, the stored frames are debayered on demand. The debayered frames are
+        # kept in the LRU cache.
+        if self.raw_cfa:
+            frame = self.original_cache.get(index_original)
+            if frame is None:
+                frame = debayer_frame(self.frames_stored(index_original),
+                                      debayer_pattern=self.bayer_pattern,
+                                      debayer_method=self.configuration.frames_debayering_method,
+                                      BGR_input=self.reader.BGR_input)
+                self.original_cache.put(index_original, frame)
+            return frame
+
+        return self.frames_stored(index_original)
+
+    def frames_stored(self, index_original):
+        """
+        Read or look up the frame with a given original index in the form delivered by the reader.
+        This is the original frame, or the raw CFA frame in raw CFA mode.
+
+        :param index_original: Original frame index (without index translation)
+        :return: Frame with index "index_original".
+        """
+
         # If the original frames are to be buffered, read them in one go at the first call to this
         # method. In this case, a progress bar is displayed in the main GUI.
         if self.frames_original is None:
             if self.buffer_original:
-                self.frames_original = []
-                self.signal_step_size = max(int(self.number_original / 10), 1)
-                for frame_index in range(self.number_original):
+                self.frames_original = self.create_buffer('original')
+                # Frames excluded from the workflow are not read.
+                index_sequence_loaded = [frame_index for frame_index in
+                                         range(self.number_original) if
+                                         self.index_included[frame_index]]
+                number_loaded = len(index_sequence_loaded)
+                self.signal_step_size = max(int(number_loaded / 10), 1)
+                # Read the frames in a background thread, so that I/O overlaps with the
+                # calibration and storing of frames. If prefetching is switched off, read the
+                # frames as a sequence on this thread (still images are decoded in parallel).
+                self.start_prefetcher(index_sequence_loaded)
+                if self.prefetcher is not None:
+                    frame_iterator = (self.read_frame_original(frame_index) for frame_index in
+                                      index_sequence_loaded)
+                else:
+                    frame_iterator = self.read_frames_calibrated(index_sequence_loaded)
+                for position, (frame_index, frame) in enumerate(
+                        zip(index_sequence_loaded, frame_iterator)):
                     # After every "signal_step_size"th frame, send a progress signal to the main GUI.
-                    if self.progress_signal is not None and frame_index % self.signal_step_size == 1:
+                    if self.progress_signal is not None and position % self.signal_step_size == 1:
                         self.progress_signal.emit("Read all frames",
-                                                  int(round(10 * frame_index / self.number_original) * 10))
-                    # Read the next frame. If dark/flat correction is active, do the corrections.
-                    if self.calibration_matches:
-                        self.frames_original.append(self.calibration.correct(
-                            self.reader.read_frame(frame_index)))
-                    else:
-                        self.frames_original.append(self.reader.read_frame(frame_index))
-
-                self.reader.close()
+                                                  int(round(10 * position / number_loaded) * 10))
+                    # Store the next frame. If dark/flat correction is active, it has been corrected.
+                    self.frames_original[frame_index] = frame
+
+                self.stop_prefetching()
+                self.close_reader()
                 if self.progress_signal is not None:
                     self.progress_signal.emit("Read all frames", 100)
 
@@ -1361,27 +3521,208 @@ class Frames(object):
             else:
                 self.frames_original = [None] * self.number_original
 
-        # The original frames are buffered. Just return the frame.
-        if self.buffer_original:
-            return self.frames_original[index_original]
+        # The frame is buffered. Just return it. If the original frames are buffered, but this
+        # frame is missing (because it was excluded from the workflow when the frames were read),
+        # it is read now.
+        frame = self.frames_original[index_original]
+        if frame is not None:
+            return frame
 
-        # This frame has been cached. Just return it.
-        if self.original_available_index == index_original:
-            return self.original_available
+        # This frame has been cached. Just return it. In raw CFA mode the cache holds debayered
+        # frames, so it is not used here.
+        if not self.raw_cfa:
+            frame = self.original_cache.get(index_original)
+            if frame is not None:
+                return frame
 
         # The frame has not been stored for re-use, read it. If dark/flat correction is active, do
         # the corrections.
+        frame = self.read_frame_original(index_original)
+
+        # Buffer or cache the frame just read.
+        if self.buffered('original', index_original):
+            self.frames_original[index_original] = frame
+        elif not self.raw_cfa:
+            self.original_cache.put(index_original, frame)
+
+        return frame
+
+    def read_frame_calibrated(self, index_original):
+        """
+        Read a frame from the reader object. If dark/flat correction is active, do the corrections.
+
+        :param index_original: Original frame index (without index translation)
+        :return: Frame with index "index_original".
+        """
+
+        self.open_reader()
+        if self.calibration_matches:
+            return self.crop_original(self.calibration.correct(
+                self.reader.read_frame(index_original), window=self.calibration_window()))
         else:
+            return self.crop_original(self.reader.read_frame(index_original))
+
+    def calibration_window(self):
+        """
+        Look up the window of the master frames which corresponds to the frames delivered by the
+        reader.
+
+        :return: Window (y_low, y_high, x_low, x_high), or None if the reader delivers full frames.
+        """
+
+        if self.reader_window_active:
+            return self.effective_window()
+        return None
+
+    def open_reader(self):
+        """
+        Make sure that the reader object is open. After all frames have been read into the buffer,
+        the reader is closed. If frames are needed again later (e.g. frames which were excluded
+        from the workflow before and are included again), the reader is re-opened.
+
+        :return: -
+        """
+
+        if not self.reader_open:
+            self.reader.open(self.names, bayer_option_selected=self.bayer_option_selected)
+            if self.raw_cfa:
+                self.reader.set_raw_output(True)
+            if self.reader_window_active:
+                self.reader.set_window(self.effective_window())
+            self.reader_open = True
+
+    def close_reader(self):
+        """
+        Close the reader object.
+
+        :return: -
+        """
+
+        if self.reader_open:
+            self.reader.close()
+            self.reader_open = False
+
+    def read_frames_calibrated(self, index_sequence_original):
+        """
+        Read a sequence of frames from the reader object. If dark/flat correction is active, do the
+        corrections.
+
+        :param index_sequence_original: Sequence of original frame indices
+        :return: Generator which yields the frames in the order of "index_sequence_original".
+        """
+
+        self.open_reader()
+        window = self.calibration_window()
+        for frame in self.reader.read_frames(index_sequence_original):
             if self.calibration_matches:
-                frame = self.calibration.correct(self.reader.read_frame(index_original))
+                yield self.crop_original(self.calibration.correct(frame, window=window))
             else:
-                frame = self.reader.read_frame(index_original)
+                yield self.crop_original(frame)
 
-            # Cache the frame just read.
-            self.original_available = frame
-            self.original_available_index = index_original
+    def read_frame_original(self, index_original):
+        """
+        Get a (calibrated) frame from the prefetcher, if it has read the frame ahead. Otherwise, read
+        it directly. If the access does not follow the sequence announced to the prefetcher, the
+        prefetcher is stopped before the reader is used on this thread.
 
-            return frame
+        :param index_original: Original frame index (without index translation)
+        :return: Frame with index "index_original".
+        """
+
+        if self.prefetcher is not None:
+            frame = self.prefetcher.get(index_original)
+            if frame is not None:
+                return frame
+            self.stop_prefetching()
+
+        return self.read_frame_calibrated(index_original)
+
+    def start_prefetcher(self, index_sequence_original):
+        """
+        Start reading frames ahead in a background thread. A prefetcher still active is stopped.
+
+        :param index_sequence_original: Sequence of original frame indices in the order in which
+                                        they will be accessed.
+        :return: -
+        """
+
+        self.stop_prefetching()
+        if self.configuration.frames_prefetching and index_sequence_original:
+            self.prefetcher = FramePrefetcher(self.read_frames_calibrated,
+                                              index_sequence_original,
+                                              self.configuration.frames_prefetch_queue_size)
+
+    def stop_prefetching(self):
+        """
+        Stop the prefetcher (if active), so that the reader object can be used on the current thread
+        again.
+
+        :return: -
+        """
+
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+
+    def prefetch(self, index_sequence, variant):
+        """
+        Announce the sequence of frame accesses of the next workflow phase. Those frames which will
+        have to be read from the input (because neither the requested variant nor any variant it is
+        derived from is buffered) are read ahead in a background thread.
+
+        If the original frames are buffered, nothing is done. They are read in one go at the first
+        access anyway.
+
+        :param index_sequence: Sequence of frame indices (translated indices if index translation
+                               is active) in the order in which they will be accessed.
+        :param variant: Variant accessed in the next phase, one out of 'original', 'monochrome',
+                        'gaussian', 'laplacian'.
+        :return: -
+        """
+
+        if self.buffer_original:
+            return
+
+        # For each variant list the buffers and sidecar cache products from which it can be
+        # obtained without I/O.
+        if variant == 'laplacian':
+            buffers = [self.frames_monochrome_blurred_laplacian, self.frames_monochrome_blurred,
+                       self.frames_monochrome]
+            products = ['laplacian', 'gaussian']
+        elif variant == 'gaussian':
+            buffers = [self.frames_monochrome_blurred, self.frames_monochrome]
+            products = ['gaussian']
+        elif variant == 'monochrome':
+            buffers = [self.frames_monochrome]
+            products = []
+        elif variant == 'original':
+            buffers = []
+            products = []
+        else:
+            raise ArgumentError("Invalid frame variant " + str(variant) + " specified")
+
+        # Original frames which are buffered partially can be used for all variants.
+        if self.frames_original is not None:
+            buffers = buffers + [self.frames_original]
+
+        index_sequence_original = []
+        for index in index_sequence:
+            if self.index_translation_active:
+                index_original = self.index_translation[index]
+            else:
+                index_original = index
+            if any(frame_stored(buffer, index_original) for buffer in buffers):
+                continue
+            # A product in the sidecar cache only avoids I/O if the brightness value (if required)
+            # is known as well.
+            if self.sidecar_cache is not None and any(
+                    self.sidecar_cache.available(product, index_original) for product in
+                    products) and (self.frames_average_brightness is None or
+                                   self.frames_average_brightness[index_original] is not None):
+                continue
+            index_sequence_original.append(index_original)
+
+        self.start_prefetcher(index_sequence_original)
 
     def frames_mono(self, index):
         """
@@ -1404,68 +3745,133 @@ class Frames(object):
         # print("Accessing frame monochrome " + str(index))
         # The monochrome frames are buffered, and this frame has been stored before. Just return
         # the frame.
-        if self.frames_monochrome[index_original] is not None:
-            return self.frames_monochrome[index_original]
+        frame_mono = self.frames_monochrome[index_original]
+        if frame_mono is not None:
+            return frame_mono
 
         # If the monochrome frame is cached, just return it.
-        if self.monochrome_available_index == index_original:
-            return self.monochrome_available
+        frame_mono = self.monochrome_cache.get(index_original)
+        if frame_mono is not None:
+            return frame_mono
 
         # The frame has not been stored for re-use, compute it.
         else:
 
-            # Get the original frame. If it is not cached, this involves I/O.
-            frame_original = self.frames(index)
+            # Get the original (or raw CFA) frame. If it is not cached, this involves I/O.
+            frame_original = self.frames_for_monochrome(index, index_original)
 
-            # If frames are in color mode produce a B/W version.
-            if self.color:
-                if self.color_index == 3:
-                    frame_mono = cvtColor(frame_original, COLOR_RGB2GRAY)
-                else:
-                    frame_mono = frame_original[:, :, self.color_index]
-            # Frames are in B/W mode already
+            # Produce a B/W version, and compute its average brightness.
+            frame_mono = self.monochrome_from_original(frame_original)
+            if self.configuration.frames_normalization:
+                self.compute_average_brightness(frame_mono, index_original)
+
+            # Buffer or cache the frame.
+            self.store_variant('monochrome', index_original, frame_mono)
+
+            return frame_mono
+
+    def frames_for_monochrome(self, index, index_original):
+        """
+        Look up the frame from which the monochrome version is computed. In raw CFA mode with
+        panchromatic channel selection, this is the raw frame which is converted directly into a
+        B/W image. Otherwise it is the (debayered) original frame.
+
+        :param index: Frame index (translated if index translation is active)
+        :param index_original: Original frame index (without index translation)
+        :return: Original frame or raw CFA frame
+        """
+
+        if self.raw_cfa and self.color_index == 3:
+            return self.frames_stored(index_original)
+        return self.frames(index)
+
+    def monochrome_from_original(self, frame_original):
+        """
+        Compute the monochrome version of an original frame. In raw CFA mode, the frame can be a
+        raw frame as well. It is converted to B/W without debayering.
+
+        :param frame_original: Original frame, or raw CFA frame
+        :return: Monochrome frame
+        """
+
+        # Convert a raw CFA frame directly into a B/W version.
+        if self.raw_cfa and len(frame_original.shape) == 2:
+            if self.color_index == 3:
+                return cvtColor(frame_original, self.cfa_gray_code)
+            frame_original = debayer_frame(frame_original, debayer_pattern=self.bayer_pattern,
+                                           debayer_method=self.configuration.frames_debayering_method,
+                                           BGR_input=self.reader.BGR_input)
+
+        # If frames are in color mode produce a B/W version.
+        if self.color:
+            if self.color_index == 3:
+                return cvtColor(frame_original, COLOR_RGB2GRAY)
             else:
-                frame_mono = frame_original
+                return frame_original[:, :, self.color_index]
+        # Frames are in B/W mode already
+        else:
+            return frame_original
 
-            # Normalize the overall frame brightness. The first monochrome frame for which this
-            # method is invoked is taken as the reference. The average brightness of all other
-            # monochrome frames is adjusted to match the brightness of the referenence.
-            if self.configuration.frames_normalization:
-                frame_type = frame_mono.dtype
-                if self.first_monochrome:
-                    if frame_type == uint8:
-                        self.normalization_lower_threshold = \
-                            self.configuration.frames_normalization_threshold
-                        self.normalization_upper_threshold = 255
-                    else:
-                        self.normalization_lower_threshold = \
-                            self.configuration.frames_normalization_threshold * 256
-                        self.normalization_upper_threshold = 255
-
-                    self.frames_average_brightness[index_original] = cv_mean(
-                        threshold(frame_mono, self.normalization_lower_threshold,
-                                  self.normalization_upper_threshold,
-                                  THRESH_TOZERO)[1])[0] + 1.e-10
-                    # Keep the index of the first monochrome frame as the reference index.
-                    self.first_monochrome_index = index_original
-                    self.first_monochrome = False
-                # Not the first monochrome frame. Adjust brightness to match the reference.
-                else:
-                    self.frames_average_brightness[index_original] = cv_mean(
-                        threshold(frame_mono, self.normalization_lower_threshold,
-                                  self.normalization_upper_threshold,
-                                  THRESH_TOZERO)[1])[0] + 1.e-10
+    def compute_average_brightness(self, frame_mono, index_original):
+        """
+        Compute the average brightness of a monochrome frame, used to normalize the overall frame
+        brightness. The first monochrome frame for which this method is invoked is taken as the
+        reference. The average brightness of all other monochrome frames is adjusted to match the
+        brightness of the referenence.
 
-            # If the monochrome frames are buffered, store it at the current index.
-            if self.buffer_monochrome:
-                self.frames_monochrome[index_original] = frame_mono
+        :param frame_mono: Monochrome frame
+        :param index_original: Original frame index (without index translation)
+        :return: -
+        """
 
-            # If frames are not buffered, cache the current frame.
+        # After the frames have been restricted to a window, keep the brightness values computed on
+        # full frames, so that the normalization stays consistent.
+        if self.window is not None and self.frames_average_brightness[index_original] is not None:
+            return
+
+        frame_type = frame_mono.dtype
+        if self.first_monochrome:
+            if frame_type == uint8:
+                self.normalization_lower_threshold = \
+                    self.configuration.frames_normalization_threshold
+                self.normalization_upper_threshold = 255
             else:
-                self.monochrome_available_index = index_original
-                self.monochrome_available = frame_mono
+                self.normalization_lower_threshold = \
+                    self.configuration.frames_normalization_threshold * 256
+                self.normalization_upper_threshold = 255
+
+            # Keep the index of the first monochrome frame as the reference index.
+            self.first_monochrome_index = index_original
+            self.first_monochrome = False
+
+        self.frames_average_brightness[index_original] = cv_mean(
+            threshold(frame_mono, self.normalization_lower_threshold,
+                      self.normalization_upper_threshold,
+                      THRESH_TOZERO)[1])[0] + 1.e-10
+        self.sidecar_store('brightness', index_original,
+                           self.frames_average_brightness[index_original])
+
+    def store_variant(self, variant, index_original, frame):
+        """
+        Store a frame variant for re-use: If the variant is buffered for this frame, store it in
+        the buffer list. Otherwise put it into the LRU cache of the variant.
 
-            return frame_mono
+        :param variant: One out of 'original', 'monochrome', 'gaussian', 'laplacian'.
+        :param index_original: Original frame index (without index translation)
+        :param frame: Frame variant to be stored
+        :return: -
+        """
+
+        buffers = {'original': (self.frames_original, self.original_cache),
+                   'monochrome': (self.frames_monochrome, self.monochrome_cache),
+                   'gaussian': (self.frames_monochrome_blurred, self.gaussian_cache),
+                   'laplacian': (self.frames_monochrome_blurred_laplacian, self.laplacian_cache)}
+        buffer, cache = buffers[variant]
+
+        if self.buffered(variant, index_original):
+            buffer[index_original] = frame
+        else:
+            cache.put(index_original, frame)
 
     def frames_mono_blurred(self, index):
         """
@@ -1488,38 +3894,70 @@ class Frames(object):
         # print("Accessing frame with Gaussian blur " + str(index))
         # The blurred frames are buffered, and this frame has been stored before. Just return
         # the frame.
-        if self.frames_monochrome_blurred[index_original] is not None:
-            return self.frames_monochrome_blurred[index_original]
+        frame_monochrome_blurred = self.frames_monochrome_blurred[index_original]
+        if frame_monochrome_blurred is not None:
+            return self.widen_gaussian(frame_monochrome_blurred)
 
         # If the blurred frame is cached, just return it.
-        if self.gaussian_available_index == index_original:
-            return self.gaussian_available
+        frame_monochrome_blurred = self.gaussian_cache.get(index_original)
+        if frame_monochrome_blurred is not None:
+            return self.widen_gaussian(frame_monochrome_blurred)
 
-        # The frame has not been stored for re-use, compute it.
+        # The frame has not been stored for re-use. Look it up in the sidecar cache, or compute it.
         else:
+            frame_monochrome_blurred = self.sidecar_lookup('gaussian', index_original)
 
-            # Get the monochrome frame. If it is not cached, this involves I/O.
-            frame_mono = self.frames_mono(index)
+            if frame_monochrome_blurred is None:
+                # Get the monochrome frame. If it is not cached, this involves I/O.
+                frame_mono = self.frames_mono(index)
 
-            # If the mono image is 8bit, interpolate it to 16bit.
-            if frame_mono.dtype == uint8:
-                frame_mono = frame_mono.astype(uint16) * 256
+                # Compute a version of the frame with Gaussian blur added.
+                frame_monochrome_blurred = self.gaussian_from_monochrome(frame_mono)
+                self.sidecar_store('gaussian', index_original, frame_monochrome_blurred)
+
+            # Buffer or cache the frame.
+            self.store_variant('gaussian', index_original, frame_monochrome_blurred)
 
-            # Compute a version of the frame with Gaussian blur added.
-            frame_monochrome_blurred = GaussianBlur(frame_mono,
-                                                    (self.configuration.frames_gauss_width,
-                                                     self.configuration.frames_gauss_width), 0)
+            return self.widen_gaussian(frame_monochrome_blurred)
 
-            # If the blurred frames are buffered, store the current frame at the current index.
-            if self.buffer_gaussian:
-                self.frames_monochrome_blurred[index_original] = frame_monochrome_blurred
+    def widen_gaussian(self, frame_monochrome_blurred):
+        """
+        Convert a Gaussian-blurred frame as stored into the 16bit form expected by the alignment
+        and stacking code. Frames stored with 8bit are scaled to the 16bit range.
+
+        :param frame_monochrome_blurred: Gaussian-blurred frame (uint8 or uint16)
+        :return: Gaussian-blurred frame (uint16)
+        """
+
+        if frame_monochrome_blurred.dtype == uint8:
+            frame_widened = frame_monochrome_blurred.astype(uint16)
+            frame_widened <<= 8
+            return frame_widened
+        return frame_monochrome_blurred
 
-            # If frames are not buffered, cache the current frame.
+    def gaussian_from_monochrome(self, frame_mono, scratch_uint16=None):
+        """
+        Compute the Gaussian-blurred version of a monochrome frame. The result is 16bit, except
+        for 8bit frames if "frames_gaussian_8bit" is set. In this case the frame is blurred with
+        8bit (OpenCV rounds to the nearest integer), and the result is 8bit.
+
+        :param frame_mono: Monochrome frame
+        :param scratch_uint16: Optional pre-allocated uint16 work array with the shape of the
+                               frame. It is used to interpolate 8bit frames to 16bit.
+        :return: Gaussian-blurred frame
+        """
+
+        # If the mono image is 8bit, interpolate it to 16bit.
+        if frame_mono.dtype == uint8 and not self.gaussian_8bit:
+            if scratch_uint16 is None:
+                frame_mono = frame_mono.astype(uint16) * 256
             else:
-                self.gaussian_available_index = index_original
-                self.gaussian_available = frame_monochrome_blurred
+                scratch_uint16[:] = frame_mono
+                scratch_uint16 <<= 8
+                frame_mono = scratch_uint16
 
-            return frame_monochrome_blurred
+        return GaussianBlur(frame_mono, (self.configuration.frames_gauss_width,
+                                         self.configuration.frames_gauss_width), 0)
 
     def frames_mono_blurred_laplacian(self, index):
         """
@@ -1541,35 +3979,166 @@ class Frames(object):
 
         # print("Accessing LoG number " + str(index))
         # The LoG frames are buffered, and this frame has been stored before. Just return the frame.
-        if self.frames_monochrome_blurred_laplacian[index_original] is not None:
-            return self.frames_monochrome_blurred_laplacian[index_original]
+        frame_monochrome_laplacian = self.frames_monochrome_blurred_laplacian[index_original]
+        if frame_monochrome_laplacian is not None:
+            return frame_monochrome_laplacian
 
         # If the blurred frame is cached, just return it.
-        if self.laplacian_available_index == index_original:
-            return self.laplacian_available
+        frame_monochrome_laplacian = self.laplacian_cache.get(index_original)
+        if frame_monochrome_laplacian is not None:
+            return frame_monochrome_laplacian
 
-        # The frame has not been stored for re-use, compute it.
+        # The frame has not been stored for re-use. Look it up in the sidecar cache, or compute it.
+        else:
+            frame_monochrome_laplacian = self.sidecar_lookup('laplacian', index_original)
+
+            if frame_monochrome_laplacian is None:
+                # Get the monochrome frame. If it is not cached, this involves I/O.
+                frame_monochrome_blurred = self.frames_mono_blurred(index)
+
+                # Compute the down-sampled Laplacian of the blurred frame.
+                frame_monochrome_laplacian = self.laplacian_from_gaussian(frame_monochrome_blurred)
+                self.sidecar_store('laplacian', index_original, frame_monochrome_laplacian)
+
+            # Buffer or cache the frame.
+            self.store_variant('laplacian', index_original, frame_monochrome_laplacian)
+
+            return frame_monochrome_laplacian
+
+    def laplacian_from_gaussian(self, frame_monochrome_blurred, scratch_float32=None):
+        """
+        Compute the down-sampled "Laplacian of Gaussian" of a Gaussian-blurred frame.
+
+        :param frame_monochrome_blurred: Gaussian-blurred frame
+        :param scratch_float32: Optional pre-allocated float32 work array with the shape of the
+                                down-sampled frame, to hold the unscaled Laplacian.
+        :return: LoG frame (uint8)
+        """
+
+        stride = self.configuration.align_frames_sampling_stride
+        if scratch_float32 is None:
+            laplacian = Laplacian(frame_monochrome_blurred[::stride, ::stride], CV_32F)
         else:
+            laplacian = Laplacian(frame_monochrome_blurred[::stride, ::stride], CV_32F,
+                                  dst=scratch_float32)
+
+        # The scaling factor refers to the 16bit range. For an 8bit blurred frame the Laplacian
+        # is smaller by a factor of 256.
+        if frame_monochrome_blurred.dtype == uint8:
+            return convertScaleAbs(laplacian, alpha=self.alpha * 256.)
+        return convertScaleAbs(laplacian, alpha=self.alpha)
+
+    def variant_stored(self, variant, index_original):
+        """
+        Check if a frame variant can be obtained without computation, i.e. if it is buffered,
+        cached, or stored in the sidecar cache.
+
+        :param variant: One out of 'original', 'monochrome', 'gaussian', 'laplacian'.
+        :param index_original: Original frame index (without index translation)
+        :return: True, if the variant is stored. False otherwise.
+        """
+
+        buffers = {'monochrome': (self.frames_monochrome, self.monochrome_cache),
+                   'gaussian': (self.frames_monochrome_blurred, self.gaussian_cache),
+                   'laplacian': (self.frames_monochrome_blurred_laplacian, self.laplacian_cache)}
+        buffer, cache = buffers[variant]
 
-            # Get the monochrome frame. If it is not cached, this involves I/O.
-            frame_monochrome_blurred = self.frames_mono_blurred(index)
+        return frame_stored(buffer, index_original) or index_original in cache.frames or (
+                self.sidecar_cache is not None and
+                self.sidecar_cache.available(variant, index_original))
 
-            # Compute a version of the frame with Gaussian blur added.
-            frame_monochrome_laplacian = convertScaleAbs(Laplacian(
-                frame_monochrome_blurred[::self.configuration.align_frames_sampling_stride,
-                ::self.configuration.align_frames_sampling_stride], CV_32F),
-                alpha=self.alpha)
+    def preprocess(self, index_sequence, variant):
+        """
+        Produce the derived variants of a batch of frames in one pass per frame. For every frame for
+        which the requested variant is not stored yet, the monochrome version, its average
+        brightness, the Gaussian-blurred version and its down-sampled Laplacian are computed
+        together as soon as the original frame is read. Intermediate results are kept in work
+        arrays which are allocated once for the whole batch. All variants are stored according to
+        the buffering settings.
+
+        :param index_sequence: Sequence of frame indices (translated indices if index translation
+                               is active).
+        :param variant: Variant to be returned, either 'gaussian' or 'laplacian'.
+        :return: Generator which for each frame yields a tuple (index, frame variant, average
+                 brightness). The brightness is None if normalization is switched off.
+        """
 
-            # If the blurred frames are buffered, store the current frame at the current index.
-            if self.buffer_laplacian:
-                self.frames_monochrome_blurred_laplacian[index_original] = frame_monochrome_laplacian
+        if variant not in ['gaussian', 'laplacian']:
+            raise ArgumentError("Invalid frame variant " + str(variant) + " for preprocessing")
 
-            # If frames are not buffered, cache the current frame.
+        # Allocate work arrays for interpolating 8bit frames and for the unscaled Laplacian.
+        stride = self.configuration.align_frames_sampling_stride
+        if self.depth == 8 and not self.gaussian_8bit:
+            scratch_uint16 = empty(self.shape[:2], dtype=uint16)
+        else:
+            scratch_uint16 = None
+        scratch_float32 = empty((int(ceil(self.shape[0] / stride)),
+                                 int(ceil(self.shape[1] / stride))), dtype=float32)
+
+        for index in index_sequence:
+            # Check if the requested index is within bounds. Translate index, if necessary.
+            if self.index_translation_active:
+                if not 0 <= index < self.number:
+                    raise ArgumentError(
+                        "Translated frame index " + str(index) + " is out of bounds")
+                index_original = self.index_translation[index]
             else:
-                self.laplacian_available_index = index_original
-                self.laplacian_available = frame_monochrome_laplacian
+                if not 0 <= index < self.number_original:
+                    raise ArgumentError("Frame index " + str(index) + " is out of bounds")
+                index_original = index
 
-            return frame_monochrome_laplacian
+            brightness_known = not self.configuration.frames_normalization or \
+                self.frames_average_brightness[index_original] is not None
+
+            # The variant is available already. Look it up with the standard method.
+            if brightness_known and self.variant_stored(variant, index_original):
+                if variant == 'gaussian':
+                    frame_variant = self.frames_mono_blurred(index)
+                else:
+                    frame_variant = self.frames_mono_blurred_laplacian(index)
+
+            # Only the Laplacian is missing, but the Gaussian is stored (e.g. in the sidecar cache).
+            # Compute the Laplacian from it without reading the original frame.
+            elif brightness_known and variant == 'laplacian' and \
+                    self.variant_stored('gaussian', index_original):
+                frame_variant = self.laplacian_from_gaussian(self.frames_mono_blurred(index),
+                                                             scratch_float32=scratch_float32)
+                self.sidecar_store('laplacian', index_original, frame_variant)
+                if not frame_stored(self.frames_monochrome_blurred_laplacian, index_original):
+                    self.store_variant('laplacian', index_original, frame_variant)
+
+            # Compute all variants from the original frame.
+            else:
+                frame_mono = self.monochrome_from_original(
+                    self.frames_for_monochrome(index, index_original))
+                if self.configuration.frames_normalization:
+                    self.compute_average_brightness(frame_mono, index_original)
+                if not frame_stored(self.frames_monochrome, index_original):
+                    self.store_variant('monochrome', index_original, frame_mono)
+
+                frame_variant = frame_blurred = self.gaussian_from_monochrome(
+                    frame_mono, scratch_uint16=scratch_uint16)
+                self.sidecar_store('gaussian', index_original, frame_blurred)
+                if not frame_stored(self.frames_monochrome_blurred, index_original):
+                    self.store_variant('gaussian', index_original, frame_blurred)
+
+                if variant == 'laplacian' or self.buffer_laplacian:
+                    frame_variant = self.laplacian_from_gaussian(
+                        frame_blurred, scratch_float32=scratch_float32)
+                    self.sidecar_store('laplacian', index_original, frame_variant)
+                    if not frame_stored(self.frames_monochrome_blurred_laplacian, index_original):
+                        self.store_variant('laplacian', index_original, frame_variant)
+                    if variant == 'gaussian':
+                        frame_variant = frame_blurred
+
+                # Blurred frames stored with 8bit are handed out with 16bit.
+                if variant == 'gaussian':
+                    frame_variant = self.widen_gaussian(frame_variant)
+
+            if self.configuration.frames_normalization:
+                yield index, frame_variant, self.frames_average_brightness[index_original]
+            else:
+                yield index, frame_variant, None
 
     def average_brightness(self, index):
         """
@@ -1589,6 +4158,12 @@ class Frames(object):
                 raise ArgumentError("Frame index " + str(index) + " is out of bounds")
             index_original = index
 
+        # If the frame variant has been taken from the sidecar cache, the brightness may not have
+        # been computed yet. In this case compute the monochrome frame which sets the brightness.
+        if self.frames_average_brightness[index_original] is None and \
+                self.sidecar_cache is not None:
+            self.frames_mono(index)
+
         ab = self.frames_average_brightness[index_original]
         if ab:
             return ab
@@ -1596,6 +4171,30 @@ class Frames(object):
             raise InternalError("Accessing average frame brightness before computing it, frame: " +
                                 str(index_original))
 
+    def cache_statistics(self):
+        """
+        Create a summary of the hit / miss statistics of the LRU caches for non-buffered frame
+        variants, and of the contents of compressed frame buffers.
+
+        :return: Multi-line string with one line per non-buffered variant and compressed buffer.
+        """
+
+        lines = []
+        for buffered, cache in [(self.buffer_original, self.original_cache),
+                                (self.buffer_monochrome, self.monochrome_cache),
+                                (self.buffer_gaussian, self.gaussian_cache),
+                                (self.buffer_laplacian, self.laplacian_cache)]:
+            if not buffered:
+                lines.append("           " + cache.statistics())
+
+        # Add the contents of compressed buffers.
+        for variant, buffer in [('original', self.frames_original),
+                                ('monochrome', self.frames_monochrome)]:
+            if isinstance(buffer, CompressedFrameBuffer):
+                lines.append("           " + variant + " compressed buffer: " +
+                             buffer.statistics())
+        return "\n".join(lines)
+
     def set_index_translation(self):
         """
         Set the index translation table. The list "self.index_included" for every original frame
@@ -1615,10 +4214,32 @@ class Frames(object):
         # Set the number of frames which will take part in the processing workflow.
         self.number = len(self.index_translation)
 
+        # Release the memory of all buffered versions of excluded frames.
+        for index in range(self.number_original):
+            if not self.index_included[index]:
+                self.release_frame(index)
+
         # Set the index translation flag, so that in future frame lookups the translation table
         # will be used.
         self.index_translation_active = True
 
+    def release_frame(self, index_original):
+        """
+        Remove all buffered and cached versions of a frame.
+
+        :param index_original: Original frame index (without index translation)
+        :return: -
+        """
+
+        if self.frames_original is not None:
+            self.frames_original[index_original] = None
+        self.frames_monochrome[index_original] = None
+        self.frames_monochrome_blurred[index_original] = None
+        self.frames_monochrome_blurred_laplacian[index_original] = None
+        for cache in [self.original_cache, self.monochrome_cache, self.gaussian_cache,
+                      self.laplacian_cache]:
+            cache.remove(index_original)
+
     def reset_index_translation(self):
         """
         Reset the index translation table, and de-activate index translation. Keep the list of
@@ -1825,6 +4446,336 @@ def access_pattern_simple(frames_object, average_frame_percent):
 
 
 if __name__ == "__main__":
+    from shutil import rmtree
+    from struct import pack
+    from tempfile import mkdtemp
+
+    from cv2 import VideoWriter, VideoWriter_fourcc
+    from numpy import absolute, array, array_equal, ascontiguousarray, empty, exp, indices, \
+        median, tile
+    from numpy.random import normal, randint, seed
+
+    # Self-checks with synthetic input files. The random generator is seeded, so that failures can
+    # be reproduced.
+    seed(1)
+    test_dir = mkdtemp()
+
+    def write_ser(name, ser_frames, color_id=0):
+        file_path = path.join(test_dir, name)
+        frame_count, height, width = ser_frames.shape
+        with open(file_path, 'wb') as ser_file:
+            ser_file.write(pack('<14s 7i 40s 40s 40s 2q', b'LUCAM-RECORDER', 0, color_id, 1,
+                                width, height, 8 * ser_frames.dtype.itemsize, frame_count, b'',
+                                b'', b'', 0, 0))
+            ser_file.write(ser_frames.astype(ser_frames.dtype.newbyteorder('<')).tobytes())
+        return file_path
+
+    def test_configuration(options):
+        test_config = Configuration()
+        test_config.initialize_configuration(read_from_file=False)
+        for name, value in options.items():
+            setattr(test_config, name, value)
+        test_config.set_derived_parameters()
+        return test_config
+
+    def read_all(frames_object):
+        return [(array(frames_object.frames(index)), array(frames_object.frames_mono(index)),
+                 array(frames_object.frames_mono_blurred(index)),
+                 array(frames_object.frames_mono_blurred_laplacian(index))) for index in
+                range(frames_object.number)]
+
+    def same_frames(variants, reference_variants):
+        return len(variants) == len(reference_variants) and all(
+            array_equal(variant, variant_reference) for frame, frame_reference in
+            zip(variants, reference_variants) for variant, variant_reference in
+            zip(frame, frame_reference))
+
+    # Test video: A slightly moving, blurred planetary disk. The reference variants are read
+    # without buffering.
+    y, x = indices((48, 64))
+    test_frames = empty((12, 48, 64), dtype=uint16)
+    for index in range(12):
+        test_frames[index] = clip(2800. * exp(-((y - 24 - randint(-3, 4)) ** 2 + (
+            x - 32 - randint(-3, 4)) ** 2) / 60.) + normal(200., 40., (48, 64)), 0, 4095)
+    planet_file = write_ser('planet.ser', test_frames)
+    reference = read_all(Frames(test_configuration({}), planet_file, type='video',
+                                buffering_level=0))
+
+    # Self-check of the read-ahead thread: Frames are handed out in the order of the access
+    # sequence, frames skipped by the consumer are discarded, and an index which does not occur in
+    # the remaining sequence gives None. A read error is raised in the consumer thread and ends the
+    # read-ahead, and stop() ends the thread also if the queue is full.
+    def test_read(index_sequence):
+        for index in index_sequence:
+            if index == 5:
+                raise IOError("Test read error")
+            yield array([index])
+
+    prefetcher = FramePrefetcher(test_read, [0, 1, 2, 3, 2, 5, 6], 2)
+    assert prefetcher.get(0)[0] == 0 and prefetcher.get(2)[0] == 2
+    assert prefetcher.get(1) is None
+    assert prefetcher.get(2)[0] == 2 and prefetcher.get(2) is None
+    try:
+        prefetcher.get(5)
+        raise AssertionError("A read error was not passed on")
+    except IOError:
+        pass
+    assert prefetcher.get(6) is None
+    prefetcher.stop()
+    assert not prefetcher.thread.is_alive() and prefetcher.queue.empty()
+    prefetcher = FramePrefetcher(test_read, range(5), 2)
+    prefetcher.stop()
+    assert not prefetcher.thread.is_alive() and prefetcher.queue.empty()
+
+    # Images decoded by a pool of threads are handed out in the order of the index sequence, also
+    # if the sequence is longer than the decoding window. An image with a different size is
+    # reported.
+    image_frames = randint(0, 65536, (9, 20, 30)).astype(uint16)
+    image_names = [path.join(test_dir, 'image_' + str(index) + '.png') for index in range(9)]
+    for image_name, frame in zip(image_names, image_frames):
+        imwrite(image_name, frame)
+    reader = ImageReader(test_configuration({'frames_image_decoding_threads': 3,
+                                             'frames_image_decoding_window': 4}))
+    reader.open(image_names)
+    index_sequence = [8, 0, 3, 4, 5, 1, 1, 7, 2, 6]
+    for index, frame in zip(index_sequence, reader.read_frames(index_sequence)):
+        assert array_equal(frame, image_frames[index])
+    imwrite(image_names[5], image_frames[5, :10])
+    try:
+        list(reader.read_frames(range(9)))
+        raise AssertionError("An image with a different size was accepted")
+    except ShapeError:
+        pass
+    reader.close()
+
+    # The LRU frame cache evicts the least recently used frames when the byte budget is exceeded,
+    # but it always keeps the frame stored last.
+    cache = FrameCache('test', 3000)
+    for index in range(3):
+        cache.put(index, zeros((10, 100), dtype=uint8))
+    assert cache.get(0) is not None and cache.get(4) is None
+    cache.put(3, zeros((10, 100), dtype=uint8))
+    assert list(cache.frames) == [2, 0, 3] and cache.size_bytes == 3000
+    cache.put(4, zeros((10, 400), dtype=uint8))
+    assert list(cache.frames) == [4] and cache.hits == 1 and cache.misses == 1
+
+    # Preprocessing yields the same Gaussians and Laplacians as the frame accessors. It stores all
+    # variants of the frames it reads, if they are buffered.
+    for buffering_level in [0, 4]:
+        test_object = Frames(test_configuration({}), planet_file, type='video',
+                             buffering_level=buffering_level)
+        for variant_index, variant in [(2, 'gaussian'), (3, 'laplacian')]:
+            for index, frame, brightness in test_object.preprocess(range(12), variant):
+                assert array_equal(frame, reference[index][variant_index])
+    assert all(test_object.frames_monochrome[index] is not None and
+               test_object.frames_monochrome_blurred_laplacian[index] is not None for index in
+               range(12))
+
+    # Raw CFA buffering: The single-plane frames of a Bayer-encoded video are buffered and debayered
+    # on demand into the same color frames. Monochrome frames computed from the raw frames differ
+    # by rounding only.
+    reference_bayer = Frames(test_configuration({}), planet_file, type='video',
+                             bayer_option_selected='Force Bayer RGGB', buffering_level=0)
+    test_object = Frames(test_configuration({'frames_raw_cfa_buffering': True}), planet_file,
+                         type='video', bayer_option_selected='Force Bayer RGGB', buffering_level=4)
+    assert test_object.raw_cfa
+    for index in range(12):
+        assert array_equal(test_object.frames(index), reference_bayer.frames(index))
+        assert absolute(test_object.frames_mono(index).astype(int32) -
+                        reference_bayer.frames_mono(index)).max() <= 1
+    assert test_object.frames_original[0].shape == (48, 64)
+    assert Frames(test_configuration({'frames_raw_cfa_buffering': True}),
+                  write_ser('planet_bayer.ser', test_frames, color_id=8), type='video',
+                  buffering_level=4).raw_cfa
+
+    # Frames excluded from the workflow are not read if the original frames are buffered.
+    test_object = Frames(test_configuration({}), planet_file, type='video', buffering_level=4)
+    for index in [1, 4, 7]:
+        test_object.index_included[index] = False
+    test_object.set_index_translation()
+    for index, index_original in enumerate([0, 2, 3, 5, 6, 8, 9, 10, 11]):
+        assert array_equal(test_object.frames(index), reference[index_original][0])
+    assert all(test_object.frames_original[index] is None for index in [1, 4, 7])
+
+    # Buffers kept in memory-mapped scratch files hold the same frames as buffers in RAM.
+    test_object = Frames(test_configuration({}), planet_file, type='video', buffering_level=0)
+    assert test_object.use_spill_buffers(test_dir) == ['original', 'gaussian', 'laplacian']
+    assert same_frames(read_all(test_object), reference)
+    assert isinstance(test_object.frames_monochrome_blurred, SpillBuffer)
+    test_object.release_buffers()
+
+    # Decoding a compressed video in segments with several capture handles gives the same frames as
+    # decoding it with a single handle.
+    avi_file = path.join(test_dir, 'planet.avi')
+    writer = VideoWriter(avi_file, VideoWriter_fourcc(*'FFV1'), 25, (64, 48))
+    for frame in test_frames:
+        writer.write(cvtColor((frame >> 4).astype(uint8), COLOR_GRAY2RGB))
+    writer.release()
+    reference_avi = Frames(test_configuration({}), avi_file, type='video', buffering_level=0)
+    test_object = Frames(test_configuration({'frames_video_decoding_handles': 4,
+                                             'frames_video_segment_length': 3}), avi_file,
+                         type='video', buffering_level=4)
+    for index in range(12):
+        assert array_equal(test_object.frames(index), reference_avi.frames(index))
+
+    # Frames read from a SER file in blocks stay unchanged when the next block is read into the same
+    # buffer.
+    test_object = Frames(test_configuration({'frames_ser_block_frames': 5}), planet_file,
+                         type='video', buffering_level=4)
+    for index in range(12):
+        assert array_equal(test_object.frames(index), reference[index][0])
+
+    # Frames restricted to a window are cut out of the full frames. Resetting the window returns to
+    # the full frames.
+    test_object = Frames(test_configuration({'frames_roi_window': True}), planet_file,
+                         type='video', buffering_level=4)
+    test_object.set_window(8, 40, 16, 56)
+    assert test_object.shape == (32, 40)
+    for index in range(12):
+        assert array_equal(test_object.frames(index), reference[index][0][8:40, 16:56])
+        assert array_equal(test_object.frames_mono(index), reference[index][1][8:40, 16:56])
+    test_object.reset_window()
+    assert same_frames(read_all(test_object), reference)
+
+    # Original and monochrome frames kept compressed in RAM are returned unchanged.
+    test_object = Frames(test_configuration({'frames_buffer_compression': 'delta-zlib'}),
+                         planet_file, type='video', buffering_level=4)
+    assert same_frames(read_all(test_object), reference)
+    assert isinstance(test_object.frames_monochrome, CompressedFrameBuffer)
+
+    # For 8bit input, Gaussians stored with 8bit are rounded. They differ from the Gaussians computed
+    # with 16bit by half an 8bit step at most.
+    file_8bit = write_ser('planet_8bit.ser', (test_frames >> 4).astype(uint8))
+    reference_8bit = Frames(test_configuration({}), file_8bit, type='video', buffering_level=0)
+    test_object = Frames(test_configuration({'frames_gaussian_8bit': True}), file_8bit,
+                         type='video', buffering_level=4)
+    for index in range(12):
+        assert absolute(test_object.frames_mono_blurred(index).astype(int32) -
+                        reference_8bit.frames_mono_blurred(index)).max() <= 128
+    assert test_object.frames_monochrome_blurred[0].dtype == uint8
+
+    # Frames retained for later workflow phases: Variants which are not listed are released, and
+    # frames outside a listed subset are removed. Released frames are computed again on demand.
+    test_object = Frames(test_configuration({}), planet_file, type='video', buffering_level=4)
+    read_all(test_object)
+    test_object.retain_frames({'original': [0, 3, 5], 'gaussian': None})
+    assert [index for index in range(12) if test_object.frames_original[index] is not None] == \
+           [0, 3, 5]
+    assert not test_object.buffer_monochrome and not test_object.buffer_laplacian
+    assert same_frames(read_all(test_object), reference)
+    assert test_object.frames_original[4] is None
+
+    # Stack, rank and stack again, as with "Go back to" in the GUI: Restoring the buffering puts
+    # all variants into buffers again, in frame arenas as well, and the frames kept are not lost.
+    for arena_buffers in [False, True]:
+        test_object = Frames(test_configuration({'frames_arena_buffers': arena_buffers}),
+                             planet_file, type='video', buffering_level=4)
+        read_all(test_object)
+        test_object.retain_frames({'original': [0, 3, 5], 'gaussian': [0, 3, 5]})
+        test_object.restore_buffering()
+        assert test_object.buffer_original and test_object.buffer_monochrome and \
+               test_object.buffer_gaussian and test_object.buffer_laplacian
+        assert frame_stored(test_object.frames_original, 3)
+        assert same_frames(read_all(test_object), reference)
+        assert all(frame_stored(buffer, index) for buffer in [
+            test_object.frames_original, test_object.frames_monochrome,
+            test_object.frames_monochrome_blurred, test_object.frames_monochrome_blurred_laplacian]
+                   for index in range(12))
+        assert isinstance(test_object.frames_monochrome_blurred, FrameArena) == arena_buffers
+        test_object.retain_frames({'original': [1, 2], 'gaussian': [1, 2]})
+        assert [index for index in range(12) if test_object.frames_original[index] is not None] \
+               == [1, 2]
+
+    # A recording split into several files is read as one sequence of frames. Files with a
+    # different frame format are not joined.
+    segment_names = [write_ser('planet_segment_' + str(first) + '.ser', test_frames[first:last])
+                     for first, last in [(0, 5), (5, 9), (9, 12)]]
+    test_object = Frames(test_configuration({}), segment_names, type='video', buffering_level=4)
+    assert test_object.number == 12
+    assert same_frames(read_all(test_object), reference)
+    other_format = write_ser('planet_segment_12.ser', test_frames[:2, :, :-2])
+    assert VirtualVideoReader(test_configuration({})).matching_segments(
+        segment_names + [other_format, path.join(test_dir, 'missing.ser')]) == (
+        segment_names, [other_format, path.join(test_dir, 'missing.ser')])
+
+    # Dark / flat correction agrees with a clipped floating point computation, for uint16 and uint8
+    # frames, in place, and for a window.
+    calibration = Calibration(test_configuration({}))
+    calibration.create_master_dark(write_ser('dark.ser', (randint(500, 1500, (1, 24, 32)) +
+                                                          randint(0, 10, (6, 24, 32))).astype(
+        uint16)))
+    calibration.create_master_flat(write_ser('flat.ser', (normal(30000., 2000., (1, 24, 32)) +
+                                                          randint(0, 10, (6, 24, 32))).astype(
+        uint16)))
+    window = (3, 19, 5, 27)
+    for frame_dtype, high_value in [(uint16, 65535), (uint8, 255)]:
+        calibration.adapt_dark_frame(frame_dtype, 0)
+        if frame_dtype == uint8:
+            dark = calibration.master_dark_frame_adapted.astype(float64)
+        else:
+            dark = calibration.master_dark_frame.astype(float64)
+        frame = randint(0, high_value + 1, (24, 32)).astype(frame_dtype)
+        corrected = calibration.correct(frame)
+        assert corrected.dtype == frame_dtype and absolute(corrected - clip(
+            (frame - dark).clip(min=0.) * calibration.inverse_master_flat_frame, 0.,
+            high_value)).max() <= 1.
+        assert (corrected == 0).any() and (corrected == high_value).any()
+        in_place = frame.copy()
+        assert calibration.correct(in_place, out=in_place) is in_place
+        assert array_equal(in_place, corrected)
+        assert array_equal(calibration.correct(ascontiguousarray(
+            frame[window[0]:window[1], window[2]:window[3]]), window=window),
+            corrected[window[0]:window[1], window[2]:window[3]])
+
+    # Raw master flats are normalized separately for the four Bayer phases, and raw frames are
+    # calibrated before they are debayered.
+    test_config = test_configuration({'frames_calibration_raw': True,
+                                       'frames_debayering_default': 'Force Bayer RGGB'})
+    calibration = Calibration(test_config)
+    calibration.create_master_dark(write_ser('dark_raw.ser', (randint(
+        500, 1500, (1, 24, 32)) + randint(0, 10, (6, 24, 32))).astype(uint16)))
+    y, x = indices((24, 32))
+    flat_frames = 40000. * tile(array([[0.5, 1.], [1., 0.8]]), (12, 16)) * (
+        1.2 - ((y - 12.) ** 2 + (x - 16.) ** 2) / 1000.) + randint(0, 10, (6, 24, 32))
+    calibration.create_master_flat(write_ser('flat_raw.ser', flat_frames.astype(uint16)))
+    assert calibration.shape == (24, 32)
+    normalized = calibration.master_flat_frame * calibration.inverse_master_flat_frame
+    for dy, dx in [(0, 0), (0, 1), (1, 0), (1, 1)]:
+        assert normalized[dy::2, dx::2].max() - normalized[dy::2, dx::2].min() < \
+               1.e-3 * normalized[dy::2, dx::2].mean()
+    raw_frames = randint(0, 65536, (3, 24, 32)).astype(uint16)
+    test_object = Frames(test_config, write_ser('stack_raw.ser', raw_frames), type='video',
+                         calibration=calibration, bayer_option_selected='Force Bayer RGGB',
+                         buffering_level=4)
+    assert test_object.calibration_raw
+    for index in range(3):
+        assert array_equal(test_object.frames(index), debayer_frame(
+            calibration.correct(raw_frames[index]), debayer_pattern=test_object.bayer_pattern,
+            debayer_method=test_config.frames_debayering_method))
+
+    # Hot pixels of the master dark are replaced by the median of their eight neighbours (of the
+    # same Bayer color for raw frames), all other pixels stay unchanged.
+    hot_pixels = [(0, 0), (5, 7), (10, 10), (12, 30), (23, 31)]
+    dark_frames = randint(500, 1500, (6, 24, 32)).astype(uint16)
+    for y, x in hot_pixels:
+        dark_frames[:, y, x] = 40000
+    for bayer_option, step in [('Auto detect color', 1), ('Force Bayer RGGB', 2)]:
+        calibration = Calibration(test_configuration({'frames_hot_pixel_correction': True,
+                                                      'frames_calibration_raw': True,
+                                                      'frames_debayering_default': bayer_option}))
+        calibration.create_master_dark(write_ser('dark_hot_' + str(step) + '.ser', dark_frames))
+        calibration.adapt_dark_frame(uint16, 0)
+        assert calibration.hot_pixel_mode and calibration.dark_raw == (step == 2)
+        assert sorted(zip(*calibration.hot_pixels.tolist())) == hot_pixels
+        frame = randint(1000, 2000, (24, 32)).astype(uint16)
+        corrected = calibration.correct(frame)
+        assert set(zip(*(corrected != frame).nonzero())) <= set(hot_pixels)
+        for y, x in [(5, 7), (10, 10)]:
+            neighbours = frame[y - step:y + step + 1:step, x - step:x + step + 1:step].ravel()
+            assert corrected[y, x] == int(median(neighbours[[0, 1, 2, 3, 5, 6, 7, 8]]))
+
+    rmtree(test_dir)
+    print("Frames self-check passed")
 
     # Images can either be extracted from a video file or a batch of single photographs. Select
     # the example for the test run.
@@ -1852,6 +4803,12 @@ if __name__ == "__main__":
         # name_flats = 'D:\SW-Development\Python\PlanetarySystemStacker\Examples\Darks_and_Flats\ASI120MM-S_Flat.avi'
         # name_darks = 'D:\SW-Development\Python\PlanetarySystemStacker\Examples\Darks_and_Flats\ASI120MM-S_Dark.avi'
 
+    # The example recordings are not part of the repository. Stop after the self-checks if they
+    # are not available.
+    if not (names if type == 'image' else path.isfile(names)):
+        print("Example input " + str(names) + " not found, frame access demo skipped")
+        exit()
+
     # Get configuration parameters.
     configuration = Configuration()
     configuration.initialize_configuration()
@@ -78,6 +78,8 @@ class Job(object):
            - bayer_option_selected: Initialized to 'Auto detect color' for file types for which
                                     debayering is supported. Otherwise None.
            - bayer_pattern: Initialized to None
+           - segments: For type 'video', the list of video files to be joined into one frame
+                       sequence (see "add_segment"). Initialized to [name].
 
         :param job_name: Name of the job (str)
         """
@@ -85,6 +87,7 @@ class Job(object):
         self.name = job_name
         path = Path(self.name)
         self.file_name = path.name
+        self.segments = [job_name]
 
         # Bayer patterns are only defined for type 'video'.
         self.bayer_pattern = None
@@ -107,6 +110,21 @@ class Job(object):
         else:
             raise InternalError("Cannot decide if input file is video or image directory")
 
+    def add_segment(self, segment_name):
+        """
+        Append a video file to a video job. Capture software often splits a recording session into
+        several files. The frames of all segments are joined into one sequence, and the best frames
+        of the whole session are stacked. Result and log file names are derived from the first
+        segment.
+
+        :param segment_name: Name of the video file (str)
+        :return: -
+        """
+
+        if self.type != 'video':
+            raise InternalError("Segments can only be added to video jobs")
+        self.segments.append(segment_name)
+
 
 class JoblistWidget(QtWidgets.QListWidget):
     """
@@ -0,0 +1,223 @@
+# -*- coding: utf-8; -*-
+"""
+Copyright (c) 2018 Rolf Hempel, rolf6419@gmx.de
+
+This file is part of the PlanetarySystemStacker tool (PSS).
+https://github.com/Rolf-Hempel/PlanetarySystemStacker
+
+PSS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PSS.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+
+from concurrent.futures import ThreadPoolExecutor
+
+from numpy import empty, zeros, ones, float32, float64, median, sqrt, maximum, abs as np_abs
+
+from exceptions import ArgumentError
+from frame_buffers import SpillBuffer
+
+
+class MasterFrameBuilder(object):
+    """
+    Combine a sequence of dark or flat frames into a master frame. Frames are consumed as they
+    are delivered by the reader's "read_frames" method (which decodes images and video segments
+    in parallel), so they never have to be held in RAM all at once.
+
+    Methods:
+        'mean': Running sum over chunks of frames, divided by the number of frames.
+        'median': Pixel-wise median of all frames.
+        'sigma-clip': Pixel-wise mean after iteratively rejecting values which deviate from the
+                      mean by more than "frames_master_sigma" standard deviations.
+
+    For 'median' and 'sigma-clip' all frames are written to a memory-mapped scratch file first.
+    The frame stack is then combined in horizontal tiles, each of which holds the data of all
+    frames for a few rows only. Tiles are processed in parallel threads. Unlike the mean, both
+    methods remove cosmic-ray and satellite hits which occur in a few frames only.
+
+    """
+
+    methods = ['mean', 'median', 'sigma-clip']
+
+    def __init__(self, configuration, method=None):
+        """
+        Initialize the builder.
+
+        :param configuration: Configuration object with parameters
+        :param method: One out of 'mean', 'median', 'sigma-clip'. If None, the method is taken
+                       from the configuration parameter "frames_master_method".
+        """
+
+        self.configuration = configuration
+        if method is None:
+            method = configuration.frames_master_method
+        if method not in MasterFrameBuilder.methods:
+            raise ArgumentError("Master frame method " + str(method) + " not supported")
+        self.method = method
+
+    def build(self, frame_iterator, frame_count, frame_shape, dtype):
+        """
+        Combine frames into a master frame.
+
+        :param frame_iterator: Iterator which yields the frames.
+        :param frame_count: Number of frames delivered by the iterator (upper limit).
+        :param frame_shape: Shape of a single frame
+        :param dtype: Numpy dtype of the frames
+        :return: Master frame (float64) in the value range of the input frames
+        """
+
+        if self.method == 'mean':
+            return self.combine_mean(frame_iterator, frame_shape, dtype)
+
+        stack = SpillBuffer(self.configuration.frames_spill_directory or None, frame_count,
+                            frame_shape, dtype)
+        try:
+            number = 0
+            for frame in frame_iterator:
+                stack.data[number] = frame
+                number += 1
+            if not number:
+                raise ArgumentError("No frames available for master frame construction")
+            return self.combine_tiles(stack.data[:number])
+        finally:
+            stack.release()
+
+    def chunks(self, frame_iterator, frame_shape, dtype):
+        """
+        Collect frames in chunks of "frames_master_chunk_frames" frames. The chunk array is
+        allocated once and re-used.
+
+        :param frame_iterator: Iterator which yields the frames.
+        :param frame_shape: Shape of a single frame
+        :param dtype: Numpy dtype of the frames
+        :return: Generator which yields arrays of shape (n,) + frame_shape. They are views into
+                 the chunk array, valid until the next chunk is requested.
+        """
+
+        chunk = empty((self.configuration.frames_master_chunk_frames,) + tuple(frame_shape),
+                      dtype=dtype)
+        number = 0
+        for frame in frame_iterator:
+            chunk[number] = frame
+            number += 1
+            if number == chunk.shape[0]:
+                yield chunk
+                number = 0
+        if number:
+            yield chunk[:number]
+
+    def combine_mean(self, frame_iterator, frame_shape, dtype):
+        """
+        Compute the mean of all frames with a running sum in a 64bit buffer.
+
+        :param frame_iterator: Iterator which yields the frames.
+        :param frame_shape: Shape of a single frame
+        :param dtype: Numpy dtype of the frames
+        :return: Mean frame (float64)
+        """
+
+        sum_frames = zeros(frame_shape, dtype=float64)
+        number = 0
+        for chunk in self.chunks(frame_iterator, frame_shape, dtype):
+            sum_frames += chunk.sum(axis=0, dtype=float64)
+            number += chunk.shape[0]
+        if not number:
+            raise ArgumentError("No frames available for master frame construction")
+        sum_frames /= number
+        return sum_frames
+
+    def combine_tiles(self, stack):
+        """
+        Combine a (memory-mapped) frame stack pixel-wise in tiles of rows. The tile height is
+        chosen such that the float32 copies of all tiles processed in parallel stay within
+        "frames_master_tile_mbytes" per thread.
+
+        :param stack: Array of shape (number of frames,) + frame_shape
+        :return: Master frame (float64)
+        """
+
+        number, height = stack.shape[0], stack.shape[1]
+        row_bytes = 4 * stack[0, 0].size * number
+        tile_rows = max(int(self.configuration.frames_master_tile_mbytes * 1e6 / row_bytes), 1)
+        master = empty(stack.shape[1:], dtype=float64)
+
+        def combine(y_low):
+            y_high = min(y_low + tile_rows, height)
+            master[y_low:y_high] = self.combine_tile(stack[:, y_low:y_high])
+
+        with ThreadPoolExecutor(max_workers=self.configuration.frames_master_threads) as executor:
+            list(executor.map(combine, range(0, height, tile_rows)))
+        return master
+
+    def combine_tile(self, tile):
+        """
+        Combine the frames of a tile pixel-wise with the selected robust method.
+
+        :param tile: Array of shape (number of frames, rows, ...)
+        :return: Combined tile of shape (rows, ...)
+        """
+
+        if self.method == 'median':
+            return median(tile, axis=0)
+
+        # Sigma clipping: Iterate mean and standard deviation over the values not rejected, until
+        # the set of rejected values does not change any more.
+        tile = tile.astype(float32)
+        valid = ones(tile.shape, dtype=bool)
+        for iteration in range(self.configuration.frames_master_clip_iterations):
+            number = maximum(valid.sum(axis=0), 1)
+            mean = (tile * valid).sum(axis=0) / number
+            deviation = tile - mean
+            sigma = sqrt(((deviation * valid) ** 2).sum(axis=0) / number)
+            valid_new = np_abs(deviation) <= self.configuration.frames_master_sigma * sigma
+            if (valid_new == valid).all():
+                break
+            valid = valid_new
+        return (tile * valid).sum(axis=0, dtype=float64) / maximum(valid.sum(axis=0), 1)
+
+
+if __name__ == "__main__":
+    from numpy import allclose, array_equal, indices, mean as np_mean, uint16
+
+    from configuration import Configuration
+
+    # Self-check: All methods must agree with the corresponding numpy computation on the full frame
+    # stack. Small chunks and tiles make sure that partial chunks and several tiles are combined.
+    configuration = Configuration()
+    configuration.initialize_configuration(read_from_file=False)
+    configuration.frames_master_chunk_frames = 4
+    configuration.frames_master_tile_mbytes = 0.01
+    # Every pixel alternates between two levels 100 apart, starting at a pixel dependent level. With
+    # 25 frames no value deviates by more than 1.04 sigma from the pixel mean, so sigma clipping
+    # never rejects any of these values.
+    frame_index, y, x = indices((25, 30, 40))
+    test_frames = (1000 + 3 * y + x + 100 * ((frame_index + y + x) % 2)).astype(uint16)
+
+    # A "cosmic ray" hits one pixel in a single frame. Sigma clipping must reject it and reproduce
+    # the mean of all other frames for this pixel.
+    test_frames[7, 12, 21] = 65535
+
+    masters = {}
+    for method in MasterFrameBuilder.methods:
+        masters[method] = MasterFrameBuilder(configuration, method=method).build(
+            iter(test_frames), test_frames.shape[0], test_frames.shape[1:], uint16)
+        assert masters[method].shape == test_frames.shape[1:]
+    assert allclose(masters['mean'], np_mean(test_frames, axis=0, dtype=float64))
+    assert array_equal(masters['median'], median(test_frames, axis=0))
+    others = test_frames[[index for index in range(25) if index != 7], 12, 21]
+    assert abs(masters['sigma-clip'][12, 21] - np_mean(others, dtype=float64)) < 0.01
+    assert masters['mean'][12, 21] > 3000.
+    masters['sigma-clip'][12, 21] = masters['mean'][12, 21]
+    assert allclose(masters['sigma-clip'], masters['mean'])
+    print("Master frame self-check passed")
@@ -731,6 +731,10 @@ class PlanetarySystemStacker(QtWidgets.QMainWindow):
                     'Postprocessing', 'Save postprocessed image']:
             # Make sure to remove any active interaction widget.
             self.display_widget(None, display=False)
+            # Later phases may have freed frame variants which are needed again. Restore the
+            # buffering selected for the job.
+            if task != 'Read frames' and self.workflow.frames is not None:
+                self.workflow.frames.restore_buffering()
             self.work_next_task(task)
 
         # Go back to the previous job and start with the first task.
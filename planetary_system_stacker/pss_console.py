@@ -1,11 +1,14 @@
 from argparse import ArgumentParser, ArgumentTypeError
 from time import sleep
 from glob import glob
+from os import path
+from re import split, sub
 
 from PyQt5 import QtCore
 
 from configuration import Configuration
 from exceptions import InternalError
+from frames import VirtualVideoReader
 from job_editor import Job
 from miscellaneous import Miscellaneous
 from workflow import Workflow
@@ -21,6 +24,20 @@ def ram_size_type(x):
     return x
 
 
+def frame_cache_type(x):
+    x = int(x)
+    if x < 0:
+        raise ArgumentTypeError("Frame cache size must be an integer >= 0")
+    return x
+
+
+def video_handles_type(x):
+    x = int(x)
+    if x < 1:
+        raise ArgumentTypeError("Number of video decoding handles must be an integer >= 1")
+    return x
+
+
 def noise_type(x):
     x = int(x)
     if not 0 <= x <= 11:
@@ -206,6 +223,49 @@ class PssConsole(QtCore.QObject):
                             help="Normalization black cut-off")
         parser.add_argument("--drizzle", choices=["Off", "1.5x", "2x", "3x"], default="Off",
                             help="Drizzle factor (Off, 1.5x, 2x, 3x)")
+        parser.add_argument("--sidecar_cache", action="store_true",
+                            help="Store derived frame data next to the input for re-use")
+        parser.add_argument("--raw_cfa", action="store_true",
+                            help="Buffer raw Bayer frames and debayer them on demand")
+        parser.add_argument("--spill_dir", default='',
+                            help="Directory for frame buffer scratch files if RAM is too small")
+        parser.add_argument("--transcode", action="store_true",
+                            help="Transcode compressed videos into an uncompressed cached copy")
+        parser.add_argument("--auto_crop", action="store_true",
+                            help="In Planet mode, crop frames to a window around the object")
+        parser.add_argument("--compress_buffers", choices=["zlib", "delta-zlib", "lzma"],
+                            default='', help="Keep buffered original and monochrome frames "
+                                             "compressed in RAM")
+        parser.add_argument("--gaussian_8bit", action="store_true",
+                            help="For 8bit input, store Gaussian-blurred frames with 8bit")
+        parser.add_argument("--join_segments", action="store_true",
+                            help="Stack the numbered input videos of each recording session "
+                                 "(same directory and name up to a trailing number) as one job")
+        parser.add_argument("--calibration_library", default='',
+                            help="Directory where master frames are stored and selected for jobs")
+        parser.add_argument("--raw_calibration", action="store_true",
+                            help="Create master frames from raw Bayer frames and calibrate before "
+                                 "debayering")
+        parser.add_argument("--hot_pixel_correction", action="store_true",
+                            help="Use the master dark only to replace hot and dead pixels instead "
+                                 "of subtracting it")
+        parser.add_argument("--ser_mmap", action="store_true",
+                            help="Access SER frames through a memory map of the file")
+        parser.add_argument("--prefetch", action="store_true",
+                            help="Read frames ahead in a background thread")
+        parser.add_argument("--buffer_planner", action="store_true",
+                            help="With automatic buffering, choose the buffering of each frame "
+                                 "variant from measured costs")
+        parser.add_argument("--arena_buffers", action="store_true",
+                            help="Keep fully buffered frame variants in contiguous arrays")
+        parser.add_argument("--roi_window", action="store_true",
+                            help="After the ROI is set, restrict frames to a window around it")
+        parser.add_argument("--frame_cache", type=frame_cache_type, default=0,
+                            help="RAM (MBytes) per frame variant for caching unbuffered frames "
+                                 "(0: keep only the last frame)")
+        parser.add_argument("--video_handles", type=video_handles_type, default=1,
+                            help="Number of capture handles which decode AVI/MP4 videos in "
+                                 "parallel (1: decode sequentially)")
 
         arguments = parser.parse_args()
         # self.print_arguments(arguments)
@@ -269,6 +329,23 @@ class PssConsole(QtCore.QObject):
         self.configuration.frames_normalization = arguments.normalize_bright
         self.configuration.frames_normalization_threshold = arguments.normalize_bco
         self.configuration.stack_frames_drizzle_factor_string = arguments.drizzle
+        self.configuration.frames_sidecar_cache = arguments.sidecar_cache
+        self.configuration.frames_raw_cfa_buffering = arguments.raw_cfa
+        self.configuration.frames_spill_directory = arguments.spill_dir
+        self.configuration.frames_video_transcode = arguments.transcode
+        self.configuration.frames_auto_crop = arguments.auto_crop
+        self.configuration.frames_buffer_compression = arguments.compress_buffers
+        self.configuration.frames_gaussian_8bit = arguments.gaussian_8bit
+        self.configuration.frames_calibration_library = arguments.calibration_library
+        self.configuration.frames_calibration_raw = arguments.raw_calibration
+        self.configuration.frames_hot_pixel_correction = arguments.hot_pixel_correction
+        self.configuration.frames_ser_memory_mapped = arguments.ser_mmap
+        self.configuration.frames_prefetching = arguments.prefetch
+        self.configuration.frames_buffer_planner = arguments.buffer_planner
+        self.configuration.frames_arena_buffers = arguments.arena_buffers
+        self.configuration.frames_roi_window = arguments.roi_window
+        self.configuration.frames_cache_budget_mbytes = arguments.frame_cache
+        self.configuration.frames_video_decoding_handles = arguments.video_handles
 
         # Re-compute derived parameters after the configuration was changed.
         self.configuration.set_derived_parameters()
@@ -327,6 +404,10 @@ class PssConsole(QtCore.QObject):
                                            " continune with next job.\n",
                         self.workflow.attached_log_file)
 
+        # If requested, join the video files of each recording session into one job.
+        if arguments.join_segments:
+            self.join_segments()
+
         self.job_number = len(self.jobs)
         if self.job_number == 0:
             if self.configuration.global_parameters_protocol_level > 0:
@@ -351,6 +432,71 @@ class PssConsole(QtCore.QObject):
                                        self.workflow.attached_log_file)
             self.signal_load_master_flat.emit(arguments.flat)
 
+    def join_segments(self):
+        """
+        Join video jobs which are segments of one recording session. Capture software numbers the
+        files of a session consecutively, so they are in the same directory and have the same name
+        up to a trailing number. The segments are joined in numerical order. Files which do not
+        match the frame format of the first segment stay separate jobs.
+
+        :return: -
+        """
+
+        sessions = {}
+        for job in self.jobs:
+            if job.type == 'video':
+                sessions.setdefault(PssConsole.session_name(job.name), []).append(job)
+
+        for session_jobs in sessions.values():
+            if len(session_jobs) < 2:
+                continue
+            session_jobs.sort(key=lambda job: PssConsole.natural_sort_key(job.name))
+            segments, rejected = VirtualVideoReader(self.configuration).matching_segments(
+                [job.name for job in session_jobs],
+                bayer_option_selected=self.configuration.frames_debayering_default)
+            if len(segments) > 1:
+                first_job = next(job for job in session_jobs if job.name == segments[0])
+                for job in session_jobs:
+                    if job.name in segments[1:]:
+                        first_job.add_segment(job.name)
+                        self.jobs.remove(job)
+            if self.configuration.global_parameters_protocol_level > 0:
+                if len(segments) > 1:
+                    Miscellaneous.protocol("+++ Joining video segments: " +
+                                           ", ".join(path.basename(name) for name in segments) +
+                                           " +++", self.workflow.attached_log_file)
+                if rejected:
+                    Miscellaneous.protocol("Warning: Video files not joined because they cannot "
+                                           "be read or their frame format differs: " +
+                                           ", ".join(path.basename(name) for name in rejected),
+                                           self.workflow.attached_log_file)
+
+    @staticmethod
+    def session_name(name):
+        """
+        Derive the name of the recording session from the name of a video file: the directory
+        and the file name without extension and without a trailing segment number.
+
+        :param name: Path name of the video file
+        :return: Session name (str)
+        """
+
+        stem, extension = path.splitext(path.abspath(name))
+        return sub(r'[-_. ]*\d+$', '', stem) + extension.lower()
+
+    @staticmethod
+    def natural_sort_key(name):
+        """
+        Sort key for file names which orders embedded numbers numerically, so that "capture_10"
+        follows "capture_9".
+
+        :param name: File name
+        :return: List with text parts (in lower case) and numbers
+        """
+
+        return [int(part) if part.isdigit() else part.lower() for part in
+                split(r'(\d+)', path.splitext(name)[0])]
+
     @QtCore.pyqtSlot(str)
     def report_calibration_error(self, message):
         if self.configuration.global_parameters_protocol_level > 0:
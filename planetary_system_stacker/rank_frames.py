@@ -56,6 +56,8 @@ class RankFrames(object):
         """
 
 
+        # A window set for a previous ROI does not apply when this phase is repeated.
+        frames.reset_window()
         self.shape = frames.shape
         self.configuration = configuration
         self.frames = frames
@@ -98,32 +100,33 @@ class RankFrames(object):
         if self.frames.index_translation_active:
             self.frames.reset_index_translation()
 
-        # For all frames compute the quality with the selected method.
-        if method != Miscellaneous.local_contrast_laplace:
-            for frame_index in range(self.number_original):
-                frame = self.frames.frames_mono_blurred(frame_index)
-                if self.progress_signal is not None and frame_index % self.signal_step_size == 1:
-                    self.progress_signal.emit("Rank all frames",
-                                              int(round(10*frame_index / self.number_original) * 10))
-                if self.configuration.frames_normalization:
-                    self.frame_ranks_original.append(
-                        method(frame, self.configuration.rank_frames_pixel_stride) /
-                        self.frames.average_brightness(frame_index))
-                else:
-                    self.frame_ranks_original.append(
-                        method(frame, self.configuration.rank_frames_pixel_stride))
+        # If the frame ranks have been stored in the sidecar cache by a previous run with the same
+        # parameters, re-use them.
+        frame_ranks_cached = self.frames.sidecar_lookup_all('frame_ranks')
+        if frame_ranks_cached is not None:
+            self.frame_ranks_original = list(frame_ranks_cached)
         else:
-            for frame_index in range(self.number_original):
-                frame = self.frames.frames_mono_blurred_laplacian(frame_index)
-                # self.frame_ranks.append(mean((frame - frame.mean())**2))
+            # For all frames compute the quality with the selected method. Frames which have to be
+            # read from the input are read ahead in a background thread. All derived frame
+            # variants are computed in one pass when a frame is read.
+            if method != Miscellaneous.local_contrast_laplace:
+                variant = 'gaussian'
+            else:
+                variant = 'laplacian'
+            self.frames.prefetch(range(self.number_original), variant)
+            for frame_index, frame, brightness in self.frames.preprocess(
+                    range(self.number_original), variant):
                 if self.progress_signal is not None and frame_index % self.signal_step_size == 1:
                     self.progress_signal.emit("Rank all frames",
                                               int(round(10*frame_index / self.number_original) * 10))
-                if self.configuration.frames_normalization:
-                    self.frame_ranks_original.append(meanStdDev(frame)[1][0][0] /
-                        self.frames.average_brightness(frame_index))
+                if method != Miscellaneous.local_contrast_laplace:
+                    frame_rank = method(frame, self.configuration.rank_frames_pixel_stride)
                 else:
-                    self.frame_ranks_original.append(meanStdDev(frame)[1][0][0])
+                    frame_rank = meanStdDev(frame)[1][0][0]
+                if self.configuration.frames_normalization:
+                    frame_rank /= brightness
+                self.frame_ranks_original.append(frame_rank)
+            self.frames.sidecar_store_all('frame_ranks', self.frame_ranks_original)
 
         # Sort the frame indices in descending order of quality.
         self.quality_sorted_indices_original = sorted(range(self.number_original),
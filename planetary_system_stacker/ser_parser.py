@@ -34,7 +34,7 @@ class SERParser(object):
     __version__ = '1.1'
     __name__ = 'SER parser for PlanetarySystemStacker tool (PSS)'
 
-    def __init__(self, ser_file, SER_16bit_shift_correction=True):
+    def __init__(self, ser_file, SER_16bit_shift_correction=True, memory_mapped=False):
         """
         Parse video files of type SER (8 or 16 bit). Provide access to individual frames based on
         the frame index.
@@ -44,6 +44,10 @@ class SERParser(object):
                                            are analyzed to find the number of unused high bits in
                                            pixel data. In read operations data are shifted up by
                                            this number of bits.
+        :param memory_mapped: If True, the image data region of the file is mapped into memory
+                              as one array of shape (FrameCount, ImageHeight, ImageWidth[,
+                              NumberOfPlanes]). Frames are then returned as views into this array,
+                              without a seek / read operation and without copying the data.
         """
         super().__init__()
 
@@ -72,14 +76,46 @@ class SERParser(object):
             # Until FireCatpure 2.7 this flag was not set properly.
             self.PixelDepthPerPlane = np.dtype(np.uint16).newbyteorder('<')
 
-            # Test how many of the 16 bits are not used. Set the parameter which is used from now
-            # on to shift pixel values such that the full 16bit range is used.
-            if SER_16bit_shift_correction:
-                self.correct_dynamic_range()
+        # Optionally map the image data of all frames into memory. This must be done after the
+        # pixel type has been set, and before any frame is read. If the file is too short (e.g. an
+        # interrupted capture), the mapping fails. In this case fall back to conventional file
+        # reading.
+        self.frames_mapped = None
+        if memory_mapped:
+            self.frames_mapped = self.map_frames(ser_file)
+
+        # Test how many of the 16 bits are not used. Set the parameter which is used from now on to
+        # shift pixel values such that the full 16bit range is used.
+        if self.PixelDepthPerPlane.itemsize == 2 and SER_16bit_shift_correction:
+            self.correct_dynamic_range()
 
         self.color = 8 <= self.header['ColorID'] <= 19 and self.header['DebayerPattern'] is not None \
                      or 100 <= self.header['ColorID'] <= 101
 
+    def map_frames(self, ser_file):
+        """
+        Map the "Image Data" region of the SER file into memory (read-only). Individual frames can
+        then be accessed as views into the mapped array, so that the OS page cache is used directly
+        and no data are copied.
+
+        :param ser_file: Full name of the video file.
+        :return: Numpy memmap object of shape (FrameCount, ImageHeight, ImageWidth) or
+                 (FrameCount, ImageHeight, ImageWidth, NumberOfPlanes). None, if the file could
+                 not be mapped.
+        """
+
+        if self.header['NumberOfPlanes'] == 1:
+            shape = (self.frame_count, self.header['ImageHeight'], self.header['ImageWidth'])
+        else:
+            shape = (self.frame_count, self.header['ImageHeight'], self.header['ImageWidth'],
+                     self.header['NumberOfPlanes'])
+
+        try:
+            return np.memmap(ser_file, dtype=self.PixelDepthPerPlane, mode='r', offset=178,
+                             shape=shape)
+        except (ValueError, OSError):
+            return None
+
     def sanity_check(self, ser_file):
         warn_message = None
         if not os.path.isfile(ser_file):
@@ -186,21 +222,32 @@ class SERParser(object):
         Read the "Image Data" of SER file. Return the 2D or 3D image data without changing the
         content (e.g. debayering or conversion to / from grayscale).
 
+        If the file is memory-mapped, the frame is returned as a read-only view into the mapped
+        array (if "shift_pixels" is not zero, the shifted copy is returned).
+
         :return:    image_data: Multi dimmensional Numpy array containig image frame data.
         """
 
         if frame_number is None:
             frame_number = self.frame_number + 1
 
-        if 0 <= frame_number < self.frame_count:
-            if frame_number != self.frame_number + 1:
-                if frame_number == 0:
-                    self.fid.seek(178)
-                else:
-                    self.fid.seek(178 + frame_number * self.frame_size)
-        else:
+        if not 0 <= frame_number < self.frame_count:
             raise IOError('Error in reading SER frame, index: {0} is out of bounds'.format(frame_number))
 
+        # Memory-mapped access: no seek / read necessary.
+        if self.frames_mapped is not None:
+            self.frame_number = frame_number
+            if self.shift_pixels:
+                return self.frames_mapped[frame_number] << self.shift_pixels
+            else:
+                return self.frames_mapped[frame_number]
+
+        if frame_number != self.frame_number + 1:
+            if frame_number == 0:
+                self.fid.seek(178)
+            else:
+                self.fid.seek(178 + frame_number * self.frame_size)
+
         self.frame_number = frame_number
 
         if self.header['NumberOfPlanes'] == 1:
@@ -226,6 +273,100 @@ class SERParser(object):
                     self.header['ImageHeight'], self.header['ImageWidth'],
                     self.header['NumberOfPlanes'])
 
+    def frame_shape(self):
+        """
+        Compute the shape of the raw image data of a single frame.
+
+        :return: (ImageHeight, ImageWidth) or (ImageHeight, ImageWidth, NumberOfPlanes)
+        """
+
+        if self.header['NumberOfPlanes'] == 1:
+            return self.header['ImageHeight'], self.header['ImageWidth']
+        else:
+            return self.header['ImageHeight'], self.header['ImageWidth'], \
+                   self.header['NumberOfPlanes']
+
+    def read_frames(self, start, count, out=None):
+        """
+        Read the "Image Data" of a contiguous block of frames with a single read operation. As
+        with "read_frame_raw", the data are returned without changing the content, except for the
+        shift by "shift_pixels", which is applied in place.
+
+        :param start: Index of the first frame.
+        :param count: Number of frames.
+        :param out: Optional buffer with at least "count" frames of the raw frame shape and
+                    type. If None, a new buffer is allocated.
+        :return: View of shape (count, ImageHeight, ImageWidth[, NumberOfPlanes]) into the buffer.
+        """
+
+        if count < 1 or not 0 <= start or start + count > self.frame_count:
+            raise IOError('Error in reading SER frames, index range: {0} - {1} is out of '
+                          'bounds'.format(start, start + count - 1))
+
+        block_shape = (count,) + self.frame_shape()
+        if out is None:
+            block = np.empty(block_shape, dtype=self.PixelDepthPerPlane)
+        else:
+            if out.shape[1:] != block_shape[1:] or out.shape[0] < count or \
+                    out.dtype != self.PixelDepthPerPlane or not out.flags['C_CONTIGUOUS']:
+                raise ValueError('Buffer does not match the SER frame format')
+            block = out[:count]
+
+        # Memory-mapped access: copy the frames from the mapped array.
+        if self.frames_mapped is not None:
+            block[:] = self.frames_mapped[start:start + count]
+        else:
+            if start != self.frame_number + 1:
+                self.fid.seek(178 + start * self.frame_size)
+            if self.fid.readinto(block.reshape(-1).view(np.uint8)) != count * self.frame_size:
+                raise IOError('Error in reading SER frames, index range: {0} - {1}'.format(
+                    start, start + count - 1))
+
+        self.frame_number = start + count - 1
+
+        # If the pixel values do not use the full dynamic range, shift them accordingly.
+        if self.shift_pixels:
+            np.left_shift(block, self.shift_pixels, out=block)
+
+        return block
+
+    def read_frame_rows(self, frame_number, y_low, y_high):
+        """
+        Read a range of image rows of a frame. Only the bytes of these rows are read from the file
+        (or touched in the memory-mapped file). As with "read_frame_raw", the content is not
+        changed, except for the shift by "shift_pixels".
+
+        :param frame_number: Frame index
+        :param y_low: First row
+        :param y_high: Row after the last row
+        :return: Array of shape (y_high-y_low, ImageWidth[, NumberOfPlanes])
+        """
+
+        if not 0 <= frame_number < self.frame_count:
+            raise IOError('Error in reading SER frame, index: {0} is out of bounds'.format(frame_number))
+        if not 0 <= y_low < y_high <= self.header['ImageHeight']:
+            raise IOError('Error in reading SER frame rows, range: {0} - {1} is out of '
+                          'bounds'.format(y_low, y_high))
+
+        if self.frames_mapped is not None:
+            rows = self.frames_mapped[frame_number, y_low:y_high]
+        else:
+            row_size = self.frame_size // self.header['ImageHeight']
+            self.fid.seek(178 + frame_number * self.frame_size + y_low * row_size)
+            rows = np.frombuffer(self.fid.read((y_high - y_low) * row_size),
+                                 dtype=self.PixelDepthPerPlane).reshape(
+                                 (y_high - y_low,) + self.frame_shape()[1:])
+            # Position the file at the start of the next frame, so that sequential reads continue
+            # without a seek.
+            self.fid.seek(178 + (frame_number + 1) * self.frame_size)
+
+        self.frame_number = frame_number
+
+        if self.shift_pixels:
+            return rows << self.shift_pixels
+        else:
+            return rows
+
     def read_frame(self, frame_number=None):
         """
         Read the "Image Data" of SER file.
@@ -236,45 +377,42 @@ class SERParser(object):
         if frame_number is None:
             frame_number = self.frame_number + 1
 
-        if 0 <= frame_number < self.frame_count:
+        if not 0 <= frame_number < self.frame_count:
+            raise IOError('Error in reading SER frame, index: {0} is out of bounds'.format(frame_number))
+
+        # Look up the frame data, either in the memory-mapped file or by reading from the file.
+        if self.frames_mapped is not None:
+            image_data = self.frames_mapped[frame_number]
+        else:
             if frame_number != self.frame_number + 1:
                 if frame_number == 0:
                     self.fid.seek(178)
                 else:
                     self.fid.seek(178 + frame_number * self.frame_size)
-        else:
-            raise IOError('Error in reading SER frame, index: {0} is out of bounds'.format(frame_number))
+            if self.header['NumberOfPlanes'] == 1:
+                image_data = np.frombuffer(self.fid.read(self.frame_size),
+                        dtype=self.PixelDepthPerPlane).reshape(
+                        self.header['ImageHeight'],
+                        self.header['ImageWidth'])
+            else:
+                image_data = np.frombuffer(self.fid.read(self.frame_size),
+                        dtype=self.PixelDepthPerPlane).reshape(
+                        self.header['ImageHeight'],
+                        self.header['ImageWidth'],
+                        self.header['NumberOfPlanes'])
 
         self.frame_number = frame_number
 
         if self.header['NumberOfPlanes'] == 1:
             if self.color:
-                return cv2.cvtColor(
-                        np.frombuffer(self.fid.read(self.frame_size),
-                        dtype=self.PixelDepthPerPlane).reshape(
-                        self.header['ImageHeight'],
-                        self.header['ImageWidth']),
-                        self.header['DebayerPattern'])
+                return cv2.cvtColor(image_data, self.header['DebayerPattern'])
             else:
-                return np.frombuffer(self.fid.read(self.frame_size),
-                        dtype=self.PixelDepthPerPlane).reshape(
-                        self.header['ImageHeight'],
-                        self.header['ImageWidth'])
+                return image_data
         else:
             if self.header['ColorID'] == 101:
-                return cv2.cvtColor(
-                        np.frombuffer(self.fid.read(self.frame_size),
-                        dtype=self.PixelDepthPerPlane).reshape(
-                        self.header['ImageHeight'],
-                        self.header['ImageWidth'],
-                        self.header['NumberOfPlanes']),
-                        cv2.COLOR_BGR2RGB)
+                return cv2.cvtColor(image_data, cv2.COLOR_BGR2RGB)
             else:
-                return np.frombuffer(self.fid.read(self.frame_size),
-                        dtype=self.PixelDepthPerPlane).reshape(
-                        self.header['ImageHeight'],
-                        self.header['ImageWidth'],
-                        self.header['NumberOfPlanes'])
+                return image_data
 
     def read_all_frames(self):
         return [self.read_frame(idx) for idx in range(self.frame_count)]
@@ -296,8 +434,11 @@ class SERParser(object):
         else:
             frame_ids = [0]
 
-        # Compute the maximal value of a (color) channel pixel within the sample.
-        max_pixel_value = max([np.max(self.read_frame_raw(frame_id)) for frame_id in frame_ids])
+        # Compute the maximal value of a (color) channel pixel within the sample. Re-use one buffer
+        # for reading the sample frames.
+        buffer = np.empty((1,) + self.frame_shape(), dtype=self.PixelDepthPerPlane)
+        max_pixel_value = max([np.max(self.read_frames(frame_id, 1, out=buffer)) for frame_id in
+                               frame_ids])
 
         # Compute the number of unused "head room" bits. Subsequent calls to "read_frame_raw"
         # will return pixel values left-shifted by this number.
@@ -327,6 +468,9 @@ class SERParser(object):
             return None
 
     def release(self):
+        # Drop the reference to the memory-mapped frames. The mapping is closed as soon as no
+        # frame views are referenced any more.
+        self.frames_mapped = None
         self.fid.close()
 
 
@@ -336,6 +480,52 @@ if __name__ == "__main__":
     import matplotlib
     matplotlib.use('Agg')
     import matplotlib.pyplot as plt
+    from tempfile import mkdtemp
+    from shutil import rmtree
+
+    # Self-check with synthetic SER files: Memory-mapped access, block reads and row reads must
+    # return the same frames as conventional frame-by-frame reads, and the unused high bits of
+    # 12bit data in a 16bit file must be detected. 8bit frames are returned as views into the
+    # memory map. If the file is shorter than stated in its header, it is read conventionally.
+    test_dir = mkdtemp()
+
+    def write_test_file(name, frames, frame_count):
+        file_path = os.path.join(test_dir, name)
+        with open(file_path, 'wb') as test_fid:
+            test_fid.write(struct.pack('<14s 7i 40s 40s 40s 2q', b'LUCAM-RECORDER', 0, 0, 1, 30,
+                                       20, 8 * frames.itemsize, frame_count, b'', b'', b'', 0, 0))
+            test_fid.write(frames.tobytes())
+        return file_path
+
+    test_frames = np.random.randint(0, 4096, (7, 20, 30)).astype('<u2')
+    test_frames[3, 5, 7] = 4095
+    test_file = write_test_file('test_16bit.ser', test_frames, 7)
+    for mapped in [False, True]:
+        test_cap = ser_parser.SERParser(test_file, memory_mapped=mapped)
+        assert (test_cap.frames_mapped is not None) == mapped
+        assert test_cap.shift_pixels == 4
+        for index in range(7):
+            assert np.array_equal(test_cap.read_frame(index), test_frames[index])
+            assert np.array_equal(test_cap.read_frame_raw(index), test_frames[index] << 4)
+        assert np.array_equal(test_cap.read_frames(2, 4), test_frames[2:6] << 4)
+        test_block = np.empty((5, 20, 30), dtype=test_cap.PixelDepthPerPlane)
+        assert np.array_equal(test_cap.read_frames(0, 5, out=test_block), test_frames[:5] << 4)
+        assert np.array_equal(test_cap.read_frame_rows(6, 3, 9), test_frames[6, 3:9] << 4)
+        test_cap.release()
+
+    test_frames_8bit = (test_frames >> 4).astype(np.uint8)
+    test_cap = ser_parser.SERParser(write_test_file('test_8bit.ser', test_frames_8bit, 7),
+                                    memory_mapped=True)
+    assert np.array_equal(test_cap.read_frame(2), test_frames_8bit[2])
+    assert np.shares_memory(test_cap.read_frame(2), test_cap.frames_mapped)
+    test_cap.release()
+    test_cap = ser_parser.SERParser(write_test_file('test_truncated.ser', test_frames_8bit[:5], 7),
+                                    memory_mapped=True)
+    assert test_cap.frames_mapped is None
+    assert np.array_equal(test_cap.read_frame(4), test_frames_8bit[4])
+    test_cap.release()
+    rmtree(test_dir)
+    print("SER parser self-check passed")
 
     # file_path = r'E:\SW-Development\Python\PlanetarySystemStacker\Examples\SER_Chris-Garry' \
     #             r'\SER_GRAYSCALED_12bit_BigEndian_352_400.ser'
@@ -347,6 +537,12 @@ if __name__ == "__main__":
     #               r'\LauraMS_AR12680_2017-09-17_T_11-44-23-0221_SolarContinuum.ser'
     file_path = r'D:\SW-Development\Python\PlanetarySystemStacker\Examples\SER_Steffen-Elste\garten_1024x768-000001__16-18-36__data.ser'
 
+    # The example recordings are not part of the repository. Stop after the self-check if they are
+    # not available.
+    if not os.path.isfile(file_path):
+        print("Example input " + file_path + " not found, SER parser demo skipped")
+        exit()
+
     cap = ser_parser.SERParser(file_path)
     if cap.warn_message is not None:
         print (cap.warn_message)
@@ -0,0 +1,331 @@
+# -*- coding: utf-8; -*-
+"""
+Copyright (c) 2018 Rolf Hempel, rolf6419@gmx.de
+
+This file is part of the PlanetarySystemStacker tool (PSS).
+https://github.com/Rolf-Hempel/PlanetarySystemStacker
+
+PSS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PSS.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+from hashlib import sha1
+from json import dump, load, dumps
+from os import makedirs, remove, listdir, stat
+from os.path import join, isfile, abspath, dirname, splitext
+
+from numpy import array, uint8
+from numpy.lib.format import open_memmap
+
+from exceptions import ArgumentError
+
+
+class SidecarCache(object):
+    """
+    Persistent on-disk store of per-frame data derived from an input video or image directory
+    (e.g. Gaussian-blurred frames, Laplacians, average brightness values and frame ranks). The
+    data are kept in a directory next to the input. Every product is a memory-mapped ".npy" array
+    with one entry per (original) frame index, plus a bitmap which marks the entries computed
+    already. A JSON manifest records the identity of the input file(s) and the parameters each
+    product depends on.
+
+    A product is registered with the parameters which affect its values. If a product with the
+    same parameters exists from a previous run, it is re-used. Otherwise a new (empty) product is
+    created. If the input file(s) have changed since the cache was written, all products are
+    discarded.
+
+    """
+
+    manifest_name = 'manifest.json'
+    cache_version = 1
+
+    def __init__(self, names, number_frames, type='video'):
+        """
+        Open (or create) the sidecar cache for a given input.
+
+        :param names: In case of a video: name of the video file, or list of names of video files
+                      which are segments of one recording session. In case of images: list of
+                      names for all images.
+        :param number_frames: Number of frames in the input.
+        :param type: Either "video" or "image".
+        """
+
+        self.directory = SidecarCache.cache_directory(names, type=type)
+        self.number = number_frames
+        self.source = SidecarCache.source_identity(names)
+
+        # Dictionaries with the open memory maps (data and validity bitmap) of registered
+        # products.
+        self.data = {}
+        self.valid = {}
+
+        makedirs(self.directory, exist_ok=True)
+
+        # Read the manifest of a previous run. If it does not match the current input, start
+        # with an empty cache.
+        self.manifest = self.read_manifest()
+        if self.manifest is None or \
+                self.manifest.get('version') != SidecarCache.cache_version or \
+                self.manifest.get('source') != self.source or \
+                self.manifest.get('number') != self.number or 'products' not in self.manifest:
+            self.clear()
+
+    @staticmethod
+    def cache_directory(names, type='video'):
+        """
+        Compute the name of the cache directory for a given input. For a video it is placed next
+        to the video file (the first segment, if the video is split into several files), for an
+        image directory it is a subdirectory.
+
+        :param names: Name of the video file, or list of video segment or image file names.
+        :param type: Either "video" or "image".
+        :return: Path name of the cache directory.
+        """
+
+        if type == 'video' and isinstance(names, list):
+            return splitext(abspath(names[0]))[0] + '.segments.pss_cache'
+        elif isinstance(names, list):
+            return join(dirname(abspath(names[0])), 'pss_cache')
+        else:
+            return splitext(abspath(names))[0] + '.pss_cache'
+
+    @staticmethod
+    def source_identity(names):
+        """
+        Compute a description of the input file(s) which changes if any input file is modified.
+
+        :param names: Name of the video file, or list of image file names.
+        :return: List with [path, size, modification time] for each input file.
+        """
+
+        if not isinstance(names, list):
+            names = [names]
+
+        identity = []
+        for name in names:
+            file_stat = stat(name)
+            identity.append([abspath(name), file_stat.st_size, file_stat.st_mtime_ns])
+        return identity
+
+    def read_manifest(self):
+        """
+        Read the manifest file of the cache directory.
+
+        :return: Manifest dictionary, or None if no valid manifest exists.
+        """
+
+        manifest_path = join(self.directory, SidecarCache.manifest_name)
+        if not isfile(manifest_path):
+            return None
+        try:
+            with open(manifest_path, 'r') as manifest_file:
+                return load(manifest_file)
+        except (OSError, ValueError):
+            return None
+
+    def write_manifest(self):
+        """
+        Write the manifest file to the cache directory.
+
+        :return: -
+        """
+
+        with open(join(self.directory, SidecarCache.manifest_name), 'w') as manifest_file:
+            dump(self.manifest, manifest_file, indent=1)
+
+    def clear(self):
+        """
+        Remove all products from the cache directory and start with an empty manifest.
+
+        :return: -
+        """
+
+        self.data = {}
+        self.valid = {}
+        for file_name in listdir(self.directory):
+            if file_name.endswith('.npy') or file_name == SidecarCache.manifest_name:
+                remove(join(self.directory, file_name))
+
+        self.manifest = {'version': SidecarCache.cache_version, 'source': self.source,
+                         'number': self.number, 'products': {}}
+        self.write_manifest()
+
+    def register(self, product, parameters, shape, dtype):
+        """
+        Register a product with the parameters which affect its values. If the product has been
+        stored with the same parameters before, the stored data are used. Otherwise an empty
+        product is created.
+
+        :param product: Name of the product, e.g. 'gaussian'.
+        :param parameters: Dictionary with all parameters the product depends on. Values must be
+                           JSON serializable.
+        :param shape: Shape of the entry for a single frame. Use () for scalar values.
+        :param dtype: Numpy dtype of the product.
+        :return: True, if the product could be opened or created. False otherwise.
+        """
+
+        key = sha1(dumps(parameters, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        file_name = product + '_' + key
+        data_path = join(self.directory, file_name + '.npy')
+        valid_path = join(self.directory, file_name + '_valid.npy')
+        full_shape = (self.number,) + tuple(shape)
+
+        try:
+            if file_name in self.manifest['products'] and isfile(data_path) and \
+                    isfile(valid_path):
+                data = open_memmap(data_path, mode='r+')
+                valid = open_memmap(valid_path, mode='r+')
+                if data.shape != full_shape or data.dtype != dtype or \
+                        valid.shape != (self.number,):
+                    raise ValueError("Cached product " + file_name + " does not match")
+            else:
+                data = open_memmap(data_path, mode='w+', dtype=dtype, shape=full_shape)
+                valid = open_memmap(valid_path, mode='w+', dtype=uint8, shape=(self.number,))
+                self.manifest['products'][file_name] = {'product': product,
+                                                        'parameters': parameters}
+                self.write_manifest()
+        except (OSError, ValueError):
+            return False
+
+        self.data[product] = data
+        self.valid[product] = valid
+        return True
+
+    def available(self, product, index):
+        """
+        Check if a product entry is stored for a given frame.
+
+        :param product: Name of the product.
+        :param index: Original frame index.
+        :return: True, if the entry is stored. False otherwise.
+        """
+
+        return product in self.valid and bool(self.valid[product][index])
+
+    def get(self, product, index):
+        """
+        Look up a product entry for a given frame.
+
+        :param product: Name of the product.
+        :param index: Original frame index.
+        :return: Copy of the stored entry, or None if it is not available.
+        """
+
+        if not self.available(product, index):
+            return None
+        return array(self.data[product][index])
+
+    def put(self, product, index, value):
+        """
+        Store a product entry for a given frame. If the product is not registered, do nothing.
+
+        :param product: Name of the product.
+        :param index: Original frame index.
+        :param value: Entry to be stored.
+        :return: -
+        """
+
+        if product not in self.data:
+            return
+        self.data[product][index] = value
+        self.valid[product][index] = 1
+
+    def get_all(self, product):
+        """
+        Look up the entries of a product for all frames.
+
+        :param product: Name of the product.
+        :return: Copy of the stored product array, or None if not all entries are available.
+        """
+
+        if product not in self.valid or not self.valid[product].all():
+            return None
+        return array(self.data[product])
+
+    def put_all(self, product, values):
+        """
+        Store the entries of a product for all frames.
+
+        :param product: Name of the product.
+        :param values: Sequence with one entry per frame.
+        :return: -
+        """
+
+        if product not in self.data:
+            return
+        if len(values) != self.number:
+            raise ArgumentError("Number of values does not match the number of frames")
+        self.data[product][:] = values
+        self.valid[product][:] = 1
+
+    def close(self):
+        """
+        Write all pending changes to disk and release the memory maps.
+
+        :return: -
+        """
+
+        for memory_map in list(self.data.values()) + list(self.valid.values()):
+            memory_map.flush()
+        self.data = {}
+        self.valid = {}
+
+
+if __name__ == "__main__":
+    from shutil import rmtree
+    from tempfile import mkdtemp
+
+    from numpy import array_equal, float32
+    from numpy.random import randint
+
+    # Self-check: Entries stored in one run must be found in the next run with the same
+    # parameters, but not with different parameters or after the input file has changed.
+    test_dir = mkdtemp()
+    test_file = join(test_dir, 'test.ser')
+    with open(test_file, 'wb') as test_fid:
+        test_fid.write(b'0' * 100)
+    test_frames = randint(0, 65536, (6, 20, 30)).astype('uint16')
+    test_brightness = test_frames.mean(axis=(1, 2)).astype(float32)
+    parameters = {'gauss_width': 7}
+
+    cache = SidecarCache(test_file, 6)
+    assert cache.register('gaussian', parameters, (20, 30), 'uint16')
+    assert cache.register('brightness', {}, (), float32)
+    cache.put('gaussian', 2, test_frames[2])
+    cache.put('gaussian', 4, test_frames[4])
+    cache.put('unregistered', 0, test_frames[0])
+    assert cache.get_all('brightness') is None
+    cache.put_all('brightness', test_brightness)
+    cache.close()
+
+    cache = SidecarCache(test_file, 6)
+    assert cache.register('gaussian', parameters, (20, 30), 'uint16')
+    assert cache.register('brightness', {}, (), float32)
+    assert [cache.available('gaussian', index) for index in range(6)] == \
+           [False, False, True, False, True, False]
+    assert array_equal(cache.get('gaussian', 4), test_frames[4])
+    assert cache.get('gaussian', 0) is None
+    assert array_equal(cache.get_all('brightness'), test_brightness)
+    assert cache.register('gaussian', {'gauss_width': 9}, (20, 30), 'uint16')
+    assert not cache.available('gaussian', 4)
+    cache.close()
+
+    with open(test_file, 'ab') as test_fid:
+        test_fid.write(b'0')
+    cache = SidecarCache(test_file, 6)
+    assert cache.register('gaussian', parameters, (20, 30), 'uint16')
+    assert not cache.available('gaussian', 2)
+    cache.close()
+    rmtree(test_dir)
+    print("Sidecar cache self-check passed")
@@ -334,8 +334,25 @@ class StackFrames(object):
         # Initialize widths of border areas where artifacts occur because not all patches contribute.
         self.border_y_low = self.border_y_high = self.border_x_low = self.border_x_high = 0
 
-        # Go through the list of all frames.
-        for frame_index in range(self.frames.number):
+        # Only frames which contribute to at least one alignment point or to the background have
+        # to be read (and debayered). Frames without any contribution are skipped.
+        if self.number_stacking_holes > 0:
+            background_frame_indices = set(
+                self.rank_frames.quality_sorted_indices[:self.alignment_points.stack_size])
+        else:
+            background_frame_indices = set()
+        frame_indices_stacked = [frame_index for frame_index in range(self.frames.number) if
+                                 self.frames.used_alignment_points[frame_index] or
+                                 frame_index in background_frame_indices]
+
+        # Frames which do not contribute are not needed any more. Free their buffered variants.
+        self.frames.retain_frames({'original': frame_indices_stacked,
+                                   'gaussian': frame_indices_stacked})
+
+        # Go through the list of contributing frames. The original frames are read ahead in a
+        # background thread if they are not buffered.
+        self.frames.prefetch(frame_indices_stacked, 'original')
+        for frame_index in frame_indices_stacked:
 
             # If brightness normalization is switched on, change the brightness of this frame to
             # the median of all frames.
@@ -456,9 +473,7 @@ class StackFrames(object):
 
             # If there are holes between AP patches, add this frame's contribution (if any) to the
             # averaged background image.
-            if self.number_stacking_holes > 0 and \
-                    frame_index in self.rank_frames.quality_sorted_indices[
-                        :self.alignment_points.stack_size]:
+            if frame_index in background_frame_indices:
                 self.my_timer.start('Stacking: computing background')
 
                 # Treat the case that the background is computed for specific patches only.
@@ -0,0 +1,188 @@
+# -*- coding: utf-8; -*-
+"""
+Copyright (c) 2018 Rolf Hempel, rolf6419@gmx.de
+
+This file is part of the PlanetarySystemStacker tool (PSS).
+https://github.com/Rolf-Hempel/PlanetarySystemStacker
+
+PSS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PSS.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+from json import dump, load
+from os import remove, replace
+from os.path import abspath, isfile, splitext
+
+from numpy.lib.format import open_memmap
+
+from sidecar_cache import SidecarCache
+
+
+class TranscodedVideo(object):
+    """
+    Uncompressed copy of a compressed video (AVI, MOV, MP4, ...) in a memory-mappable ".npy"
+    container next to the video file. Frames are stored as delivered by OpenCV (i.e. before
+    debayering), so the debayer options can be changed without transcoding again. A JSON manifest
+    records the identity of the video file, the number of frames, and the Bayer pattern detected
+    when the video was opened first.
+
+    Reading frames from the container replaces codec decoding with plain memory-mapped I/O. This
+    pays off if frames are read more than once, i.e. if original frames are not buffered, and for
+    re-runs of the same job.
+
+    """
+
+    container_version = 1
+
+    def __init__(self, file_path):
+        """
+        Set the names of the container and manifest files for a video.
+
+        :param file_path: Full name of the video file.
+        """
+
+        self.file_path = file_path
+        base_name = splitext(abspath(file_path))[0]
+        self.data_path = base_name + '.pss_transcoded.npy'
+        self.manifest_path = base_name + '.pss_transcoded.json'
+        self.data = None
+        self.frame_count = None
+        self.bayer_pattern = None
+
+    def open(self):
+        """
+        Open the container of a previous run, if it exists and matches the video file.
+
+        :return: True, if the container could be opened. False otherwise.
+        """
+
+        if not isfile(self.manifest_path) or not isfile(self.data_path):
+            return False
+        try:
+            with open(self.manifest_path, 'r') as manifest_file:
+                manifest = load(manifest_file)
+            if manifest.get('version') != TranscodedVideo.container_version or \
+                    manifest.get('source') != SidecarCache.source_identity(self.file_path):
+                return False
+            data = open_memmap(self.data_path, mode='r')
+            frame_count = manifest['frame_count']
+            if not 0 < frame_count <= data.shape[0]:
+                return False
+        except (OSError, ValueError, KeyError):
+            return False
+
+        self.data = data[:frame_count]
+        self.frame_count = frame_count
+        self.bayer_pattern = manifest.get('bayer_pattern')
+        return True
+
+    def create(self, capture, first_frame, frame_count, bayer_pattern):
+        """
+        Transcode the video into the container. The container is written under a temporary name
+        and renamed when complete, so an interrupted transcoding is never used.
+
+        :param capture: OpenCV VideoCapture object, positioned after the first frame.
+        :param first_frame: First frame, as read by OpenCV.
+        :param frame_count: Number of frames reported by OpenCV. If the video ends early, the
+                            number of frames actually read is recorded.
+        :param bayer_pattern: Bayer pattern detected for the video, or None.
+        :return: True, if the container was created and opened. False otherwise.
+        """
+
+        temporary_path = self.data_path + '.part'
+        try:
+            data = open_memmap(temporary_path, mode='w+', dtype=first_frame.dtype,
+                               shape=(frame_count,) + first_frame.shape)
+            data[0] = first_frame
+            frames_read = 1
+            while frames_read < frame_count:
+                ret, frame = capture.read()
+                if not ret:
+                    break
+                data[frames_read] = frame
+                frames_read += 1
+            data.flush()
+            del data
+            replace(temporary_path, self.data_path)
+
+            manifest = {'version': TranscodedVideo.container_version,
+                        'source': SidecarCache.source_identity(self.file_path),
+                        'frame_count': frames_read, 'bayer_pattern': bayer_pattern}
+            with open(self.manifest_path, 'w') as manifest_file:
+                dump(manifest, manifest_file, indent=1)
+        except (OSError, ValueError):
+            if isfile(temporary_path):
+                remove(temporary_path)
+            return False
+
+        return self.open()
+
+    def close(self):
+        """
+        Release the memory map.
+
+        :return: -
+        """
+
+        self.data = None
+
+
+if __name__ == "__main__":
+    from os.path import join
+    from shutil import rmtree
+    from tempfile import mkdtemp
+
+    import cv2
+    from numpy import array_equal, uint8
+    from numpy.random import randint
+
+    # Self-check: The container must hold the frames exactly as OpenCV delivers them, record the
+    # number of frames actually read if the video ends early, be re-opened in the next run, and be
+    # rejected after the video has changed.
+    test_dir = mkdtemp()
+    test_file = join(test_dir, 'test.avi')
+    writer = cv2.VideoWriter(test_file, cv2.VideoWriter_fourcc(*'FFV1'), 25, (40, 30))
+    for index in range(5):
+        writer.write(randint(0, 256, (30, 40, 3)).astype(uint8))
+    writer.release()
+
+    capture = cv2.VideoCapture(test_file)
+    reference_frames = []
+    while True:
+        ret, frame = capture.read()
+        if not ret:
+            break
+        reference_frames.append(frame)
+    capture.release()
+    assert len(reference_frames) == 5
+
+    capture = cv2.VideoCapture(test_file)
+    ret, first_frame = capture.read()
+    transcoded = TranscodedVideo(test_file)
+    assert not transcoded.open()
+    assert transcoded.create(capture, first_frame, 8, 'Grayscale')
+    capture.release()
+    assert transcoded.frame_count == 5 and transcoded.bayer_pattern == 'Grayscale'
+    for index in range(5):
+        assert array_equal(transcoded.data[index], reference_frames[index])
+    transcoded.close()
+
+    transcoded = TranscodedVideo(test_file)
+    assert transcoded.open() and array_equal(transcoded.data[4], reference_frames[4])
+    transcoded.close()
+    with open(test_file, 'ab') as test_fid:
+        test_fid.write(b'0')
+    assert not TranscodedVideo(test_file).open()
+    rmtree(test_dir)
+    print("Video transcoder self-check passed")
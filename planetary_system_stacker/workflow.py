@@ -32,6 +32,7 @@ from numpy import uint16, uint8
 
 from align_frames import AlignFrames
 from alignment_points import AlignmentPoints
+from buffer_planner import BufferPlanner
 from configuration import PostprocDataObject
 from exceptions import NotSupportedError, InternalError, ArgumentError, Error
 from frames import Frames, Calibration
@@ -176,7 +177,12 @@ class Workflow(QtCore.QObject):
         # name).
         self.attached_log_name_new = None
 
-        # Remove objects from previous job to clean up RAM.
+        # Remove objects from previous job to clean up RAM. Stop reading frames ahead and write
+        # the sidecar cache to disk first.
+        if self.frames is not None:
+            self.frames.stop_prefetching()
+            self.frames.close_sidecar_cache()
+            self.frames.release_buffers()
         for obj in [self.frames, self.rank_frames, self.align_frames, self.alignment_points,
                     self.stack_frames]:
             if obj is not None:
@@ -214,9 +220,13 @@ class Workflow(QtCore.QObject):
             self.attached_log_name = splitext(self.job.name)[0] + '_postproc-log.txt'
 
         # For video file input, the Frames constructor expects the video file name for "names".
+        # If the video is split into several segments, it expects the list of their names.
         elif self.job.type == 'video':
             self.activity = 'stacking'
-            names = self.job.name
+            if len(self.job.segments) > 1:
+                names = self.job.segments
+            else:
+                names = self.job.name
             self.attached_log_name = splitext(self.job.name)[0] + '_stacking-log.txt'
 
         # For single image input, the Frames constructor expects a list of image file names for
@@ -286,6 +296,19 @@ class Workflow(QtCore.QObject):
                                      calibration=self.calibration,
                                      progress_signal=self.work_current_progress_signal)
 
+                # In "Planet" mode, optionally crop all frames to a window around the object. This
+                # is done before buffering is decided, because it reduces the RAM requirements.
+                if self.configuration.frames_auto_crop and \
+                        self.configuration.align_frames_mode == "Planet":
+                    object_window = AlignFrames.object_window(self.frames, self.configuration)
+                    if object_window is not None:
+                        self.frames.set_base_window(*object_window)
+                        if self.configuration.global_parameters_protocol_level > 1:
+                            Miscellaneous.protocol(
+                                "+++ Frames cropped to the object: " + str(object_window[0]) +
+                                "<y<" + str(object_window[1]) + ", " + str(object_window[2]) +
+                                "<x<" + str(object_window[3]) + " +++", self.attached_log_file)
+
                 # If buffering is not automatic, set the buffering_level as requested by the user.
                 if self.configuration.global_parameters_buffering_level != -1:
                     # Decide on the objects to be buffered, depending on configuration parameter.
@@ -295,10 +318,39 @@ class Workflow(QtCore.QObject):
                 else:
                     needed_ram = None
 
+                # If buffering was set to "auto" and the buffer planner is active, choose the
+                # buffering of each frame variant based on measured costs and the access pattern.
+                if self.configuration.global_parameters_buffering_level == -1 and \
+                        self.configuration.frames_buffer_planner:
+                    buffer_planner = BufferPlanner(self.frames, self.configuration)
+                    if not buffer_planner.compute_plan(available_ram):
+                        if not self.use_spill_buffers(available_ram):
+                            self.abort_job_signal.emit(
+                                "Error: Too little RAM for this job, continuing with the next one")
+                            return
+                    else:
+                        self.frames.set_buffering_plan(buffer_planner.plan)
+                    if self.configuration.global_parameters_protocol_level > 1 and \
+                            buffer_planner.plan is not None:
+                        Miscellaneous.protocol("+++ Buffering plan: " +
+                                               buffer_planner.plan_description() + " +++",
+                                               self.attached_log_file)
+                        Miscellaneous.protocol(
+                            "           Measured costs per frame (ms): " +
+                            buffer_planner.costs_description(), self.attached_log_file,
+                            precede_with_timestamp=False)
+                        Miscellaneous.protocol(
+                            "           Predicted time for reading / computing frames (s): " +
+                            str(round(buffer_planner.predicted_time, 1)) +
+                            ", RAM required (Gbytes): " +
+                            str(round(buffer_planner.required_ram, 2)) + ", available: " +
+                            str(round(available_ram, 2)), self.attached_log_file,
+                            precede_with_timestamp=False)
+
                 # If buffering was set to "auto", compute the highest possible value. If the
                 # buffering level requested explicitly was too high, test if lowering the
                 # buffering level would help.
-                if self.configuration.global_parameters_buffering_level == -1 or needed_ram > available_ram:
+                elif self.configuration.global_parameters_buffering_level == -1 or needed_ram > available_ram:
                     buffering_level_set = None
                     for level in range(4, -1, -1):
                         alternative_ram = self.frames.compute_required_buffer_size(level)
@@ -307,10 +359,15 @@ class Workflow(QtCore.QObject):
                             needed_ram = alternative_ram
                             break
 
-                    # Check if the job can be processed with the requested buffering level.
+                    # Check if the job can be processed with the requested buffering level. If
+                    # not even buffering level 0 fits, try to spill buffers to disk.
                     message = None
                     if buffering_level_set is None:
-                        message = "Error: Too little RAM for this job, continuing with the next one"
+                        if self.use_spill_buffers(available_ram):
+                            needed_ram = None
+                        else:
+                            message = "Error: Too little RAM for this job, continuing with the " \
+                                      "next one"
 
                     # If an appropriate level other then the one set by the user was found, write it
                     # as a recommendation to the protocol. The job is aborted anyway.
@@ -321,7 +378,7 @@ class Workflow(QtCore.QObject):
 
                     # Buffering is set to "auto" and an appropriate buffering level was found. Set
                     # the buffering in the frames object.
-                    else:
+                    elif buffering_level_set is not None:
                         self.frames.set_buffering(buffering_level_set)
 
                     # The job does not fit in RAM, continue with the next job.
@@ -334,7 +391,8 @@ class Workflow(QtCore.QObject):
                 else:
                     self.frames.set_buffering(buffering_level_set)
 
-                if self.configuration.global_parameters_protocol_level > 1:
+                if self.configuration.global_parameters_protocol_level > 1 and \
+                        needed_ram is not None:
                     Miscellaneous.protocol("+++ Buffering level is " +
                                            str(buffering_level_set) +
                                            " +++", self.attached_log_file)
@@ -431,6 +489,37 @@ class Workflow(QtCore.QObject):
                 self.postproc_input_image = self.postproc_input_image.astype(uint16) * 256
             self.work_next_task_signal.emit("Postprocessing")
 
+    def use_spill_buffers(self, available_ram):
+        """
+        If the frame buffers do not fit into RAM, keep them in memory-mapped scratch files on disk
+        instead. This is only possible if a spill directory is configured, and if the remaining
+        workspace fits into RAM.
+
+        :param available_ram: RAM available for the job in Gbytes.
+        :return: True, if spill buffers are used. False otherwise.
+        """
+
+        directory = self.configuration.frames_spill_directory
+        if not directory:
+            return False
+
+        needed_ram = self.frames.compute_required_buffer_size_fractions(
+            {'original': 0., 'monochrome': 0., 'gaussian': 0., 'laplacian': 0.})
+        if needed_ram >= available_ram:
+            return False
+
+        spilled_variants = self.frames.use_spill_buffers(directory)
+        if self.configuration.global_parameters_protocol_level > 1:
+            Miscellaneous.protocol("+++ Too little RAM for frame buffers, buffers for " +
+                                   ", ".join(spilled_variants) + " frames are kept in "
+                                   "scratch files in " + directory + " +++",
+                                   self.attached_log_file)
+            Miscellaneous.protocol(
+                "           RAM required (Gbytes): " + str(round(needed_ram, 2)) +
+                ", available: " + str(round(available_ram, 2)), self.attached_log_file,
+                precede_with_timestamp=False)
+        return True
+
     @QtCore.pyqtSlot()
     def execute_rank_frames(self):
 
@@ -448,6 +537,9 @@ class Workflow(QtCore.QObject):
                                           self.work_current_progress_signal)
             self.rank_frames.frame_score()
             self.my_timer.stop('Ranking frames')
+
+            # Now that the ranking is known, select the frames for partial buffering.
+            self.frames.set_partial_buffering(self.rank_frames.quality_sorted_indices_original)
         except Error as e:
             self.abort_job_signal.emit("Error: " + e.message + ", continuing with next job")
             self.my_timer.stop('Ranking frames')
@@ -744,6 +836,10 @@ class Workflow(QtCore.QObject):
         self.alignment_points.compute_frame_qualities()
         self.my_timer.stop('Rank frames at alignment points')
 
+        # Stacking only needs the original frames and the Gaussians. Return the buffer memory of the
+        # Laplacians and monochrome frames in one piece.
+        self.frames.retain_frames({'original': None, 'gaussian': None})
+
         self.work_next_task_signal.emit("Stack frames")
 
     @QtCore.pyqtSlot()
@@ -781,6 +877,13 @@ class Workflow(QtCore.QObject):
             Miscellaneous.protocol(self.stack_frames.print_shift_table() + "\n",
                                    self.attached_log_file, precede_with_timestamp=False)
 
+        cache_statistics = self.frames.cache_statistics()
+        if self.configuration.global_parameters_protocol_level > 1 and cache_statistics:
+            Miscellaneous.protocol("\n           Frame cache statistics:",
+                                   self.attached_log_file, precede_with_timestamp=False)
+            Miscellaneous.protocol(cache_statistics + "\n",
+                                   self.attached_log_file, precede_with_timestamp=False)
+
         self.set_status_bar_processing_phase("merging AP patches")
         # Merge the stacked alignment point buffers into a single image.
         if self.configuration.global_parameters_protocol_level > 0: